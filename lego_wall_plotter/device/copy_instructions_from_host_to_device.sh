@@ -1,3 +1,3 @@
-PYTHON_FILE="$(pwd)/out/nature/motor_instructions.txt"
+BINARY_FILE="$(pwd)/out/nature/motor_instructions.bin"
 
-ampy --port COM3 put $PYTHON_FILE custom/motor_instructions.txt
\ No newline at end of file
+ampy --port COM3 put $BINARY_FILE custom/motor_instructions.bin
\ No newline at end of file
@@ -0,0 +1 @@
+ampy --port COM3 get custom/telemetry.bin telemetry.bin
\ No newline at end of file
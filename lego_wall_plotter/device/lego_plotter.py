@@ -1,4 +1,5 @@
 import math
+import struct
 import time
 
 import hub
@@ -28,6 +29,9 @@ class Constants :
     PEN_UP = 0# not drawing
     PEN_DOWN = 180# drawing
     PEN_MOTOR_SPEED = 30# How fast to move pen up/down
+    PEN_POSITION_TOLERANCE_DEGREES = 5# the pen is in position when it is this close to it
+    PEN_CLEARANCE_DEGREES = 45# once lifted this far from PEN_DOWN, the pen is clear of the paper and we may start moving
+    PEN_MOVE_TIMEOUT_MS = 2000# never wait longer than this for the pen, in case it gets stuck before reaching its position
 
     # Motor settings for power control
     POWER_MAX_PERCENTAGE = 1.0# use only XX% of available motor power
@@ -38,21 +42,30 @@ class Constants :
     MM_PER_DEGREE = 3760 / 137816
     POINT_REACHED_ERROR_ACCEPTANCE_MM = 1
     POINT_REACHED_ERROR_ACCEPTANCE_DEGREES = POINT_REACHED_ERROR_ACCEPTANCE_MM / abs( MM_PER_DEGREE )
-    MAGIC_MOTOR_MODE = [ (1, 0), (2, 2), (3, 1), (0, 0) ]
-
-
-def sleep( seconds ) :
-    time.sleep( seconds )
 
-
-def sign( v ) -> int :
-    return (v > 0) - (v < 0)
+    # Motor settings for following the speeds planned by the host, these have to match the host Constants
+    PLANNED_DECELERATION_DEG_PER_S2 = 4000
+    END_SPEED_MAX = 255
+    # we never plan to go slower than this, otherwise we could stall just outside the acceptance distance
+    PLANNED_MIN_DEG_PER_S = 100
+
+    # Record how many iterations the control loop gets through, and how close it gets to every target
+    # Only the most recent TELEMETRY_CAPACITY moves are kept, see telemetry.py on the host to analyse the file
+    TELEMETRY = False
+    TELEMETRY_FILENAME = 'custom/telemetry.bin'
+    TELEMETRY_CAPACITY = 1024
+    TELEMETRY_SAVE_INTERVAL_PATHS = 50
+    MAGIC_MOTOR_MODE = [ (1, 0), (2, 2), (3, 1), (0, 0) ]
 
 
 class MotorInstruction:
-    def __init__( self, target_degrees_left, target_degrees_right ):
+    # The end speed is how fast we may still go when we reach the target, as planned by the host
+    # An end speed of 0 means we brake at the target, anything else means we keep moving into the next instruction
+    # Files without end speeds have None, and get the old behaviour of going full speed and braking at every instruction
+    def __init__( self, target_degrees_left, target_degrees_right, end_speed = None ):
         self.target_degrees_left = target_degrees_left
         self.target_degrees_right = target_degrees_right
+        self.end_speed = end_speed
 
 
 class MotorInstructionReader:
@@ -79,29 +92,231 @@ class PathReader:
             yield instruction
 
 
+class BinaryMotorInstructionReader:
+    # See motor_instructions_file.py on the host for a description of the binary format
+    # We only ever hold a single instruction in memory,
+    # and seek between the tables and the instructions instead of loading the tables.
+    MAGIC = b'LWPI'
+    VERSION_FIXED_WIDTH = 1
+    VERSION_DELTA_ENCODED = 2
+    VERSION_FIXED_WIDTH_WITH_END_SPEEDS = 3
+    VERSION_DELTA_ENCODED_WITH_END_SPEEDS = 4
+    HEADER_FORMAT = '<4sHHII'
+    HEADER_SIZE = 16
+    DELTA_HEADER_SIZE = 8
+
+    def __init__(self, filename):
+        self._file = open( filename, 'rb' )
+        magic, self.version, self.units_per_degree, self.n_paths, self.n_instructions = struct.unpack(
+            self.HEADER_FORMAT, self._file.read( self.HEADER_SIZE )
+        )
+        assert magic == self.MAGIC
+        assert 1 <= self.version <= 4
+        self._is_delta_encoded = self.version in ( self.VERSION_DELTA_ENCODED, self.VERSION_DELTA_ENCODED_WITH_END_SPEEDS )
+        self._n_values = 3 if self.version >= self.VERSION_FIXED_WIDTH_WITH_END_SPEEDS else 2
+
+        table_size = 4 * ( self.n_paths + 1 )
+        self._path_offsets_position = self.HEADER_SIZE
+        if not self._is_delta_encoded:
+            self._instructions_position = self._path_offsets_position + table_size
+        else:
+            self._file.seek( self._path_offsets_position + table_size )
+            self.keyframe_interval, self.n_keyframes = struct.unpack( '<II', self._file.read( self.DELTA_HEADER_SIZE ) )
+            self._path_keyframe_offsets_position = self._path_offsets_position + table_size + self.DELTA_HEADER_SIZE
+            self._keyframe_byte_offsets_position = self._path_keyframe_offsets_position + table_size
+            self._instructions_position = self._keyframe_byte_offsets_position + 4 * self.n_keyframes
+
+    def _read_uint32( self, position ):
+        self._file.seek( position )
+        return struct.unpack( '<I', self._file.read( 4 ) )[ 0 ]
+
+    def paths(self):
+        for i_path in range( self.n_paths ):
+            start = self._read_uint32( self._path_offsets_position + 4 * i_path )
+            end = self._read_uint32( self._path_offsets_position + 4 * ( i_path + 1 ) )
+            if not self._is_delta_encoded:
+                yield BinaryPathReader(
+                    self._file, self._instructions_position + 4 * self._n_values * start, end - start, self._n_values, self.units_per_degree
+                )
+                continue
+
+            byte_offset = 0
+            if end > start:
+                i_keyframe = self._read_uint32( self._path_keyframe_offsets_position + 4 * i_path )
+                byte_offset = self._read_uint32( self._keyframe_byte_offsets_position + 4 * i_keyframe )
+            yield DeltaPathReader(
+                self._file, self._instructions_position + byte_offset, end - start, self._n_values, self.keyframe_interval, self.units_per_degree
+            )
+        return
+
+
+class BinaryPathReader:
+    def __init__(self, file, position, n_instructions, n_values, units_per_degree):
+        self._file = file
+        self._position = position
+        self._n_instructions = n_instructions
+        self._n_values = n_values
+        self._units_per_degree = units_per_degree
+
+    def instructions(self):
+        self._file.seek( self._position )
+        instruction_format = '<' + 'i' * self._n_values
+        instruction_size = 4 * self._n_values
+        for _ in range( self._n_instructions ):
+            values = struct.unpack( instruction_format, self._file.read( instruction_size ) )
+            yield MotorInstruction( values[ 0 ] / self._units_per_degree, values[ 1 ] / self._units_per_degree, *values[ 2 : ] )
+
+
+class DeltaPathReader:
+    # Decodes zigzag varints incrementally from small chunks of the file,
+    # so a path never has to be held in memory as a whole
+    CHUNK_SIZE = 64
+
+    def __init__(self, file, position, n_instructions, n_values, keyframe_interval, units_per_degree):
+        self._file = file
+        self._position = position
+        self._n_instructions = n_instructions
+        self._n_values = n_values
+        self._keyframe_interval = keyframe_interval
+        self._units_per_degree = units_per_degree
+        self._chunk = b''
+        self._chunk_index = 0
+
+    def _read_byte( self ):
+        if self._chunk_index >= len( self._chunk ):
+            self._chunk = self._file.read( self.CHUNK_SIZE )
+            self._chunk_index = 0
+        byte = self._chunk[ self._chunk_index ]
+        self._chunk_index += 1
+        return byte
+
+    def _read_signed( self ):
+        value = 0
+        shift = 0
+        while True:
+            byte = self._read_byte()
+            value |= ( byte & 0x7F ) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        # undo the zigzag encoding
+        return ( value >> 1 ) ^ -( value & 1 )
+
+    def instructions(self):
+        self._file.seek( self._position )
+        has_end_speed = self._n_values == 3
+        left = 0
+        right = 0
+        end_speed = 0
+        for i_instruction in range( self._n_instructions ):
+            left_value = self._read_signed()
+            right_value = self._read_signed()
+            end_speed_value = self._read_signed() if has_end_speed else 0
+            if i_instruction % self._keyframe_interval == 0:
+                left = left_value
+                right = right_value
+                end_speed = end_speed_value
+            else:
+                left += left_value
+                right += right_value
+                end_speed += end_speed_value
+            yield MotorInstruction( left / self._units_per_degree, right / self._units_per_degree, end_speed if has_end_speed else None )
+
+
+def open_motor_instruction_reader( *filenames ):
+    # Use the first file that exists, so the binary file can be preferred with the text file as a fallback
+    for filename in filenames:
+        try:
+            with open( filename, 'rb' ) as file:
+                is_binary = file.read( 4 ) == BinaryMotorInstructionReader.MAGIC
+        except OSError:
+            continue
+        if is_binary:
+            return BinaryMotorInstructionReader( filename )
+        return MotorInstructionReader( filename )
+    raise OSError( 'None of the motor instruction files exist' )
+
+
 class LegoPenController :
+    # Pen moves do not sleep for a fixed time, but poll the position of the pen motor until it gets there
+    # Lifting the pen only waits until the pen is clear of the paper,
+    # the rest of the lift happens while the plotter already travels to the next path
     def __init__( self ) :
         self.motor = Constants.MOTOR_PEN.motor
         self.motor.mode( Constants.MAGIC_MOTOR_MODE )
         self.stop_drawing()
+        self._wait_until( self._is_in_position )
 
-    def _move_to_position( self, target_position ) :
-        dif = target_position - self.motor.get()[ 2 ]
-        if abs( dif ) > 5 :
+    def _get_position( self ) :
+        return self.motor.get()[ 2 ]
+
+    def _start_move_to_position( self, target_position ) :
+        self._target_position = target_position
+        dif = target_position - self._get_position()
+        if abs( dif ) > Constants.PEN_POSITION_TOLERANCE_DEGREES :
             self.motor.run_for_degrees( abs( dif ), round( math.copysign( Constants.PEN_MOTOR_SPEED, dif ) ) )
-            sleep( 1 )
 
         # self.motor.run_to_position( Constants.PEN_DOWN )
 
+    def _is_in_position( self ) :
+        return abs( self._target_position - self._get_position() ) <= Constants.PEN_POSITION_TOLERANCE_DEGREES
+
+    def _is_clear_of_paper( self ) :
+        return abs( Constants.PEN_DOWN - self._get_position() ) >= Constants.PEN_CLEARANCE_DEGREES or self._is_in_position()
+
+    def _wait_until( self, condition ) :
+        start_ms = time.ticks_ms()
+        while not condition() and time.ticks_diff( time.ticks_ms(), start_ms ) < Constants.PEN_MOVE_TIMEOUT_MS :
+            pass
+
     def start_drawing( self ) :
-        self._move_to_position( Constants.PEN_DOWN )
+        # only call this once the plotter reached the start of the path, since we wait until the pen touches the paper
+        # This also takes over from a lift that is still going on
+        self._start_move_to_position( Constants.PEN_DOWN )
+        self._wait_until( self._is_in_position )
 
     def stop_drawing( self ) :
-        self._move_to_position( Constants.PEN_UP )
+        # returns as soon as the plotter can start moving again, while the pen keeps going up
+        self._start_move_to_position( Constants.PEN_UP )
+        self._wait_until( self._is_clear_of_paper )
+
+
+class TelemetryRecorder :
+    # Records how every move went in a ring buffer, which is saved to a file for later analysis on the host
+    # See telemetry.py on the host for a description of the file
+    # The buffer is allocated once, and only the most recent CAPACITY moves are kept
+    MAGIC = b'LWPT'
+    VERSION = 1
+    HEADER_FORMAT = '<4sHHII'
+    RECORD_FORMAT = '<IIf'
+    RECORD_SIZE = 12
+
+    def __init__( self, filename, capacity ) :
+        self._filename = filename
+        self._capacity = capacity
+        self._buffer = bytearray( capacity * self.RECORD_SIZE )
+        self._n_records = 0
+
+    def record( self, n_iterations, duration_us ) :
+        # the final error is only known at the start of the next move, after braking and settling
+        position = ( self._n_records % self._capacity ) * self.RECORD_SIZE
+        struct.pack_into( self.RECORD_FORMAT, self._buffer, position, n_iterations, duration_us, -1.0 )
+        self._n_records += 1
+
+    def set_final_error( self, error_degrees ) :
+        if self._n_records == 0 :
+            return
+        position = ( ( self._n_records - 1 ) % self._capacity ) * self.RECORD_SIZE
+        struct.pack_into( '<f', self._buffer, position + 8, error_degrees )
+
+    def save( self ) :
+        with open( self._filename, 'wb' ) as file :
+            file.write( struct.pack( self.HEADER_FORMAT, self.MAGIC, self.VERSION, self.RECORD_SIZE, self._capacity, self._n_records ) )
+            file.write( self._buffer )
 
 
 class LegoMotorController :
-    def __init__( self ) :
+    def __init__( self, telemetry = None ) :
         self.motor_left = Constants.MOTOR_LEFT.motor
         self.motor_left.mode( Constants.MAGIC_MOTOR_MODE )
         self.start_pos_left = self.motor_left.get()[ 1 ]
@@ -110,53 +325,119 @@ class LegoMotorController :
         self.motor_right.mode( Constants.MAGIC_MOTOR_MODE )
         self.start_pos_right = self.motor_right.get()[ 1 ]
 
-    def get_current_degrees( self ):
-        return (
-            self.motor_left.get()[ 1 ] - self.start_pos_left,
-            self.motor_right.get()[ 1 ] - self.start_pos_right
-        )
+        # the powers that were set last, so we only talk to the motors when something changes
+        self._power_left = 0
+        self._power_right = 0
+
+        # the target of the previous move, in raw motor positions, to measure how close we got to it
+        self.telemetry = telemetry
+        self._previous_target_left = self.start_pos_left
+        self._previous_target_right = self.start_pos_right
+
+    def record_final_error( self ) :
+        # how far we ended up from the previous target, now that the motors had time to come to a stop
+        error_left = self._previous_target_left - self.motor_left.get()[ 1 ]
+        error_right = self._previous_target_right - self.motor_right.get()[ 1 ]
+        self.telemetry.set_final_error( math.sqrt( error_left * error_left + error_right * error_right ) )
 
     def move( self, motor_instruction ) :
         # motor instructions describe in an absolute sense,
         # what the degrees should be to be at a certain point.
-        while True :
-            # determine current position in motor degrees
-            current_degrees_left, current_degrees_right = self.get_current_degrees()
+        # Unless the instruction has an end speed, we brake once we get there.
+        # Otherwise the motors keep running, and the next instruction simply takes over from here.
+        # With an end speed we also slow down in time to reach the target at that speed,
+        # so we do not overshoot the target, or the corner after it.
+
+        # The loop below runs as often as the hub allows, and the more often it runs, the more precise we are.
+        # So everything it needs is looked up once before it starts, the targets are converted to raw motor positions,
+        # errors are compared squared instead of taking a square root, and the motors are only updated when their power changes.
+        target_left = motor_instruction.target_degrees_left + self.start_pos_left
+        target_right = motor_instruction.target_degrees_right + self.start_pos_right
+        get_left = self.motor_left.get
+        get_right = self.motor_right.get
+        pwm_left = self.motor_left.pwm
+        pwm_right = self.motor_right.pwm
+        power_left = self._power_left
+        power_right = self._power_right
+
+        acceptance_degrees = Constants.POINT_REACHED_ERROR_ACCEPTANCE_DEGREES
+        squared_acceptance_degrees = acceptance_degrees * acceptance_degrees
+        max_dps = Constants.MAX_DEG_PER_S
+        squared_max_dps = max_dps * max_dps
+        power_per_dps = Constants.POWER_PER_DEGREE_PER_SECOND
+        max_power = max_dps * power_per_dps
+        double_deceleration = 2 * Constants.PLANNED_DECELERATION_DEG_PER_S2
+        squared_min_dps = Constants.PLANNED_MIN_DEG_PER_S * Constants.PLANNED_MIN_DEG_PER_S
+        squared_end_dps = None
+        if motor_instruction.end_speed is not None :
+            end_dps = motor_instruction.end_speed * max_dps / Constants.END_SPEED_MAX
+            squared_end_dps = end_dps * end_dps
+
+        telemetry = self.telemetry
+        if telemetry is not None :
+            self.record_final_error()
+            start_us = time.ticks_us()
+        n_iterations = 0
 
-            # determine the error
-            error_degrees_left = motor_instruction.target_degrees_left - current_degrees_left
-            error_degrees_right = motor_instruction.target_degrees_right - current_degrees_right
+        while True :
+            n_iterations += 1
 
-            # check if we reached our target
-            error_degrees = math.sqrt( error_degrees_left ** 2 + error_degrees_right ** 2 )
-            if error_degrees <= Constants.POINT_REACHED_ERROR_ACCEPTANCE_DEGREES :
+            # determine the error, and check if we reached our target
+            error_degrees_left = target_left - get_left()[ 1 ]
+            error_degrees_right = target_right - get_right()[ 1 ]
+            if error_degrees_left * error_degrees_left + error_degrees_right * error_degrees_right <= squared_acceptance_degrees :
                 break
 
             # we will first ignore the signs because it makes scaling proportionally easier
-            abs_error_degrees_left = abs( error_degrees_left )
-            abs_error_degrees_right = abs( error_degrees_right )
-
-            # one of the motors will run at max dps, while the other is scaled proportionally
-            if abs_error_degrees_left < abs_error_degrees_right :
-                left_dps = round( (abs_error_degrees_left / abs_error_degrees_right) * Constants.MAX_DEG_PER_S )
-                right_dps = Constants.MAX_DEG_PER_S
-            else :
-                left_dps = Constants.MAX_DEG_PER_S
-                right_dps = round( (abs_error_degrees_right / abs_error_degrees_left) * Constants.MAX_DEG_PER_S )
-
-            # we now fix the signs
-            left_dps *= sign( error_degrees_left )
-            right_dps *= sign( error_degrees_right )
-
-            # update dps
-            self.set_degree_per_second( left_dps, right_dps )
+            abs_error_degrees_left = error_degrees_left if error_degrees_left >= 0 else -error_degrees_left
+            abs_error_degrees_right = error_degrees_right if error_degrees_right >= 0 else -error_degrees_right
+            abs_error_degrees = abs_error_degrees_left if abs_error_degrees_left > abs_error_degrees_right else abs_error_degrees_right
+
+            # follow the planned speed: the fastest speed from which we can still slow down to the end speed,
+            # by the time we are within the acceptance distance
+            # We only need the square root when that is slower than the maximum speed
+            power = max_power
+            if squared_end_dps is not None :
+                remaining_degrees = abs_error_degrees - acceptance_degrees
+                squared_dps = squared_end_dps + double_deceleration * remaining_degrees if remaining_degrees > 0 else squared_end_dps
+                if squared_dps < squared_min_dps :
+                    squared_dps = squared_min_dps
+                if squared_dps < squared_max_dps :
+                    power = math.sqrt( squared_dps ) * power_per_dps
+
+            # one of the motors will run at the planned speed, while the other is scaled proportionally
+            # and we now fix the signs
+            new_power_left = round( power * abs_error_degrees_left / abs_error_degrees )
+            new_power_right = round( power * abs_error_degrees_right / abs_error_degrees )
+            if error_degrees_left < 0 :
+                new_power_left = -new_power_left
+            if error_degrees_right < 0 :
+                new_power_right = -new_power_right
+
+            # update power
+            if new_power_left != power_left :
+                pwm_left( new_power_left )
+                power_left = new_power_left
+            if new_power_right != power_right :
+                pwm_right( new_power_right )
+                power_right = new_power_right
+
+        self._power_left = power_left
+        self._power_right = power_right
+        self._previous_target_left = target_left
+        self._previous_target_right = target_right
+        if telemetry is not None :
+            telemetry.record( n_iterations, time.ticks_diff( time.ticks_us(), start_us ) )
 
         # target reached!
-        self.brake()
+        if not motor_instruction.end_speed :
+            self.brake()
 
     def set_degree_per_second( self, left, right ) :
-        self.motor_left.pwm( round( left * Constants.POWER_PER_DEGREE_PER_SECOND ) )
-        self.motor_right.pwm( round( right * Constants.POWER_PER_DEGREE_PER_SECOND ) )
+        self._power_left = round( left * Constants.POWER_PER_DEGREE_PER_SECOND )
+        self._power_right = round( right * Constants.POWER_PER_DEGREE_PER_SECOND )
+        self.motor_left.pwm( self._power_left )
+        self.motor_right.pwm( self._power_right )
 
     def brake( self ) :
         self.set_degree_per_second( 0, 0 )
@@ -167,11 +448,15 @@ class LegoMotorController :
 def plot_motor_instructions( motor_instruction_reader ) :
 
     pen_controller = LegoPenController()
-    motor_controller = LegoMotorController()
+    telemetry = None
+    if Constants.TELEMETRY :
+        telemetry = TelemetryRecorder( Constants.TELEMETRY_FILENAME, Constants.TELEMETRY_CAPACITY )
+    motor_controller = LegoMotorController( telemetry )
 
-    for motor_instruction_path in motor_instruction_reader.paths():
+    for i_path, motor_instruction_path in enumerate( motor_instruction_reader.paths() ):
 
         # move to the first point of the path before starting to draw the rest
+        # the pen only goes down once we got there
         instruction_generator = motor_instruction_path.instructions()
         first_point = next( instruction_generator )
         motor_controller.move( first_point )
@@ -182,8 +467,17 @@ def plot_motor_instructions( motor_instruction_reader ) :
             motor_controller.move( instruction )
 
         # move pen up before moving to the beginning of the next path
+        # We only wait until it is clear of the paper, it keeps going up during the move to the next path
         pen_controller.stop_drawing()
 
+        # save the telemetry every now and then, so we still have it when the plot is stopped halfway
+        if telemetry is not None and ( i_path + 1 ) % Constants.TELEMETRY_SAVE_INTERVAL_PATHS == 0 :
+            telemetry.save()
+
+    if telemetry is not None :
+        motor_controller.record_final_error()
+        telemetry.save()
+
 
 # Put the robot in place on the board
 # measure the offset to the board and put those values in Constants
@@ -193,4 +487,4 @@ def plot_motor_instructions( motor_instruction_reader ) :
 # upload your program to your hub
 # connect the hub again to the lego robot
 # execute the program!
-plot_motor_instructions( MotorInstructionReader( 'custom/motor_instructions.txt' ) )
\ No newline at end of file
+plot_motor_instructions( open_motor_instruction_reader( 'custom/motor_instructions.bin', 'custom/motor_instructions.txt' ) )
\ No newline at end of file
@@ -0,0 +1,153 @@
+from dataclasses import asdict, dataclass
+import json
+import logging
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import CanvasArrayPack, CanvasPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.convert_svg import get_initial_pen_position_in_canvas_space
+
+
+"""
+Analyzes the quality of a CanvasPack before it is converted to motor instructions, all at once with NumPy.
+
+Moves shorter than QUALITY_THRESHOLD_DISTANCE_VALUE are hardly visible, but the Device still has to reach every one of them.
+The distances are split into drawing with the pen down, and travelling between paths with the pen up,
+where the first travel starts at the initial pen position.
+
+The plotter hangs from two ropes, which can only position the pen well away from the singularities of that setup:
+close to an anchor the rope is too short to move the pen in every direction,
+close to the line between the anchors both ropes pull almost horizontally, and cannot carry the weight of the plotter,
+and outside of the anchors, or close to the edges of the board, the plotter does not hang straight or may fall off.
+Points within QUALITY_SINGULARITY_DISTANCE_MM of any of those are counted.
+"""
+
+
+_SEGMENT_LENGTH_PERCENTILES = ( 5, 25, 50, 75, 95 )
+_SEGMENT_LENGTH_HISTOGRAM_BINS_MM = ( 0, 0.5, 1, 2, 5, 10, 20, 50 )
+
+
+@dataclass
+class QualityReport:
+    n_paths : int
+    n_points : int
+
+    # of the segments drawn with the pen down, in mm
+    segment_length_min_mm : float | None
+    segment_length_mean_mm : float | None
+    segment_length_max_mm : float | None
+    segment_length_percentiles_mm : dict[ str, float ]
+    # the number of segments with a length from every bin edge up to the next one, and the last up to infinity
+    segment_length_histogram : dict[ str, int ]
+
+    # of all moves, including the travel between paths
+    n_short_moves : int
+
+    pen_down_distance_mm : float
+    pen_up_distance_mm : float
+
+    # min x, min y, max x, max y
+    bounding_box_board_mm : list[ float ] | None
+
+    n_points_near_anchors : int
+    n_points_near_anchor_line : int
+    n_points_outside_anchors : int
+    n_points_near_board_edges : int
+
+
+def _get_distances_to_line( points : np.ndarray, line_start : np.ndarray, line_end : np.ndarray ) -> np.ndarray:
+    direction = ( line_end - line_start ) / np.hypot( *( line_end - line_start ) )
+    offsets = points - line_start
+    return np.abs( offsets[ :, 0 ] * direction[ 1 ] - offsets[ :, 1 ] * direction[ 0 ] )
+
+
+def analyze_canvas_pack_quality( canvas_pack : CanvasPack | CanvasArrayPack ) -> QualityReport:
+    canvas_pack = CanvasArrayPack.from_paths( canvas_pack )
+    coordinates = canvas_pack.coordinates
+    initial_point = get_initial_pen_position_in_canvas_space()
+
+    # the distance of every move, where the first move starts at the initial pen position
+    previous_coordinates = np.concatenate( ( [ ( initial_point.x, initial_point.y ) ], coordinates[ : -1 ] ) )
+    distances = np.hypot( *( coordinates - previous_coordinates ).T )
+    pen_up = np.zeros( len( coordinates ), dtype = bool )
+    pen_up[ canvas_pack.path_offsets[ : -1 ][ canvas_pack.path_lengths > 0 ] ] = True
+    segment_lengths = distances[ ~pen_up ]
+
+    has_segments = len( segment_lengths ) > 0
+    histogram_counts, _ = np.histogram( segment_lengths, bins = [ *_SEGMENT_LENGTH_HISTOGRAM_BINS_MM, np.inf ] )
+    percentiles = np.percentile( segment_lengths, _SEGMENT_LENGTH_PERCENTILES ) if has_segments else []
+
+    # everything about singularities is in board space
+    board_coordinates = coordinates + Constants.CANVAS_OFFSET_TO_BOARD_MM
+    left_anchor = np.array( Constants.LEFT_ANCHOR_OFFSET_TO_BOARD_MM, dtype = float )
+    right_anchor = np.array( Constants.RIGHT_ANCHOR_OFFSET_TO_BOARD_MM, dtype = float )
+    board_size = np.array( Constants.BOARD_SIZE_MM, dtype = float )
+    distance = Constants.QUALITY_SINGULARITY_DISTANCE_MM
+
+    near_anchors = (
+        ( np.hypot( *( board_coordinates - left_anchor ).T ) < distance )
+        | ( np.hypot( *( board_coordinates - right_anchor ).T ) < distance )
+    )
+    near_anchor_line = _get_distances_to_line( board_coordinates, left_anchor, right_anchor ) < distance
+    outside_anchors = ( board_coordinates[ :, 0 ] < left_anchor[ 0 ] ) | ( board_coordinates[ :, 0 ] > right_anchor[ 0 ] )
+    near_board_edges = np.any( ( board_coordinates < distance ) | ( board_coordinates > board_size - distance ), axis = 1 )
+
+    return QualityReport(
+        n_paths = len( canvas_pack ),
+        n_points = canvas_pack.n_points,
+        segment_length_min_mm = float( segment_lengths.min() ) if has_segments else None,
+        segment_length_mean_mm = float( segment_lengths.mean() ) if has_segments else None,
+        segment_length_max_mm = float( segment_lengths.max() ) if has_segments else None,
+        segment_length_percentiles_mm = {
+            f"p{percentile}" : float( value ) for percentile, value in zip( _SEGMENT_LENGTH_PERCENTILES, percentiles )
+        },
+        segment_length_histogram = {
+            f"{edge}mm" : int( count ) for edge, count in zip( _SEGMENT_LENGTH_HISTOGRAM_BINS_MM, histogram_counts )
+        },
+        n_short_moves = int( np.count_nonzero( distances < Constants.QUALITY_THRESHOLD_DISTANCE_VALUE ) ),
+        pen_down_distance_mm = float( segment_lengths.sum() ),
+        pen_up_distance_mm = float( distances[ pen_up ].sum() ),
+        bounding_box_board_mm = [
+            *board_coordinates.min( axis = 0 ).tolist(), *board_coordinates.max( axis = 0 ).tolist()
+        ] if len( board_coordinates ) > 0 else None,
+        n_points_near_anchors = int( np.count_nonzero( near_anchors ) ),
+        n_points_near_anchor_line = int( np.count_nonzero( near_anchor_line ) ),
+        n_points_outside_anchors = int( np.count_nonzero( outside_anchors ) ),
+        n_points_near_board_edges = int( np.count_nonzero( near_board_edges ) ),
+    )
+
+
+def log_quality_report( report : QualityReport ) -> None:
+    logging.info( "-" * 64 )
+    logging.info( f"Quality of {report.n_paths} paths with {report.n_points} points:" )
+    if report.segment_length_mean_mm is not None:
+        logging.info(
+            f"  segment length: median {report.segment_length_percentiles_mm[ 'p50' ]:.2f}mm, "
+            f"mean {report.segment_length_mean_mm:.2f}mm, max {report.segment_length_max_mm:.2f}mm"
+        )
+    logging.info( f"  {report.n_short_moves} moves shorter than {Constants.QUALITY_THRESHOLD_DISTANCE_VALUE}mm" )
+    logging.info( f"  distance: {report.pen_down_distance_mm:.0f}mm pen down, {report.pen_up_distance_mm:.0f}mm pen up" )
+    if report.bounding_box_board_mm is not None:
+        min_x, min_y, max_x, max_y = report.bounding_box_board_mm
+        logging.info( f"  bounding box on the board: ( {min_x:.0f}, {min_y:.0f} ) to ( {max_x:.0f}, {max_y:.0f} )mm" )
+
+    n_points_near_singularities = (
+        report.n_points_near_anchors + report.n_points_near_anchor_line
+        + report.n_points_outside_anchors + report.n_points_near_board_edges
+    )
+    if n_points_near_singularities > 0:
+        logging.warning(
+            f"  points near singularities: {report.n_points_near_anchors} near the anchors, "
+            f"{report.n_points_near_anchor_line} near the line between the anchors, "
+            f"{report.n_points_outside_anchors} outside of the anchors, {report.n_points_near_board_edges} near the edges of the board"
+        )
+    logging.info( "-" * 64 )
+
+
+def write_quality_report( canvas_pack : CanvasPack | CanvasArrayPack, path : str ) -> QualityReport:
+    report = analyze_canvas_pack_quality( canvas_pack )
+    with open( path, 'w' ) as f:
+        json.dump( asdict( report ), f, indent = 4 )
+    log_quality_report( report )
+    return report
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from typing import NewType
 
+import numpy as np
+
 from lego_wall_plotter.host.constants import Constants
 
 
@@ -62,4 +64,148 @@ class MotorInstruction:
     target_degrees_right : float
 
 MotorInstructionsPath = list[ MotorInstruction ]
-MotorInstructionsPack = list[ MotorInstructionsPath ]
\ No newline at end of file
+MotorInstructionsPack = list[ MotorInstructionsPath ]
+
+# ----------------------------------------------------------------
+class ArrayPack:
+    # A compact, columnar alternative to a list of lists of points.
+    # The coordinates of all paths are stored in one contiguous ( n_points, 2 ) float array,
+    # and path i consists of coordinates[ path_offsets[ i ] : path_offsets[ i + 1 ] ].
+    # Validation of the coordinate space happens once for the whole array, instead of once per point.
+    # Iterating over a pack, or indexing it, still gives lists of points,
+    # so code written against the old list-of-points API keeps working.
+
+    # the point class that is used when converting back to the list-of-points API
+    point_type = None
+
+    def __init__( self, coordinates : np.ndarray, path_offsets : np.ndarray ):
+        self.coordinates = np.ascontiguousarray( coordinates, dtype = np.float64 ).reshape( -1, 2 )
+        self.path_offsets = np.ascontiguousarray( path_offsets, dtype = np.int64 )
+
+        # make sure the offsets are valid
+        assert len( self.path_offsets ) > 0
+        assert self.path_offsets[ 0 ] == 0
+        assert self.path_offsets[ -1 ] == len( self.coordinates )
+        assert np.all( np.diff( self.path_offsets ) >= 0 )
+
+        # make sure the coordinates are valid
+        self._validate()
+
+    def _validate( self ) -> None:
+        pass
+
+    @staticmethod
+    def _get_point_coordinates( point ) -> tuple[ float, float ]:
+        return point.x, point.y
+
+    @classmethod
+    def from_path_arrays( cls, path_arrays : list[ np.ndarray ] ):
+        # build a pack from a list of ( n, 2 ) coordinate arrays, one per path
+        path_lengths = [ len( path_array ) for path_array in path_arrays ]
+        path_offsets = np.zeros( len( path_arrays ) + 1, dtype = np.int64 )
+        np.cumsum( path_lengths, out = path_offsets[ 1 : ] )
+        if len( path_arrays ) == 0:
+            return cls( np.empty( ( 0, 2 ) ), path_offsets )
+        return cls( np.concatenate( [ np.reshape( path_array, ( -1, 2 ) ) for path_array in path_arrays ] ), path_offsets )
+
+    @classmethod
+    def from_paths( cls, paths ):
+        # adapter for the list-of-points API, array packs are converted without copying the points one by one
+        if isinstance( paths, ArrayPack ):
+            if type( paths ) is cls:
+                return paths
+            return cls( paths.coordinates, paths.path_offsets )
+        return cls.from_path_arrays( [
+            np.array( [ cls._get_point_coordinates( point ) for point in path ], dtype = np.float64 ) for path in paths
+        ] )
+
+    @classmethod
+    def concatenate( cls, packs : list ):
+        packs = [ ArrayPack.from_paths( pack ) for pack in packs ]
+        coordinates = [ pack.coordinates for pack in packs ]
+        path_offsets = [ np.zeros( 1, dtype = np.int64 ) ]
+        n_points = 0
+        for pack in packs:
+            path_offsets.append( pack.path_offsets[ 1 : ] + n_points )
+            n_points += len( pack.coordinates )
+        return cls( np.concatenate( coordinates ) if coordinates else np.empty( ( 0, 2 ) ), np.concatenate( path_offsets ) )
+
+    def __len__( self ) -> int:
+        return len( self.path_offsets ) - 1
+
+    def __getitem__( self, index : int ) -> list:
+        index = range( len( self ) )[ index ]
+        return [ self.point_type( x, y ) for x, y in self.path_coordinates( index ).tolist() ]
+
+    def __iter__( self ):
+        for index in range( len( self ) ):
+            yield self[ index ]
+
+    @property
+    def n_points( self ) -> int:
+        return len( self.coordinates )
+
+    @property
+    def path_lengths( self ) -> np.ndarray:
+        return np.diff( self.path_offsets )
+
+    def path_coordinates( self, index : int ) -> np.ndarray:
+        # a view on the coordinates of a single path, without copying
+        return self.coordinates[ self.path_offsets[ index ] : self.path_offsets[ index + 1 ] ]
+
+    def iter_path_coordinates( self ):
+        for index in range( len( self ) ):
+            yield self.path_coordinates( index )
+
+    def path_starts( self ) -> np.ndarray:
+        return self.coordinates[ self.path_offsets[ : -1 ] ]
+
+    def path_ends( self ) -> np.ndarray:
+        return self.coordinates[ self.path_offsets[ 1 : ] - 1 ]
+
+    def reordered( self, order : np.ndarray, reversed_paths : np.ndarray = None ):
+        # returns a new pack containing the paths in the given order,
+        # optionally with some of the paths reversed
+        if reversed_paths is None:
+            reversed_paths = np.zeros( len( order ), dtype = bool )
+        path_arrays = []
+        for index, is_reversed in zip( np.asarray( order ).tolist(), np.asarray( reversed_paths ).tolist() ):
+            path_array = self.path_coordinates( index )
+            path_arrays.append( path_array[ : : -1 ] if is_reversed else path_array )
+        return type( self ).from_path_arrays( path_arrays )
+
+    def to_paths( self ) -> list:
+        return list( self )
+
+
+class PlotArrayPack( ArrayPack ):
+    point_type = PlotPoint
+
+    def _validate( self ) -> None:
+        assert np.all( ( 0 <= self.coordinates ) & ( self.coordinates <= 1 ) )
+
+
+class CanvasArrayPack( ArrayPack ):
+    point_type = CanvasPoint
+
+    def _validate( self ) -> None:
+        # the same slack as in CanvasPoint
+        canvas_size = np.array( Constants.CANVAS_SIZE_MM, dtype = np.float64 )
+        assert np.all( ( 0 - 1 <= self.coordinates ) & ( self.coordinates < canvas_size + 1 ) )
+
+
+class BoardArrayPack( ArrayPack ):
+    point_type = BoardPoint
+
+    def _validate( self ) -> None:
+        board_size = np.array( Constants.BOARD_SIZE_MM, dtype = np.float64 )
+        assert np.all( ( 0 <= self.coordinates ) & ( self.coordinates <= board_size ) )
+
+
+class MotorInstructionsArrayPack( ArrayPack ):
+    # the two columns are the target degrees of the left and the right motor
+    point_type = MotorInstruction
+
+    @staticmethod
+    def _get_point_coordinates( point : MotorInstruction ) -> tuple[ float, float ]:
+        return point.target_degrees_left, point.target_degrees_right
@@ -0,0 +1,162 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.main import make_motor_instructions, make_motor_instructions_streaming
+from lego_wall_plotter.host.stage_cache import StageCache
+
+
+"""
+Batch entrypoint, to convert many SVGs to instructions for the Device at once.
+Every SVG gets its own project directory, named after the SVG,
+and the SVGs are converted concurrently, one per worker process.
+A failing SVG does not stop the batch, it is simply reported in the summary.
+
+Example, converting everything in the in/ directory to projects in the out/ directory:
+    python -m lego_wall_plotter.host.batch in --out out --overwrite
+"""
+
+
+# relative to the root of the repository
+_DEFAULT_IN_DIRECTORY = Path( __file__ ).parents[ 2 ] / 'in'
+_DEFAULT_OUT_DIRECTORY = Path( __file__ ).parents[ 2 ] / 'out'
+
+
+@dataclass
+class BatchResult:
+    in_path_svg : str
+    project_name : str
+    duration_s : float
+    n_instructions : int | None = None
+    error : str | None = None
+
+
+def _collect_svg_files( inputs : list[ str ] ) -> list[ Path ]:
+    # inputs can be SVG files, or directories of which we take all SVG files
+    svg_files = []
+    for input_path in map( Path, inputs ):
+        if input_path.is_dir():
+            svg_files.extend( sorted( input_path.glob( '*.svg' ) ) )
+        else:
+            svg_files.append( input_path )
+
+    # the same file could be given more than once
+    return list( dict.fromkeys( svg_files ) )
+
+
+def _convert_svg_file(
+        in_path_svg : Path,
+        projects_root_directory : str,
+        delta_encode_instructions : bool,
+        overwrite : bool,
+        stage_cache_directory : str | None,
+        streaming : bool
+) -> BatchResult:
+    start = time.perf_counter()
+    try:
+        if streaming:
+            n_instructions = make_motor_instructions_streaming(
+                in_path_svg = str( in_path_svg ),
+                projects_root_directory = projects_root_directory,
+                project_name = in_path_svg.stem,
+                delta_encode_instructions = delta_encode_instructions,
+                overwrite = overwrite,
+            )
+        else:
+            n_instructions = make_motor_instructions(
+                in_path_svg = str( in_path_svg ),
+                projects_root_directory = projects_root_directory,
+                project_name = in_path_svg.stem,
+                delta_encode_instructions = delta_encode_instructions,
+                overwrite = overwrite,
+                open_previews = False,
+                stage_cache = None if stage_cache_directory is None else StageCache( stage_cache_directory ),
+            ).n_points
+    except Exception as e:
+        logging.exception( f"Converting {in_path_svg} failed." )
+        return BatchResult( str( in_path_svg ), in_path_svg.stem, time.perf_counter() - start, error = f"{type( e ).__name__}: {e}" )
+    return BatchResult( str( in_path_svg ), in_path_svg.stem, time.perf_counter() - start, n_instructions = n_instructions )
+
+
+def convert_svg_files(
+        in_paths_svg : list[ Path ],
+        projects_root_directory : str,
+        max_workers : int | None = None,
+        delta_encode_instructions : bool = False,
+        overwrite : bool = False,
+        stage_cache_directory : str | None = None,
+        streaming : bool = False
+) -> list[ BatchResult ]:
+    # Results are in the same order as the inputs, no matter which one finishes first
+    # Two SVGs with the same name would end up in the same project directory, so only the first one is converted
+    results = {}
+    unique_paths = {}
+    for in_path_svg in in_paths_svg:
+        if in_path_svg.stem in unique_paths:
+            results[ in_path_svg ] = BatchResult(
+                str( in_path_svg ), in_path_svg.stem, 0, error = f"Project name is already used by {unique_paths[ in_path_svg.stem ]}."
+            )
+        else:
+            unique_paths[ in_path_svg.stem ] = in_path_svg
+
+    with ProcessPoolExecutor( max_workers = max_workers ) as executor:
+        futures = {
+            in_path_svg : executor.submit(
+                _convert_svg_file, in_path_svg, projects_root_directory, delta_encode_instructions, overwrite, stage_cache_directory, streaming
+            )
+            for in_path_svg in unique_paths.values()
+        }
+        for in_path_svg, future in futures.items():
+            results[ in_path_svg ] = future.result()
+
+    return [ results[ in_path_svg ] for in_path_svg in in_paths_svg ]
+
+
+def _print_summary( results : list[ BatchResult ], total_duration_s : float ) -> None:
+    name_width = max( [ len( 'project' ) ] + [ len( result.project_name ) for result in results ] ) + 2
+    print( "-" * 64 )
+    print( f"{'project':<{name_width}}{'time (s)':>10}{'instructions':>14}  status" )
+    for result in results:
+        n_instructions = '-' if result.n_instructions is None else result.n_instructions
+        status = 'ok' if result.error is None else f'FAILED ({result.error})'
+        print( f"{result.project_name:<{name_width}}{result.duration_s:>10.2f}{n_instructions:>14}  {status}" )
+    n_failed = sum( result.error is not None for result in results )
+    print( "-" * 64 )
+    print( f"Converted {len( results ) - n_failed}/{len( results )} files in {total_duration_s:.2f}s." )
+
+
+def main( argv : list[ str ] | None = None ) -> int:
+    parser = argparse.ArgumentParser( description = "Convert SVGs to motor instructions for the Device." )
+    parser.add_argument( 'inputs', nargs = '*', default = [ str( _DEFAULT_IN_DIRECTORY ) ], help = "SVG files, or directories containing SVG files." )
+    parser.add_argument( '--out', default = str( _DEFAULT_OUT_DIRECTORY ), help = "Directory in which to create a project per SVG." )
+    parser.add_argument( '--workers', type = int, default = os.cpu_count(), help = "Number of SVGs to convert at the same time." )
+    parser.add_argument( '--delta', action = 'store_true', help = "Write delta encoded binary instruction files." )
+    parser.add_argument( '--overwrite', action = 'store_true', help = "Replace existing project directories." )
+    parser.add_argument( '--cache', default = Constants.STAGE_CACHE_DIRECTORY, help = "Directory of the stage cache." )
+    parser.add_argument( '--no-cache', action = 'store_true', help = "Do not use the stage cache." )
+    parser.add_argument( '--streaming', action = 'store_true', help = "Convert in chunks with bounded memory, for very big SVGs. Skips the previews and the cache." )
+    parser.add_argument( '--verbose', action = 'store_true', help = "Log the progress of every conversion step." )
+    args = parser.parse_args( argv )
+
+    logging.basicConfig( level = logging.INFO if args.verbose else logging.WARNING )
+
+    in_paths_svg = _collect_svg_files( args.inputs )
+    if len( in_paths_svg ) == 0:
+        print( "No SVG files found." )
+        return 1
+
+    start = time.perf_counter()
+    stage_cache_directory = None if args.no_cache else args.cache
+    results = convert_svg_files( in_paths_svg, args.out, args.workers, args.delta, args.overwrite, stage_cache_directory, args.streaming )
+    _print_summary( results, time.perf_counter() - start )
+    return 0 if all( result.error is None for result in results ) else 1
+
+
+if __name__ == "__main__" :
+    sys.exit( main() )
@@ -0,0 +1,374 @@
+import argparse
+import json
+import logging
+from pathlib import Path
+import random
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from svgpathtools import Path as SVGPath
+
+from lego_wall_plotter.host.base_types import CanvasArrayPack, CanvasPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.convert_svg import (
+    clean_svg_paths,
+    determine_scale_factor_fit,
+    determine_svg_bounds,
+    get_continuous_paths_from_file,
+    make_canvas_pack_from_svg_paths,
+    sort_paths_by_successive_distance,
+)
+from lego_wall_plotter.host.distance import distance
+from lego_wall_plotter.host.make_motor_instructions import make_motor_instructions_for_canvas_pack
+from lego_wall_plotter.host.make_preview import make_preview_for_motor_instructions, make_preview_for_pack
+from lego_wall_plotter.host.motor_instructions_file import (
+    BINARY_VERSION_DELTA_ENCODED,
+    BINARY_VERSION_FIXED_WIDTH,
+    encode_motor_instructions_binary,
+    read_motor_instructions_file,
+    write_motor_instructions_file,
+)
+from lego_wall_plotter.host.sample_svg_paths import get_path_points, sample_path, sample_path_adaptively
+
+
+"""
+Benchmarks to check whether changes actually make the conversion faster.
+
+The stage benchmarks run the conversion one stage at a time, over the SVGs in a directory,
+and over synthetic inputs that tile every SVG into a grid, to see how the stages scale with the size of a drawing.
+For every stage they record the wall time and the peak memory, as JSON.
+A stored result can be used as the baseline for a later run, to flag the stages that got slower or use more memory.
+
+Example, before and after a change:
+    python -m lego_wall_plotter.host.benchmark stages --out baseline.json
+    python -m lego_wall_plotter.host.benchmark stages --out results.json --baseline baseline.json
+"""
+
+
+# the synthetic inputs tile every SVG into a grid of this many rows and columns
+_STAGE_BENCHMARK_TILINGS = ( 3, )
+
+# a stage is a regression when it takes this fraction more time or memory than the baseline,
+# ignoring stages that are too fast to measure reliably
+_REGRESSION_TOLERANCE = 0.25
+_REGRESSION_MIN_WALL_TIME_S = 0.05
+
+
+def _sort_paths_by_successive_distance_reference( paths : CanvasPack ) -> CanvasPack:
+    # The original greedy ordering, which sorts all remaining paths on every step
+    # We keep it around to verify that the fast ordering gives the exact same result
+    paths = list( paths )
+    result_sorted = [ paths.pop() ]
+    while len( paths ) > 0 :
+        last_point_added = result_sorted[ -1 ][ -1 ]
+        closest_path = sorted( paths, key = lambda p : distance( last_point_added, p[ 0 ] ) )[ 0 ]
+        result_sorted.append( closest_path )
+        paths.remove( closest_path )
+    return result_sorted
+
+
+def _make_canvas_pack( in_path_svg : str, flatness_tolerance_mm : float | None = None ) -> CanvasArrayPack:
+    paths = get_continuous_paths_from_file( in_path_svg )
+    bounds = determine_svg_bounds( paths )
+    scale_factor_fit = determine_scale_factor_fit( bounds )
+    scaled_flatness_tolerance = None if flatness_tolerance_mm is None else flatness_tolerance_mm / scale_factor_fit
+    paths_point_based = clean_svg_paths( paths, Constants.SAMPLING_DISTANCE / scale_factor_fit, scaled_flatness_tolerance )
+    return make_canvas_pack_from_svg_paths( paths_point_based, bounds, scale_factor_fit )
+
+
+def _make_random_canvas_pack( n_paths : int, seed : int = 0 ) -> CanvasArrayPack:
+    # lots of small two-point paths scattered over the canvas
+    rng = random.Random( seed )
+    canvas_pack = []
+    for _ in range( n_paths ):
+        x = rng.uniform( 10, Constants.CANVAS_SIZE_MM[ 0 ] - 10 )
+        y = rng.uniform( 10, Constants.CANVAS_SIZE_MM[ 1 ] - 10 )
+        canvas_pack.append( [ ( x, y ), ( x + rng.uniform( -5, 5 ), y + rng.uniform( -5, 5 ) ) ] )
+    return CanvasArrayPack.from_path_arrays( canvas_pack )
+
+
+def _time( function, *args ) -> tuple[ float, object ]:
+    start = time.perf_counter()
+    result = function( *args )
+    return time.perf_counter() - start, result
+
+
+def benchmark_sort_paths( in_directory : str, n_random_paths : int = 10000 ) -> None:
+    canvas_packs = {}
+    for in_path_svg in sorted( Path( in_directory ).glob( '*.svg' ) ):
+        canvas_packs[ in_path_svg.name ] = _make_canvas_pack( str( in_path_svg ) )
+    canvas_packs[ f'random_{n_random_paths}' ] = _make_random_canvas_pack( n_random_paths )
+
+    logging.info( "-" * 64 )
+    logging.info( f"{'input':<24}{'paths':>8}{'reference (s)':>16}{'indexed (s)':>14}{'speedup':>10}" )
+    for name, canvas_pack in canvas_packs.items():
+        reference_time, reference_result = _time( _sort_paths_by_successive_distance_reference, canvas_pack.to_paths() )
+        indexed_time, indexed_result = _time( sort_paths_by_successive_distance, canvas_pack )
+        assert np.array_equal( CanvasArrayPack.from_paths( reference_result ).coordinates, indexed_result.coordinates )
+        logging.info(
+            f"{name:<24}{len( canvas_pack ):>8}{reference_time:>16.3f}{indexed_time:>14.3f}"
+            f"{reference_time / max( indexed_time, 1e-9 ):>9.1f}x"
+        )
+    logging.info( "-" * 64 )
+
+
+def _get_max_sampling_deviation( path : SVGPath, points : np.ndarray ) -> float:
+    # The largest distance between the (densely evaluated) path and the polyline through the sampled points
+    if len( points ) < 2:
+        return 0.0
+    dense_points = get_path_points( path, np.linspace( 0, 1, 20 * len( path ) + 100 ) )
+    starts = points[ : -1 ]
+    moves = points[ 1 : ] - starts
+    max_deviation = 0.0
+    # in chunks, to keep the distance matrices small for long paths
+    for chunk_start in range( 0, len( dense_points ), 1024 ):
+        offsets = dense_points[ chunk_start : chunk_start + 1024, None ] - starts
+        t = np.clip( ( offsets * np.conj( moves ) ).real / np.maximum( np.abs( moves ) ** 2, 1e-30 ), 0, 1 )
+        max_deviation = max( max_deviation, float( np.abs( offsets - t * moves ).min( axis = 1 ).max() ) )
+    return max_deviation
+
+
+def report_adaptive_sampling( in_directory : str, flatness_tolerances_mm : tuple[ float, ... ] = ( 0.25, 0.5, 1.0, 2.0 ) ) -> None:
+    # Compares the number of instructions of fixed distance sampling to adaptive sampling,
+    # for a couple of flatness tolerances, together with the largest deviation from the SVG in canvas millimeters
+    logging.info( "-" * 64 )
+    logging.info(
+        f"{'input':<16}{'fixed':>16}"
+        + "".join( f"{f'{tolerance} mm':>24}" for tolerance in flatness_tolerances_mm )
+    )
+    for in_path_svg in sorted( Path( in_directory ).glob( '*.svg' ) ):
+        paths = get_continuous_paths_from_file( str( in_path_svg ) )
+        scale_factor_fit = determine_scale_factor_fit( determine_svg_bounds( paths ) )
+
+        def _count_and_deviation( sample ) -> tuple[ int, float ]:
+            sampled_paths = [ ( path, sample( path ) ) for path in paths ]
+            n_points = sum( len( points ) for _, points in sampled_paths )
+            deviation = max( _get_max_sampling_deviation( path, points ) for path, points in sampled_paths )
+            return n_points, deviation * scale_factor_fit
+
+        n_fixed, deviation_fixed = _count_and_deviation(
+            lambda path : sample_path( path, Constants.SAMPLING_DISTANCE / scale_factor_fit )
+        )
+        line = f"{in_path_svg.name:<16}{n_fixed:>8} ({deviation_fixed:.2f})"
+        for tolerance in flatness_tolerances_mm:
+            n_adaptive, deviation_adaptive = _count_and_deviation(
+                lambda path : sample_path_adaptively( path, tolerance / scale_factor_fit )
+            )
+            # adaptive sampling guarantees its tolerance, up to rounding
+            assert deviation_adaptive <= tolerance * ( 1 + 1e-6 ), f"{in_path_svg.name} deviates {deviation_adaptive} mm at a tolerance of {tolerance} mm"
+            line += f"{n_adaptive:>8} {n_adaptive / n_fixed - 1:>+5.0%} ({deviation_adaptive:.2f})"
+        logging.info( line )
+    logging.info( "-" * 64 )
+
+
+def report_compression_ratios( projects_root_directory : str ) -> None:
+    # Compares the size of the motor instructions of every project in every format
+    logging.info( "-" * 64 )
+    logging.info( f"{'project':<24}{'text':>10}{'fixed':>10}{'delta':>10}{'text/delta':>12}{'fixed/delta':>12}" )
+    for instructions_path in sorted( Path( projects_root_directory ).glob( '*/motor_instructions.txt' ) ):
+        instructions_pack = read_motor_instructions_file( str( instructions_path ) )
+        text_size = instructions_path.stat().st_size
+        fixed_width_size = len( encode_motor_instructions_binary( instructions_pack, version = BINARY_VERSION_FIXED_WIDTH ) )
+        delta_size = len( encode_motor_instructions_binary( instructions_pack, version = BINARY_VERSION_DELTA_ENCODED ) )
+        logging.info(
+            f"{instructions_path.parent.name:<24}{text_size:>10}{fixed_width_size:>10}{delta_size:>10}"
+            f"{text_size / delta_size:>11.1f}x{fixed_width_size / delta_size:>11.1f}x"
+        )
+    logging.info( "-" * 64 )
+
+
+def _make_tiled_svg_file( in_path_svg : str, n_tiles : int, out_path_svg : str ) -> None:
+    # A synthetic, bigger input: the paths of the SVG repeated on a grid of n_tiles by n_tiles,
+    # which has n_tiles squared times as many paths, each drawn smaller, since the whole grid is scaled to fit the canvas
+    paths = get_continuous_paths_from_file( in_path_svg )
+    bounds = determine_svg_bounds( paths )
+    with open( out_path_svg, 'w' ) as f:
+        f.write( '<svg xmlns="http://www.w3.org/2000/svg" version="1.1">\n' )
+        for row in range( n_tiles ):
+            for column in range( n_tiles ):
+                offset = complex( column * ( bounds.max_x - bounds.min_x ), row * ( bounds.max_y - bounds.min_y ) )
+                for path in paths:
+                    f.write( f'<path d="{path.translated( offset ).d()}"/>\n' )
+        f.write( '</svg>\n' )
+
+
+def _measure( function, *args, measure_memory : bool = True ) -> tuple[ object, dict[ str, float ] ]:
+    # The wall time is measured without tracing memory, since tracing slows everything down
+    # The peak memory is then measured in a second run, which traces every allocation of Python and NumPy
+    wall_time_s, result = _time( function, *args )
+    measurement = { 'wall_time_s' : wall_time_s }
+    if measure_memory:
+        tracemalloc.start()
+        function( *args )
+        measurement[ 'peak_memory_mb' ] = tracemalloc.get_traced_memory()[ 1 ] / 2 ** 20
+        tracemalloc.stop()
+    return result, measurement
+
+
+def benchmark_stages_for_svg_file( in_path_svg : str, measure_memory : bool = True ) -> dict:
+    # Runs the conversion one stage at a time, with the output of every stage as the input for the next
+    stages = {}
+    with tempfile.TemporaryDirectory() as out_directory:
+        paths, stages[ 'get_continuous_paths_from_file' ] = _measure(
+            get_continuous_paths_from_file, in_path_svg, measure_memory = measure_memory
+        )
+
+        # determining the scale factor is not a stage of its own
+        bounds = determine_svg_bounds( paths )
+        scale_factor_fit = determine_scale_factor_fit( bounds )
+        scaled_flatness_tolerance = None
+        if Constants.SAMPLING_FLATNESS_TOLERANCE_MM is not None:
+            scaled_flatness_tolerance = Constants.SAMPLING_FLATNESS_TOLERANCE_MM / scale_factor_fit
+        paths_point_based, stages[ 'clean_svg_paths' ] = _measure(
+            clean_svg_paths, paths, Constants.SAMPLING_DISTANCE / scale_factor_fit, scaled_flatness_tolerance,
+            measure_memory = measure_memory
+        )
+        canvas_pack = make_canvas_pack_from_svg_paths( paths_point_based, bounds, scale_factor_fit )
+
+        canvas_pack_sorted, stages[ 'sort_paths_by_successive_distance' ] = _measure(
+            sort_paths_by_successive_distance, canvas_pack, measure_memory = measure_memory
+        )
+        motor_instructions_pack, stages[ 'make_motor_instructions_for_canvas_pack' ] = _measure(
+            make_motor_instructions_for_canvas_pack, canvas_pack_sorted, measure_memory = measure_memory
+        )
+
+        out_path_motor_instructions = f'{out_directory}/motor_instructions.txt'
+        _, stages[ 'write_motor_instructions_file' ] = _measure(
+            write_motor_instructions_file, motor_instructions_pack, out_path_motor_instructions, measure_memory = measure_memory
+        )
+        _, stages[ 'make_preview_for_pack' ] = _measure(
+            make_preview_for_pack, canvas_pack_sorted, f'{out_directory}/point_based.svg', False, measure_memory = measure_memory
+        )
+        _, stages[ 'make_preview_for_motor_instructions' ] = _measure(
+            make_preview_for_motor_instructions, out_path_motor_instructions, f'{out_directory}/mock_preview.svg', False,
+            measure_memory = measure_memory
+        )
+
+    return {
+        'n_svg_paths' : len( paths ),
+        'n_paths' : len( canvas_pack ),
+        'n_instructions' : motor_instructions_pack.n_points,
+        'stages' : stages,
+    }
+
+
+def benchmark_stages(
+        in_directory : str,
+        tilings : tuple[ int, ... ] = _STAGE_BENCHMARK_TILINGS,
+        measure_memory : bool = True
+) -> dict:
+    # Returns the results of benchmark_stages_for_svg_file for every SVG in the directory, and for every tiling of it
+    results = {}
+    with tempfile.TemporaryDirectory() as synthetic_directory:
+        for in_path_svg in sorted( Path( in_directory ).glob( '*.svg' ) ):
+            inputs = { in_path_svg.name : str( in_path_svg ) }
+            for n_tiles in tilings:
+                synthetic_path_svg = f'{synthetic_directory}/{in_path_svg.stem}_tiled_{n_tiles}x{n_tiles}.svg'
+                _make_tiled_svg_file( str( in_path_svg ), n_tiles, synthetic_path_svg )
+                inputs[ Path( synthetic_path_svg ).name ] = synthetic_path_svg
+
+            for name, path_svg in inputs.items():
+                results[ name ] = benchmark_stages_for_svg_file( path_svg, measure_memory )
+    return { 'constants' : _get_benchmark_constants(), 'inputs' : results }
+
+
+def _get_benchmark_constants() -> dict:
+    # the constants that change the work the stages do, results are only comparable when these are the same
+    return {
+        'SAMPLING_DISTANCE' : Constants.SAMPLING_DISTANCE,
+        'SAMPLING_FLATNESS_TOLERANCE_MM' : Constants.SAMPLING_FLATNESS_TOLERANCE_MM,
+        'CANVAS_SIZE_MM' : list( Constants.CANVAS_SIZE_MM ),
+        'CANVAS_PADDING_MM' : Constants.CANVAS_PADDING_MM,
+    }
+
+
+def log_stage_benchmarks( results : dict ) -> None:
+    logging.info( "-" * 64 )
+    logging.info( f"{'input':<32}{'stage':<42}{'time (s)':>10}{'memory (MB)':>13}" )
+    for name, result in results[ 'inputs' ].items():
+        for stage, measurement in result[ 'stages' ].items():
+            peak_memory = f"{measurement[ 'peak_memory_mb' ]:.1f}" if 'peak_memory_mb' in measurement else '-'
+            logging.info( f"{name:<32}{stage:<42}{measurement[ 'wall_time_s' ]:>10.3f}{peak_memory:>13}" )
+        logging.info( f"{name:<32}{result[ 'n_paths' ]} paths, {result[ 'n_instructions' ]} instructions" )
+    logging.info( "-" * 64 )
+
+
+def compare_stage_benchmarks(
+        results : dict,
+        baseline : dict,
+        tolerance : float = _REGRESSION_TOLERANCE,
+        min_wall_time_s : float = _REGRESSION_MIN_WALL_TIME_S
+) -> list[ str ]:
+    # Returns a description of every regression of the results compared to the baseline:
+    # stages that take more time or memory than the tolerance allows, and inputs that give a different number of instructions
+    # Inputs and stages that are not in both are skipped
+    if results[ 'constants' ] != baseline[ 'constants' ]:
+        logging.warning( "The results and the baseline were made with different Constants, the comparison may be meaningless." )
+
+    regressions = []
+    for name, result in results[ 'inputs' ].items():
+        baseline_result = baseline[ 'inputs' ].get( name )
+        if baseline_result is None:
+            continue
+        if result[ 'n_instructions' ] != baseline_result[ 'n_instructions' ]:
+            regressions.append( f"{name}: {result[ 'n_instructions' ]} instructions instead of {baseline_result[ 'n_instructions' ]}" )
+
+        for stage, measurement in result[ 'stages' ].items():
+            baseline_measurement = baseline_result[ 'stages' ].get( stage )
+            if baseline_measurement is None:
+                continue
+            wall_time_s, baseline_wall_time_s = measurement[ 'wall_time_s' ], baseline_measurement[ 'wall_time_s' ]
+            if wall_time_s > max( baseline_wall_time_s * ( 1 + tolerance ), min_wall_time_s ):
+                regressions.append( f"{name} {stage}: {wall_time_s:.3f}s instead of {baseline_wall_time_s:.3f}s" )
+            if 'peak_memory_mb' in measurement and 'peak_memory_mb' in baseline_measurement:
+                peak_memory_mb, baseline_peak_memory_mb = measurement[ 'peak_memory_mb' ], baseline_measurement[ 'peak_memory_mb' ]
+                if peak_memory_mb > baseline_peak_memory_mb * ( 1 + tolerance ):
+                    regressions.append( f"{name} {stage}: {peak_memory_mb:.1f}MB instead of {baseline_peak_memory_mb:.1f}MB" )
+
+    for regression in regressions:
+        logging.warning( f"Regression: {regression}" )
+    logging.info( f"Compared to the baseline: {len( regressions )} regressions." )
+    return regressions
+
+
+def main( argv : list[ str ] | None = None ) -> int:
+    repository_root = Path( __file__ ).parents[ 2 ]
+    parser = argparse.ArgumentParser( description = "Benchmarks of the conversion from SVGs to motor instructions." )
+    parser.add_argument( 'mode', nargs = '?', choices = [ 'reports', 'stages' ], default = 'reports',
+                         help = "'reports' compares the ordering, sampling and compression, 'stages' times every conversion stage." )
+    parser.add_argument( '--in', dest = 'in_directory', default = str( repository_root / 'in' ), help = "Directory with the SVGs to benchmark." )
+    parser.add_argument( '--out', help = "JSON file to store the stage benchmarks in, to use as a baseline later." )
+    parser.add_argument( '--baseline', help = "JSON file of earlier stage benchmarks, to flag regressions against." )
+    parser.add_argument( '--tilings', type = int, nargs = '*', default = list( _STAGE_BENCHMARK_TILINGS ),
+                         help = "Also benchmark synthetic inputs, that tile every SVG into a grid of this many rows and columns." )
+    parser.add_argument( '--no-memory', action = 'store_true', help = "Only measure the wall time, which is twice as fast." )
+    args = parser.parse_args( argv )
+
+    logging.basicConfig( level = logging.INFO )
+    if args.mode == 'reports':
+        benchmark_sort_paths( in_directory = args.in_directory )
+        report_adaptive_sampling( in_directory = args.in_directory )
+        report_compression_ratios( projects_root_directory = str( repository_root / 'out' ) )
+        return 0
+
+    # the stages log a lot themselves, which we do not want in between the measurements
+    logging.getLogger().setLevel( logging.WARNING )
+    results = benchmark_stages( args.in_directory, tuple( args.tilings ), not args.no_memory )
+    logging.getLogger().setLevel( logging.INFO )
+
+    log_stage_benchmarks( results )
+    if args.out is not None:
+        with open( args.out, 'w' ) as f:
+            json.dump( results, f, indent = 4 )
+        logging.info( f"Wrote stage benchmarks to {args.out}." )
+    if args.baseline is not None:
+        with open( args.baseline ) as f:
+            baseline = json.load( f )
+        return 1 if compare_stage_benchmarks( results, baseline ) else 0
+    return 0
+
+
+if __name__ == "__main__" :
+    raise SystemExit( main() )
@@ -1,3 +1,6 @@
+from pathlib import Path
+
+
 class Constants :
     # note that sampling distance is not in actual board millimeters,
     # but in the space of the original SVG
@@ -5,6 +8,36 @@ class Constants :
     # so you just have to fiddle with this and make sure the quality check passes well enough later
     SAMPLING_DISTANCE = 5
     QUALITY_THRESHOLD_DISTANCE_VALUE = 2 # this is in actual board/canvas millimeters
+    QUALITY_SINGULARITY_DISTANCE_MM = 50 # points closer than this to the anchors or the edges are reported, see analyze_quality.py
+
+    # Instead of sampling at a fixed distance, curves can be sampled adaptively:
+    # points are only added where the lines between them would deviate more than this from the curve,
+    # so straight-ish curves need far fewer motor instructions.
+    # This is in actual board/canvas millimeters, set it to None to use the fixed SAMPLING_DISTANCE instead
+    # There is little use in going below the accuracy with which the device reaches a point (POINT_REACHED_ERROR_ACCEPTANCE_MM)
+    # Unlike the fixed sampling, the tolerance is a guaranteed bound, so for dense drawings with many small curves
+    # adaptive sampling can need more points than the fixed sampling, which is why it is off by default.
+    # Run benchmark.report_adaptive_sampling to compare both for your SVGs
+    SAMPLING_FLATNESS_TOLERANCE_MM = None
+
+    # After greedily sorting the paths we spend some more time on reducing the pen-up travel
+    PATH_ORDER_OPTIMIZATION_TIME_BUDGET_S = 10
+
+    # After ordering, paths that start within this distance of where the previous path ended are joined,
+    # so the pen does not have to go up and down in between, see merge_paths.py
+    # This is in actual board/canvas millimeters, set it to None to never join paths
+    PATH_MERGE_TOLERANCE_MM = 0.5
+
+    # The SVG previews get very slow and heavy for dense drawings, raster previews are PNGs that are made in seconds
+    # Raster previews also show the travel between paths, while the pen is up, in a separate colour
+    RASTER_PREVIEWS = True
+    PREVIEW_PIXELS_PER_MM = 2
+    PREVIEW_SVG_PRECISION = 2 # the number of decimals of the coordinates in SVG previews
+
+    # Intermediate results are cached on disk, so changing a constant only reruns the stages that depend on it
+    # When the cache grows beyond its maximum size, the least recently used results are removed
+    STAGE_CACHE_DIRECTORY = str( Path.home() / '.cache' / 'lego_wall_plotter' )
+    STAGE_CACHE_MAX_SIZE_MB = 512
 
     # Motor settings for power control
     POWER_MAX_PERCENTAGE = 1.0  # use only XX% of available motor power
@@ -16,6 +49,31 @@ class Constants :
     POINT_REACHED_ERROR_ACCEPTANCE_MM = 1
     POINT_REACHED_ERROR_ACCEPTANCE_DEGREES = POINT_REACHED_ERROR_ACCEPTANCE_MM / abs( MM_PER_DEGREE )
 
+    # Instead of braking at every instruction, the Device can keep moving through the points of a path,
+    # and only brake at the end of the path, and at corners where the path turns more than CORNER_ANGLE_DEGREES
+    # The angle is measured in motor degrees, because that is the space in which the Device moves in straight lines
+    CONTINUOUS_MOTION = True
+    CORNER_ANGLE_DEGREES = 30
+
+    # With continuous motion, the host plans how fast the Device may go at every point of a path
+    # The Device slows down with this deceleration towards every point, to arrive at exactly the planned speed
+    # This has to match the same constant in the device code
+    PLANNED_DECELERATION_DEG_PER_S2 = 4000
+    # The Device never slows down below this while following the planned speeds, otherwise it could stall just outside
+    # the acceptance distance, so it arrives at least this fast, and then brakes if the end speed is 0
+    # This has to match the same constant in the device code as well
+    PLANNED_MIN_DEG_PER_S = 100
+
+    # Used to estimate how long a plot will take, see estimate_plot_duration.py
+    # These are rough measurements, the device does not control acceleration or braking itself
+    MOTOR_ACCELERATION_DEG_PER_S2 = 4000
+    MOTOR_BRAKE_DECELERATION_DEG_PER_S2 = 8000
+    CONTROL_LOOP_PERIOD_S = 0.005 # time of a single iteration of the loop in LegoMotorController.move
+    # The device waits until the pen is down before drawing, but lifting the pen only until it is clear of the paper,
+    # the rest of the lift overlaps with the move to the next path
+    PEN_DOWN_DURATION_S = 0.7
+    PEN_UP_DURATION_S = 0.2
+
     # define our coordinate spaces
     # The board is a panel of wood which our anchors are nailed into
     # The canvas is a piece of paper taped to the board
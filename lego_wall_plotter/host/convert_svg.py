@@ -1,12 +1,18 @@
 from dataclasses import dataclass
 import logging
 import math
+from xml.etree import ElementTree
 
-from svgpathtools import svg2paths, Path
+import numpy as np
+from svgpathtools import svg2paths, parse_path, Path
+from svgpathtools.svg_to_paths import ellipse2pathd, polygon2pathd, polyline2pathd, rect2pathd
 
-from lego_wall_plotter.host.base_types import CanvasPack, CanvasPoint
+from lego_wall_plotter.host.base_types import ArrayPack, CanvasArrayPack, CanvasPack, CanvasPoint
 from lego_wall_plotter.host.constants import Constants
-from lego_wall_plotter.host.distance import distance
+from lego_wall_plotter.host.optimize_path_order import optimize_path_order
+from lego_wall_plotter.host.parallel_conversion import ParallelPathConverter
+from lego_wall_plotter.host.sample_svg_paths import sample_path, sample_path_adaptively
+from lego_wall_plotter.host.spatial_index import NearestPointIndex
 
 
 """
@@ -14,7 +20,8 @@ Functions that help convert arbitrary SVG files to a format we can easily work w
 """
 
 
-SVGPathPack = list[list[tuple[ float, float ]]]
+# every path is an array of shape ( n_points, 2 )
+SVGPathPack = list[ np.ndarray ]
 
 @dataclass
 class Bounds:
@@ -24,7 +31,7 @@ class Bounds:
     max_y : float
 
 
-def _get_continuous_paths_from_file( file ) -> list[ Path ]:
+def get_continuous_paths_from_file( file ) -> list[ Path ]:
 
     # path elements can be discontinuous
     # here we pre-filter them to make every single Path element continuous
@@ -41,38 +48,71 @@ def _get_continuous_paths_from_file( file ) -> list[ Path ]:
     return paths_continuous
 
 
-def _clean_svg_paths( paths : list[ Path ], sampling_distance : float ) -> SVGPathPack:
+# the SVG elements that svg2paths converts to paths, in the order in which it returns them
+_SVG_ELEMENT_TO_PATH_STRING = [
+    ( 'path', lambda attributes : attributes[ 'd' ] ),
+    ( 'polyline', polyline2pathd ),
+    ( 'polygon', lambda attributes : polygon2pathd( attributes, True ) ),
+    ( 'line', lambda attributes : f"M{attributes[ 'x1' ]} {attributes[ 'y1' ]}L{attributes[ 'x2' ]} {attributes[ 'y2' ]}" ),
+    ( 'ellipse', ellipse2pathd ),
+    ( 'circle', ellipse2pathd ),
+    ( 'rect', rect2pathd ),
+]
+
+
+def iter_continuous_paths_from_file( file ):
+    # The same paths as get_continuous_paths_from_file, in the same order,
+    # but parsed one at a time, so the whole SVG never has to be in memory at once.
+    # svg2paths returns all path elements before any other element type,
+    # so path elements are yielded as soon as they are parsed, while the path strings of the other elements are kept
+    # until the file has been read, which is only a single pass.
+    get_path_string_per_tag = dict( _SVG_ELEMENT_TO_PATH_STRING )
+    first_tag = _SVG_ELEMENT_TO_PATH_STRING[ 0 ][ 0 ]
+    path_strings_per_tag = { tag : [] for tag, _ in _SVG_ELEMENT_TO_PATH_STRING[ 1 : ] }
+
+    # Every element is removed from its parent as soon as it has been parsed,
+    # so also the paths inside groups are dropped right away, instead of when the group ends
+    parents = []
+    for event, element in ElementTree.iterparse( file, events = ( 'start', 'end' ) ):
+        if event == 'start':
+            parents.append( element )
+            continue
+        parents.pop()
+        if parents:
+            parents[ -1 ].remove( element )
+
+        tag = element.tag.rsplit( '}', 1 )[ -1 ]
+        if tag not in get_path_string_per_tag:
+            continue
+        path_string = get_path_string_per_tag[ tag ]( dict( element.attrib ) )
+        if tag == first_tag:
+            yield from parse_path( path_string ).continuous_subpaths()
+        else:
+            path_strings_per_tag[ tag ].append( path_string )
+
+    for path_strings in path_strings_per_tag.values():
+        for path_string in path_strings:
+            yield from parse_path( path_string ).continuous_subpaths()
+
+
+def clean_svg_paths( paths : list[ Path ], sampling_distance : float, flatness_tolerance : float | None = None ) -> SVGPathPack:
 
     # SVGs can contain complex things like Arcs and Curves,
     # Here we convert them all to sequences of points
+    # If a flatness tolerance is given, curves are sampled adaptively instead of at every <sampling_distance>
 
     point_based_paths = []
     for index, path in enumerate(paths):
         logging.info( f"Parsing path {index + 1}/{len(paths)}." )
 
-        steps = math.ceil( path.length() / sampling_distance )
-        if steps == 0:
+        if flatness_tolerance is None:
+            points = sample_path( path, sampling_distance )
+        else:
+            points = sample_path_adaptively( path, flatness_tolerance )
+        if len( points ) == 0:
             continue
 
-        last_slope = math.inf
-        path_result = [ ]
-        for p in range(0, steps + 1):
-            coords = path.point(p / steps)
-            x = coords.real
-            y = coords.imag
-
-            should_replace = False
-            if len(path_result) > 0:
-                last_added = path_result[-1]
-                slope = math.atan2(y - last_added[1], x - last_added[0])
-                should_replace = math.isclose(slope, last_slope, rel_tol=1e-3)
-                if should_replace is False:
-                    last_slope = slope
-
-            if should_replace:
-                path_result[-1] = ( x, y )
-            else:
-                path_result.append( ( x, y ) )
+        path_result = np.column_stack( ( points.real, points.imag ) )
 
         logging.info( f"Parsing path {index + 1}/{len( paths )} - DONE. The path has {len(path_result)} points." )
         point_based_paths.append( path_result )
@@ -80,19 +120,21 @@ def _clean_svg_paths( paths : list[ Path ], sampling_distance : float ) -> SVGPa
     return point_based_paths
 
 
-def _determine_svg_bounds( paths : SVGPathPack ) -> Bounds:
-    # determine bounds
+def determine_svg_bounds( paths : list[ Path ] ) -> Bounds:
+    # determine bounds analytically from the extrema of every segment,
+    # paths without length are skipped because they will not be sampled either
     min_x = math.inf
     max_x = -math.inf
     min_y = math.inf
     max_y = -math.inf
     for path in paths:
-        for point in path:
-            x, y = point
-            min_x = min( min_x, x )
-            max_x = max( max_x, x )
-            min_y = min( min_y, y )
-            max_y = max( max_y, y )
+        if path.length() == 0:
+            continue
+        path_min_x, path_max_x, path_min_y, path_max_y = path.bbox()
+        min_x = min( min_x, path_min_x )
+        max_x = max( max_x, path_max_x )
+        min_y = min( min_y, path_min_y )
+        max_y = max( max_y, path_max_y )
 
     return Bounds(
         min_x = min_x,
@@ -102,7 +144,7 @@ def _determine_svg_bounds( paths : SVGPathPack ) -> Bounds:
     )
 
 
-def _determine_scale_factor_fit( svg_bounds : Bounds ) -> float:
+def determine_scale_factor_fit( svg_bounds : Bounds ) -> float:
 
     # determine scale factor to transform the coordinates to *fit* the target space, while retaining aspect ratio
     # Also see: https://stackoverflow.com/questions/14219552/scale-coordinates-while-maintaining-the-aspect-ratio-in-ios
@@ -120,7 +162,7 @@ def _determine_scale_factor_fit( svg_bounds : Bounds ) -> float:
     return scale_factor_fit
 
 
-def _make_canvas_pack_from_svg_paths( paths : SVGPathPack, old_bounds : Bounds, scale_factor_fit : float ) -> CanvasPack:
+def make_canvas_pack_from_svg_paths( paths : SVGPathPack, old_bounds : Bounds, scale_factor_fit : float ) -> CanvasArrayPack:
     logging.info( f"Normalizing paths." )
 
     new_width = ( old_bounds.max_x - old_bounds.min_x ) * scale_factor_fit
@@ -129,54 +171,50 @@ def _make_canvas_pack_from_svg_paths( paths : SVGPathPack, old_bounds : Bounds,
     plot_min_x = ( Constants.CANVAS_SIZE_MM[ 0 ] / 2 ) - ( new_width / 2 )
     plot_min_y = ( Constants.CANVAS_SIZE_MM[ 1 ] / 2 ) - ( new_height / 2 )
 
-    # Apply the transformation to evert point
-    normalized_paths = []
-    for index, path in enumerate( paths ) :
-        logging.info( f"Normalizing path {index + 1}/{len( paths )}" )
-        new_path = []
-        for point in path :
-            new_x = ( ( point[ 0 ] - old_bounds.min_x ) * scale_factor_fit )
-            new_y = ( ( point[ 1 ] - old_bounds.min_y ) * scale_factor_fit )
-
-            # Also to center the coordinates within the target space
-            new_x_centered = plot_min_x + new_x
-            new_y_centered = plot_min_y + new_y
+    # Apply the transformation to every point at once
+    pack = ArrayPack.from_path_arrays( paths )
+    new_coordinates = ( pack.coordinates - ( old_bounds.min_x, old_bounds.min_y ) ) * scale_factor_fit
 
-            new_path.append( CanvasPoint( new_x_centered, new_y_centered ) )
-        normalized_paths.append( new_path )
+    # Also to center the coordinates within the target space
+    new_coordinates_centered = new_coordinates + ( plot_min_x, plot_min_y )
 
+    canvas_pack = CanvasArrayPack( new_coordinates_centered, pack.path_offsets )
     logging.info( f"Normalizing paths - DONE!" )
-    return normalized_paths
+    return canvas_pack
 
 
-def _sort_paths_by_successive_distance( paths : CanvasPack ) -> CanvasPack:
+def sort_paths_by_successive_distance( paths : CanvasPack | CanvasArrayPack ) -> CanvasArrayPack:
     # sort paths by distance between end of path n and start of path n+1
     # the reason to do this is to minimize travel distance,
     # which minimizes time, and room for error
-    # We simply take the last element,
-    # and then greedily add the rest
 
     logging.info( "Sorting paths." )
-    result_sorted = [ paths.pop() ]
-    while len( paths ) > 0 :
-        logging.info( "Sort paths, {} left.".format( len( paths ) ) )
-        last_point_added = result_sorted[ -1 ][ -1 ]
-
-        def distance_to_last( p ) :
-            start_of_path = p[ 0 ]
-            return distance( last_point_added, start_of_path )
+    paths = CanvasArrayPack.from_paths( paths )
+    if len( paths ) == 0:
+        return paths
 
-        closest_path = sorted( paths, key = distance_to_last )[ 0 ]
-
-        result_sorted.append( closest_path )
-        paths.remove( closest_path )
+    order = get_greedy_path_order( paths.path_starts(), paths.path_ends() )
 
     logging.info( "Sorting paths - DONE!" )
-    return result_sorted
+    return paths.reordered( order )
 
 
-def _check_canvas_pack_quality( canvas_pack : CanvasPack ) -> None:
-    last_point = CanvasPoint(
+def get_greedy_path_order( path_starts : np.ndarray, path_ends : np.ndarray ) -> np.ndarray:
+    # We simply take the last element,
+    # and then greedily add the rest
+    # A spatial index on the start points of the remaining paths makes every greedy step O(log n)
+    # Only the endpoints are needed, so the paths themselves do not have to be in memory
+    last_index = len( path_starts ) - 1
+    order = [ last_index ]
+    start_points_index = NearestPointIndex( path_starts[ : last_index ] )
+    while len( start_points_index ) > 0 :
+        last_point_added = path_ends[ order[ -1 ] ]
+        order.append( start_points_index.pop_nearest( *last_point_added ) )
+    return np.array( order )
+
+
+def get_initial_pen_position_in_canvas_space() -> CanvasPoint:
+    return CanvasPoint(
         Constants.INITIAL_POSITION_MEASURE_POINT_RELATIVE_TO_BOARD_X_MM
         + Constants.PEN_POSITION_RELATIVE_TO_MEASURE_POINT_X_MM
         - Constants.CANVAS_OFFSET_TO_BOARD_MM[ 0 ],
@@ -185,28 +223,29 @@ def _check_canvas_pack_quality( canvas_pack : CanvasPack ) -> None:
         - Constants.CANVAS_OFFSET_TO_BOARD_MM[ 1 ],
     )
 
-    logging.info( "-" * 64 )
-    logging.info( "Checking the quality of produced paths" )
-    for i_path, path in enumerate( canvas_pack ):
-        for i_point, point in enumerate( path ):
-            d = distance( point, last_point )
-            if d < Constants.QUALITY_THRESHOLD_DISTANCE_VALUE:
-                logging.info( f"Point {i_point + 1}/{len(path)} in Path {i_path + 1}/{len(canvas_pack)} defines a move of distance {d}")
-            last_point = point
-    logging.info( "Done" )
-    logging.info( "-" * 64 )
-
 
 def convert_svg_file_to_canvas_pack(
         in_path_svg : str,
-        sampling_distance : float
-) -> CanvasPack:
+        sampling_distance : float,
+        flatness_tolerance_mm : float | None = None,
+        optimization_time_budget_s : float = Constants.PATH_ORDER_OPTIMIZATION_TIME_BUDGET_S,
+        max_workers : int = 1
+) -> CanvasArrayPack:
+    canvas_pack = sample_svg_file_to_canvas_pack( in_path_svg, sampling_distance, flatness_tolerance_mm, max_workers )
+    return order_canvas_pack( canvas_pack, optimization_time_budget_s )
+
+
+def sample_svg_file_to_canvas_pack(
+        in_path_svg : str,
+        sampling_distance : float,
+        flatness_tolerance_mm : float | None = None,
+        max_workers : int = 1
+) -> CanvasArrayPack:
 
     # There are two issues that result in a kind of chicken-egg problem:
     # 1) We want to determine a scaling factor to apply to the SVG,
     #    so that the SVG nicely fits the canvas.
-    #    Such a scaling factor is easiest to computer after the SVG is converted to point-based paths,
-    #    because then it is easiest to determine its bounds.
+    #    Such a scaling factor requires us to know the bounds of the SVG.
     # 2) During conversion of the SVG to point-based paths we need to sample complex shapes like Curves.
     #    Ideally we use a sampling-distance that is related to the canvas size.
     #    However, SVGs can be arbitrarily sized, and the perfect sampling distance can only be found,
@@ -217,26 +256,64 @@ def convert_svg_file_to_canvas_pack(
     # and I really think it is the simplest approach to move away from SVG representations and libraries,
     # to point-based paths in canvas space and our own very simple logic, as quickly as possible.
 
-    # We can solve this issue with a two-phased approach:
-    # 1) We will first convert the SVG to point-based paths using a sampling-distance that might be non-optimal.
-    #    After converting the SVG we can very easily determine its bounds,
-    #    which in turn we use to determine the scaling factor.
-    # 2) Using the obtained scaling factor, we can now determine the optimal sampling-distance.
-    #    We then start from scratch again, and convert the SVG to point-based paths again,
-    #    but this time using the optimal sampling distance.
+    # We solve this issue by determining the bounds directly from the parsed SVG:
+    # 1) svgpathtools can compute the exact extrema of every segment,
+    #    so we do not have to convert the SVG to point-based paths to know its bounds.
+    #    These bounds in turn are used to determine the scaling factor.
+    # 2) Using the obtained scaling factor, we can now determine the optimal sampling-distance,
+    #    and convert the SVG to point-based paths only once.
+
+    # With more than one worker, determining the bounds and sampling are spread over a pool of processes,
+    # every path is handled independently, so the result is exactly the same.
+    # Ordering the paths needs all of them at once, so that is a separate step: order_canvas_pack
 
-    temp_paths = _get_continuous_paths_from_file( in_path_svg )
-    temp_paths_point_based = _clean_svg_paths( temp_paths, sampling_distance ) # sampling distance might be non-optimal here
-    temp_bounds = _determine_svg_bounds( temp_paths_point_based )
-    scale_factor_fit = _determine_scale_factor_fit( temp_bounds )
+    paths = get_continuous_paths_from_file( in_path_svg )
+    if max_workers > 1:
+        return _sample_svg_paths_to_canvas_pack_in_parallel( paths, sampling_distance, flatness_tolerance_mm, max_workers )
+
+    bounds = determine_svg_bounds( paths )
+    scale_factor_fit = determine_scale_factor_fit( bounds )
 
     # the scaled sampling distance is basically the SVG-space equivalent,
     # of the sampling-distance as chosen in canvas-space (which is simply in millimeters)
     scaled_sampling_distance = sampling_distance / scale_factor_fit
 
-    paths = _get_continuous_paths_from_file( in_path_svg )
-    paths_point_based = _clean_svg_paths( paths, scaled_sampling_distance )
-    canvas_pack = _make_canvas_pack_from_svg_paths( paths_point_based, temp_bounds, scale_factor_fit )
-    canvas_pack_sorted = _sort_paths_by_successive_distance( canvas_pack )
-    _check_canvas_pack_quality( canvas_pack_sorted )
-    return canvas_pack_sorted
+    # The same goes for the flatness tolerance of adaptive sampling,
+    # which is chosen in canvas-space so it directly relates to the accuracy of the drawing
+    scaled_flatness_tolerance = None if flatness_tolerance_mm is None else flatness_tolerance_mm / scale_factor_fit
+
+    paths_point_based = clean_svg_paths( paths, scaled_sampling_distance, scaled_flatness_tolerance )
+    return make_canvas_pack_from_svg_paths( paths_point_based, bounds, scale_factor_fit )
+
+
+def _sample_svg_paths_to_canvas_pack_in_parallel(
+        paths : list[ Path ],
+        sampling_distance : float,
+        flatness_tolerance_mm : float | None,
+        max_workers : int
+) -> CanvasArrayPack:
+    # the same steps as in sample_svg_file_to_canvas_pack, but spread over <max_workers> processes
+    logging.info( f"Sampling {len( paths )} paths using {max_workers} workers." )
+    with ParallelPathConverter( paths, max_workers ) as converter:
+        bounds = Bounds( *converter.get_bounds() )
+        scale_factor_fit = determine_scale_factor_fit( bounds )
+        scaled_sampling_distance = sampling_distance / scale_factor_fit
+        scaled_flatness_tolerance = None if flatness_tolerance_mm is None else flatness_tolerance_mm / scale_factor_fit
+        paths_point_based = converter.sample( scaled_sampling_distance, scaled_flatness_tolerance )
+    logging.info( f"Sampling {len( paths )} paths using {max_workers} workers - DONE!" )
+
+    return make_canvas_pack_from_svg_paths( paths_point_based, bounds, scale_factor_fit )
+
+
+def order_canvas_pack(
+        canvas_pack : CanvasArrayPack,
+        optimization_time_budget_s : float = Constants.PATH_ORDER_OPTIMIZATION_TIME_BUDGET_S
+) -> CanvasArrayPack:
+    # Order the paths to minimize the travel between them
+    canvas_pack_sorted = sort_paths_by_successive_distance( canvas_pack )
+    canvas_pack_optimized = optimize_path_order(
+        canvas_pack_sorted,
+        get_initial_pen_position_in_canvas_space(),
+        optimization_time_budget_s
+    )
+    return canvas_pack_optimized
@@ -0,0 +1,178 @@
+from dataclasses import asdict, dataclass
+import json
+import logging
+import math
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import MotorInstructionsArrayPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.motor_instructions_file import END_SPEED_MAX
+
+
+"""
+Estimates how long the Device will take to plot a MotorInstructionsPack, without having to run it on the wall.
+We simulate the loop in LegoMotorController.move:
+for every instruction, the motor with the largest error runs at MAX_DEG_PER_S, and the other one proportionally,
+so the pen moves in a straight line in degree space, until it is within POINT_REACHED_ERROR_ACCEPTANCE_DEGREES of the target.
+Then both motors brake, and the next instruction starts from standstill, from wherever the braking left the pen.
+With continuous motion the motors slow down to the end speed of every instruction with the planned deceleration,
+only brake at instructions with an end speed of 0, and otherwise keep their speed going into the next instruction.
+They never slow down below PLANNED_MIN_DEG_PER_S though, so they arrive at least that fast, also before braking.
+Every path also costs two pen moves, the device waits PEN_DOWN_DURATION_S for the pen to go down and PEN_UP_DURATION_S for it to go up.
+
+The motors are modelled with a constant acceleration and braking deceleration,
+which ignores gravity, rope stretch and the changing load on the motors.
+The estimate is therefore best used to compare conversions of the same drawing, rather than as an exact prediction.
+"""
+
+
+@dataclass
+class PlotDurationEstimate:
+    drawing_s : float
+    travel_s : float
+    pen_moves_s : float
+    n_paths : int
+    n_instructions : int
+
+    @property
+    def total_s( self ) -> float:
+        return self.drawing_s + self.travel_s + self.pen_moves_s
+
+
+def _get_move_duration(
+        current_degrees : list[ float ],
+        target_degrees : tuple[ float, float ],
+        start_speed : float,
+        end_speed : float | None,
+        max_deg_per_s : float,
+        acceleration : float,
+        planned_deceleration : float,
+        planned_min_speed : float,
+        brake_deceleration : float,
+        acceptance_degrees : float,
+        loop_period_s : float
+) -> tuple[ float, float ]:
+    # Simulates a single call of LegoMotorController.move, and updates current_degrees in place
+    # Without an end speed the Device goes full speed and brakes at the end,
+    # with an end speed it slows down to it with the planned deceleration, and only brakes if it is 0
+    # Like the Device, we never plan to arrive slower than <planned_min_speed>, so braking starts from at least that speed
+    # Returns the duration, and the speed at which the next move starts
+    # Everything is computed for the leading motor, the other motor simply follows proportionally
+    error_left = target_degrees[ 0 ] - current_degrees[ 0 ]
+    error_right = target_degrees[ 1 ] - current_degrees[ 1 ]
+    error = math.sqrt( error_left ** 2 + error_right ** 2 )
+    brake = not end_speed
+
+    # the loop always runs at least once, to find out the target was already reached
+    if error <= acceptance_degrees:
+        return loop_period_s, 0.0 if brake else start_speed
+
+    # the loop stops as soon as we are within the acceptance distance, not when we reach the target
+    leading_error = max( abs( error_left ), abs( error_right ) )
+    leading_scale = leading_error / error
+    leading_distance = ( error - acceptance_degrees ) * leading_scale
+
+    # accelerate towards the highest speed from which we can still slow down to the end speed in time,
+    # or towards the maximum speed if there is no end speed
+    if end_speed is None:
+        peak_speed = max_deg_per_s
+        speed = min( max_deg_per_s, math.sqrt( start_speed ** 2 + 2 * acceleration * leading_distance ) )
+    else:
+        speed = min( max( end_speed, planned_min_speed ), math.sqrt( start_speed ** 2 + 2 * acceleration * leading_distance ) )
+        peak_speed = math.sqrt(
+            ( 2 * acceleration * planned_deceleration * leading_distance + planned_deceleration * start_speed ** 2 + acceleration * speed ** 2 )
+            / ( acceleration + planned_deceleration )
+        )
+        peak_speed = max( min( peak_speed, max_deg_per_s ), start_speed, speed )
+    acceleration_distance = ( peak_speed ** 2 - start_speed ** 2 ) / ( 2 * acceleration )
+    deceleration_distance = ( peak_speed ** 2 - speed ** 2 ) / ( 2 * planned_deceleration )
+    if end_speed is None and leading_distance <= acceleration_distance:
+        duration = ( speed - start_speed ) / acceleration
+    else:
+        cruise_distance = max( leading_distance - acceleration_distance - deceleration_distance, 0 )
+        duration = ( peak_speed - start_speed ) / acceleration + ( peak_speed - speed ) / planned_deceleration + cruise_distance / peak_speed
+
+    # without braking, the next move simply takes over from where the loop stopped
+    if not brake:
+        current_degrees[ 0 ] += error_left / error * ( error - acceptance_degrees )
+        current_degrees[ 1 ] += error_right / error * ( error - acceptance_degrees )
+        return duration + loop_period_s, speed
+
+    # braking makes us overshoot the point where the loop stopped
+    brake_duration = speed / brake_deceleration
+    brake_distance = speed ** 2 / ( 2 * brake_deceleration )
+    travelled = ( leading_distance + brake_distance ) / leading_scale
+    current_degrees[ 0 ] += error_left / error * travelled
+    current_degrees[ 1 ] += error_right / error * travelled
+
+    return duration + brake_duration + loop_period_s, 0.0
+
+
+def estimate_plot_duration(
+        motor_instructions_pack : MotorInstructionsArrayPack,
+        end_speeds : np.ndarray | None = None
+) -> PlotDurationEstimate:
+    # Without end speeds the Device goes full speed and brakes at every instruction
+    # The constants are bound to locals, since this runs once for every instruction
+    max_deg_per_s = Constants.MAX_DEG_PER_S
+    acceleration = Constants.MOTOR_ACCELERATION_DEG_PER_S2
+    planned_deceleration = Constants.PLANNED_DECELERATION_DEG_PER_S2
+    planned_min_speed = Constants.PLANNED_MIN_DEG_PER_S
+    brake_deceleration = Constants.MOTOR_BRAKE_DECELERATION_DEG_PER_S2
+    acceptance_degrees = Constants.POINT_REACHED_ERROR_ACCEPTANCE_DEGREES
+    loop_period_s = Constants.CONTROL_LOOP_PERIOD_S
+
+    # end speeds in degrees per second
+    if end_speeds is None:
+        end_speeds = [ None ] * motor_instructions_pack.n_points
+    else:
+        end_speeds = ( np.asarray( end_speeds ) * max_deg_per_s / END_SPEED_MAX ).tolist()
+
+    # the motor degrees are relative to where the device started
+    current_degrees = [ 0.0, 0.0 ]
+    drawing_s = 0.0
+    travel_s = 0.0
+    path_offsets = motor_instructions_pack.path_offsets.tolist()
+    for i_path, path in enumerate( motor_instructions_pack.iter_path_coordinates() ):
+        targets = path.tolist()
+        path_end_speeds = end_speeds[ path_offsets[ i_path ] : path_offsets[ i_path + 1 ] ]
+
+        # moving to the first point of a path happens with the pen up, and starts from standstill after the pen went up
+        duration, speed = _get_move_duration(
+            current_degrees, targets[ 0 ], 0.0, path_end_speeds[ 0 ],
+            max_deg_per_s, acceleration, planned_deceleration, planned_min_speed, brake_deceleration, acceptance_degrees, loop_period_s
+        )
+        travel_s += duration
+        for target, end_speed in zip( targets[ 1 : ], path_end_speeds[ 1 : ] ):
+            duration, speed = _get_move_duration(
+                current_degrees, target, speed, end_speed,
+                max_deg_per_s, acceleration, planned_deceleration, planned_min_speed, brake_deceleration, acceptance_degrees, loop_period_s
+            )
+            drawing_s += duration
+
+    # the pen goes down and up once for every path
+    n_paths = len( motor_instructions_pack )
+    return PlotDurationEstimate(
+        drawing_s = drawing_s,
+        travel_s = travel_s,
+        pen_moves_s = n_paths * ( Constants.PEN_DOWN_DURATION_S + Constants.PEN_UP_DURATION_S ),
+        n_paths = n_paths,
+        n_instructions = motor_instructions_pack.n_points,
+    )
+
+
+def write_plot_duration_estimate(
+        motor_instructions_pack : MotorInstructionsArrayPack,
+        path : str,
+        end_speeds : np.ndarray | None = None
+) -> PlotDurationEstimate:
+    logging.info( "Estimating plot duration." )
+    estimate = estimate_plot_duration( motor_instructions_pack, end_speeds )
+    with open( path, 'w' ) as f:
+        json.dump( { **asdict( estimate ), 'total_s' : estimate.total_s }, f, indent = 4 )
+    logging.info(
+        f"Estimating plot duration - DONE! About {estimate.total_s / 60:.1f} minutes: "
+        f"drawing {estimate.drawing_s / 60:.1f}, pen-up travel {estimate.travel_s / 60:.1f}, pen moves {estimate.pen_moves_s / 60:.1f}."
+    )
+    return estimate
@@ -2,11 +2,28 @@ import logging
 from pathlib import Path
 import shutil
 
+from lego_wall_plotter.host.analyze_quality import write_quality_report
+from lego_wall_plotter.host.base_types import ArrayPack, MotorInstructionsArrayPack
 from lego_wall_plotter.host.constants import Constants
-from lego_wall_plotter.host.convert_svg import convert_svg_file_to_canvas_pack
+from lego_wall_plotter.host.convert_svg import (
+    get_initial_pen_position_in_canvas_space,
+    order_canvas_pack,
+    sample_svg_file_to_canvas_pack,
+)
+from lego_wall_plotter.host.estimate_plot_duration import write_plot_duration_estimate
 from lego_wall_plotter.host.make_motor_instructions import make_motor_instructions_for_canvas_pack
 from lego_wall_plotter.host.make_preview import make_preview_for_motor_instructions, make_preview_for_pack
-from lego_wall_plotter.host.motor_instructions_file import write_motor_instructions_file
+from lego_wall_plotter.host.merge_paths import merge_touching_paths
+from lego_wall_plotter.host.motor_instructions_file import (
+    get_binary_version,
+    write_motor_instructions_binary_file,
+    write_motor_instructions_file,
+)
+from lego_wall_plotter.host.plan_motion import get_end_speeds
+from lego_wall_plotter.host.raster_preview import make_raster_preview_for_canvas_pack, make_raster_preview_for_motor_instructions
+from lego_wall_plotter.host.simplify_motor_instructions import simplify_motor_instructions
+from lego_wall_plotter.host.stage_cache import StageCache, get_file_hash, make_stage_key
+from lego_wall_plotter.host.streaming_pipeline import convert_svg_file_to_motor_instructions_files
 
 
 """
@@ -14,56 +31,185 @@ Main entrypoint for converting SVGs to instructions for the Device!
 """
 
 
-def make_motor_instructions(
-        in_path_svg : str,
-        projects_root_directory : str,
-        project_name : str,
-) -> None:
-
+# The Constants every stage depends on, so the stage cache knows when to rerun them
+# A stage is also rerun when any stage before it is
+_SAMPLING_STAGE_CONSTANTS = (
+    'SAMPLING_DISTANCE',
+    'SAMPLING_FLATNESS_TOLERANCE_MM',
+    'CANVAS_SIZE_MM',
+    'CANVAS_PADDING_MM',
+)
+_ORDERING_STAGE_CONSTANTS = (
+    'PATH_ORDER_OPTIMIZATION_TIME_BUDGET_S',
+)
+_MERGING_STAGE_CONSTANTS = (
+    'PATH_MERGE_TOLERANCE_MM',
+)
+_KINEMATICS_STAGE_CONSTANTS = (
+    'BOARD_SIZE_MM',
+    'LEFT_ANCHOR_OFFSET_TO_BOARD_MM',
+    'RIGHT_ANCHOR_OFFSET_TO_BOARD_MM',
+    'CANVAS_OFFSET_TO_BOARD_MM',
+    'MM_PER_DEGREE',
+    'INITIAL_POSITION_MEASURE_POINT_RELATIVE_TO_BOARD_X_MM',
+    'INITIAL_POSITION_MEASURE_POINT_RELATIVE_TO_BOARD_Y_MM',
+    'PEN_POSITION_RELATIVE_TO_MEASURE_POINT_X_MM',
+    'PEN_POSITION_RELATIVE_TO_MEASURE_POINT_Y_MM',
+    'QUALITY_THRESHOLD_DISTANCE_VALUE',
+)
+
+
+def _run_stage( stage_cache : StageCache | None, key : str, stage_name : str, compute ) -> ArrayPack:
+    if stage_cache is None:
+        return compute()
+    return stage_cache.get_or_compute( key, stage_name, compute )
+
+
+def _make_project_directory( in_path_svg : str, projects_root_directory : str, project_name : str, overwrite : bool ) -> Path:
     # make sure we have a project directory and that it is empty
+    # unless we are asked to overwrite, then we simply start over with an empty one
     project_directory = Path(f'{projects_root_directory}/{project_name}' )
-    project_directory.mkdir(exist_ok = True)
-    assert not any(project_directory.iterdir())
+    if overwrite and project_directory.exists():
+        shutil.rmtree( project_directory )
+    project_directory.mkdir( parents = True, exist_ok = True )
+    assert not any(project_directory.iterdir()), f"Project directory {project_directory} is not empty."
 
     # copy the original svg for future reference
     shutil.copy( in_path_svg, project_directory )
+    return project_directory
+
+
+def make_motor_instructions(
+        in_path_svg : str,
+        projects_root_directory : str,
+        project_name : str,
+        delta_encode_instructions : bool = False,
+        max_workers : int = 1,
+        overwrite : bool = False,
+        open_previews : bool = True,
+        stage_cache : StageCache | None = None,
+) -> MotorInstructionsArrayPack:
+
+    project_directory = _make_project_directory( in_path_svg, projects_root_directory, project_name, overwrite )
 
     # make all output file paths
     out_path_scaled_svg = f'{project_directory}/scaled_svg.svg'
-    out_path_preview_point_based_svg = f'{project_directory}/point_based.svg'
+    preview_extension = 'png' if Constants.RASTER_PREVIEWS else 'svg'
+    out_path_preview_point_based = f'{project_directory}/point_based.{preview_extension}'
     out_path_motor_instructions = f'{project_directory}/motor_instructions.txt'
-    out_path_mock_preview = f'{project_directory}/mock_preview.svg'
+    out_path_motor_instructions_binary = f'{project_directory}/motor_instructions.bin'
+    out_path_mock_preview = f'{project_directory}/mock_preview.{preview_extension}'
+    out_path_plot_duration_estimate = f'{project_directory}/plot_duration_estimate.json'
+    out_path_quality_report = f'{project_directory}/quality_report.json'
 
     # Take the SVG and convert it to our own format: CanvasPack
-    canvas_pack = convert_svg_file_to_canvas_pack( in_path_svg, Constants.SAMPLING_DISTANCE )
+    # Every stage can be loaded from the stage cache, if nothing it depends on changed since last time
+    sampling_key = make_stage_key( 'sampling', get_file_hash( in_path_svg ), _SAMPLING_STAGE_CONSTANTS )
+    sampled_canvas_pack = _run_stage( stage_cache, sampling_key, "sampled paths", lambda : sample_svg_file_to_canvas_pack(
+        in_path_svg,
+        Constants.SAMPLING_DISTANCE,
+        Constants.SAMPLING_FLATNESS_TOLERANCE_MM,
+        max_workers = max_workers
+    ) )
+
+    # The order also depends on where the pen starts in canvas space
+    initial_pen_position = get_initial_pen_position_in_canvas_space()
+    ordering_key = make_stage_key(
+        'ordering', sampling_key, _ORDERING_STAGE_CONSTANTS, ( initial_pen_position.x, initial_pen_position.y )
+    )
+    ordered_canvas_pack = _run_stage( stage_cache, ordering_key, "ordered paths", lambda : order_canvas_pack(
+        sampled_canvas_pack, Constants.PATH_ORDER_OPTIMIZATION_TIME_BUDGET_S
+    ) )
+
+    # Join the paths that touch, every path less is one less time the pen has to go up and down
+    merging_key = make_stage_key( 'merging', ordering_key, _MERGING_STAGE_CONSTANTS )
+    canvas_pack = _run_stage( stage_cache, merging_key, "merged paths", lambda : merge_touching_paths(
+        ordered_canvas_pack, Constants.PATH_MERGE_TOLERANCE_MM
+    ) )
+
+    # Check the quality of the paths, before the Device has to draw them
+    write_quality_report( canvas_pack, out_path_quality_report )
 
     # Create a preview of the converted SVG
     # ( This should be a piecewise linear approximation of the original )
-    make_preview_for_pack( canvas_pack, out_path_preview_point_based_svg )
+    if Constants.RASTER_PREVIEWS:
+        make_raster_preview_for_canvas_pack( canvas_pack, out_path_preview_point_based, open_previews )
+    else:
+        make_preview_for_pack( canvas_pack, out_path_preview_point_based, open_previews )
 
     # Convert the PlotPack to a MotorInstructionsPack
-    motor_instructions_pack = make_motor_instructions_for_canvas_pack( canvas_pack )
+    # Then drop the instructions that do not visibly change the drawing,
+    # every instruction less is one less time the Device has to brake and accelerate
+    kinematics_key = make_stage_key( 'kinematics', merging_key, _KINEMATICS_STAGE_CONSTANTS )
+    motor_instructions_pack = _run_stage( stage_cache, kinematics_key, "motor instructions", lambda : simplify_motor_instructions(
+        make_motor_instructions_for_canvas_pack( canvas_pack, max_workers ),
+        Constants.QUALITY_THRESHOLD_DISTANCE_VALUE
+    ) )
+
+    # Tell the Device where it can keep moving instead of braking
+    end_speeds = get_end_speeds( motor_instructions_pack ) if Constants.CONTINUOUS_MOTION else None
 
     # Write the MotorInstructionsTuplePack to a file for easy copying and archiving reasons
-    write_motor_instructions_file( motor_instructions_pack, out_path_motor_instructions )
+    # The compact binary file is what the Device prefers, the text file is kept as a fallback
+    # Delta encoding makes the binary file even smaller, so bigger drawings fit on the Device
+    write_motor_instructions_file( motor_instructions_pack, out_path_motor_instructions, end_speeds )
+    write_motor_instructions_binary_file(
+        motor_instructions_pack,
+        out_path_motor_instructions_binary,
+        version = get_binary_version( delta_encode_instructions, end_speeds is not None ),
+        end_speeds = end_speeds
+    )
+
+    # Predict how long the Device will take, so conversions can be compared by plot time rather than by number of points
+    write_plot_duration_estimate( motor_instructions_pack, out_path_plot_duration_estimate, end_speeds )
 
     # Create a preview of what the MotorInstructionsPack should produce
     # ( should be an approximation of the previous preview, but with some error from rounding and motor limitations )
-    make_preview_for_motor_instructions( out_path_motor_instructions, out_path_mock_preview )
+    if Constants.RASTER_PREVIEWS:
+        make_raster_preview_for_motor_instructions( out_path_motor_instructions_binary, out_path_mock_preview, open_previews )
+    else:
+        make_preview_for_motor_instructions( out_path_motor_instructions_binary, out_path_mock_preview, open_previews )
 
     logging.info( "Done!" )
     # You should now manually copy the content of <out_file_motor_instructions_pack>
     # and paste it inside the device code in the MINDSTORMS app.
     # Then move the device code onto the device,
     # and finally let your device execute the instructions!
+    return motor_instructions_pack
+
+
+def make_motor_instructions_streaming(
+        in_path_svg : str,
+        projects_root_directory : str,
+        project_name : str,
+        delta_encode_instructions : bool = False,
+        overwrite : bool = False,
+) -> int:
+    # The same as make_motor_instructions, for SVGs too big to convert in memory
+    # Only the motor instruction files are written, and nothing is cached
+    # Returns the number of motor instructions
+    project_directory = _make_project_directory( in_path_svg, projects_root_directory, project_name, overwrite )
+    n_instructions = convert_svg_file_to_motor_instructions_files(
+        in_path_svg,
+        f'{project_directory}/motor_instructions.txt',
+        f'{project_directory}/motor_instructions.bin',
+        Constants.SAMPLING_DISTANCE,
+        Constants.SAMPLING_FLATNESS_TOLERANCE_MM,
+        delta_encode_instructions = delta_encode_instructions
+    )
+    logging.info( "Done!" )
+    return n_instructions
 
 
 if __name__ == "__main__" :
+    # converts a single example, see batch.py for converting any number of SVGs from the command line
     logging.basicConfig( level = logging.INFO )
-    projects_root_directory = f'../../out/'
+    repository_root = Path( __file__ ).parents[ 2 ]
     name = "nature"
     make_motor_instructions(
-        in_path_svg =  f'../../in/{name}.svg',
-        projects_root_directory = projects_root_directory,
-        project_name = f"{name}"
+        in_path_svg = str( repository_root / 'in' / f'{name}.svg' ),
+        projects_root_directory = str( repository_root / 'out' ),
+        project_name = name,
+        overwrite = True,
+        stage_cache = StageCache( Constants.STAGE_CACHE_DIRECTORY )
     )
@@ -1,14 +1,21 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
 from lego_wall_plotter.host.base_types import (
-    MotorInstructionsPack,
+    MotorInstructionsArrayPack,
     MotorInstruction,
     MotorDegrees,
+    BoardArrayPack,
     BoardPoint,
+    CanvasArrayPack,
     CanvasPack,
     CanvasPoint,
     RopeLengths,
 )
 from lego_wall_plotter.host.constants import Constants
 from lego_wall_plotter.host.distance import distance
+from lego_wall_plotter.host.parallel_conversion import split_into_path_chunks
 
 
 """
@@ -53,6 +60,17 @@ def convert_canvas_point_to_board_point( point_in_canvas_space : CanvasPoint ) -
     )
 
 
+def get_rope_lengths_for_board_coordinates( coordinates : np.ndarray ) -> np.ndarray:
+    # vectorized version of get_rope_lengths_for_point, for an array of shape ( n, 2 )
+    # returns an array of shape ( n, 2 ) with the left and right rope length of every point
+    left_deltas = np.subtract( Constants.LEFT_ANCHOR_OFFSET_TO_BOARD_MM, coordinates )
+    right_deltas = np.subtract( Constants.RIGHT_ANCHOR_OFFSET_TO_BOARD_MM, coordinates )
+    return np.column_stack( (
+        np.sqrt( left_deltas[ :, 0 ] ** 2 + left_deltas[ :, 1 ] ** 2 ),
+        np.sqrt( right_deltas[ :, 0 ] ** 2 + right_deltas[ :, 1 ] ** 2 ),
+    ) )
+
+
 def get_motor_instruction_for_rope_lengths( rope_lengths : RopeLengths, initial_degrees : MotorDegrees ) -> MotorInstruction:
     return MotorInstruction(
         ( rope_lengths[ 0 ] / Constants.MM_PER_DEGREE ) - initial_degrees[ 0 ],
@@ -60,20 +78,28 @@ def get_motor_instruction_for_rope_lengths( rope_lengths : RopeLengths, initial_
     )
 
 
-def make_motor_instructions_for_canvas_pack( canvas_pack : CanvasPack ) -> MotorInstructionsPack:
-    initial_degrees = get_initial_degrees()
-    motor_instructions_pack = [ ]
-    for canvas_path in canvas_pack:
-        motor_instructions_path = [ ]
-        for canvas_point in canvas_path:
+def _get_target_degrees_for_board_coordinates( board_coordinates : np.ndarray ) -> np.ndarray:
+    target_rope_lengths = get_rope_lengths_for_board_coordinates( board_coordinates )
+    return ( target_rope_lengths / Constants.MM_PER_DEGREE ) - get_initial_degrees()
+
 
-            # compute motor instructions
-            target_position = convert_canvas_point_to_board_point( canvas_point )
-            target_rope_lengths = get_rope_lengths_for_point( target_position )
-            motor_instruction = get_motor_instruction_for_rope_lengths( target_rope_lengths, initial_degrees )
+def make_motor_instructions_for_canvas_pack(
+        canvas_pack : CanvasPack | CanvasArrayPack,
+        max_workers : int = 1
+) -> MotorInstructionsArrayPack:
+    # All points of all paths are converted at once,
+    # using the exact same steps as the functions for single points above
+    # With more than one worker, chunks of whole paths are converted on a pool of processes.
+    # This is already vectorized, so that only pays off for very large packs.
+    canvas_pack = CanvasArrayPack.from_paths( canvas_pack )
 
-            # update result
-            motor_instructions_path.append( motor_instruction )
+    # compute motor instructions
+    board_pack = BoardArrayPack( np.add( Constants.CANVAS_OFFSET_TO_BOARD_MM, canvas_pack.coordinates ), canvas_pack.path_offsets )
+    if max_workers > 1:
+        chunks = np.split( board_pack.coordinates, split_into_path_chunks( board_pack.path_offsets, max_workers ) )
+        with ProcessPoolExecutor( max_workers = max_workers ) as executor:
+            target_degrees = np.concatenate( list( executor.map( _get_target_degrees_for_board_coordinates, chunks ) ) )
+    else:
+        target_degrees = _get_target_degrees_for_board_coordinates( board_pack.coordinates )
 
-        motor_instructions_pack.append( motor_instructions_path )
-    return motor_instructions_pack
+    return MotorInstructionsArrayPack( target_degrees, canvas_pack.path_offsets )
@@ -1,20 +1,46 @@
+import itertools
 import logging
-from os import getcwd
+from pathlib import Path
+import webbrowser
 
-from svgpathtools import Path, Line, disvg
+import numpy as np
 
 from lego_wall_plotter.host.constants import Constants
-from lego_wall_plotter.host.base_types import BoardPack, BoardPoint
-from lego_wall_plotter.host.mock_plotter import make_plot_pack_for_motor_instructions_file
+from lego_wall_plotter.host.base_types import ArrayPack, BoardArrayPack, BoardPack, BoardPoint, MotorInstructionsArrayPack
+from lego_wall_plotter.host.mock_plotter import make_plot_pack_for_motor_instructions_pack
+from lego_wall_plotter.host.motor_instructions_file import (
+    BinaryMotorInstructionsFile,
+    is_binary_motor_instructions_file,
+    read_motor_instructions_file,
+)
 
 
 """
 Functions for previewing our PlotPacks and MotorInstructionsPack results.
 Useful to make sure you do not let the Device draw something you do not like, 
 by checking the previews beforehand. 
+
+Every path is written as a single <polyline> with a fixed number of decimals, one path at a time,
+so a preview never needs more than a single path in memory, and can be written from a generator of paths.
+The viewBox can only be known after all paths are written,
+so a blank space is reserved for it in the header, which is filled in at the end.
 """
 
 
+# the number of points to convert from motor instructions to board space at once
+_PREVIEW_CHUNK_SIZE_POINTS = 1 << 16
+
+# room for the viewBox, which is filled in once all paths are written
+_VIEW_BOX_PLACEHOLDER = ' ' * 96
+
+_SVG_HEADER = (
+    '<?xml version="1.0" encoding="utf-8" ?>\n'
+    '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" viewBox="{view_box}">\n'
+    '<g fill="none" stroke="#000000" stroke-width="{stroke_width}">\n'
+)
+_SVG_FOOTER = '</g>\n</svg>\n'
+
+
 def _get_board() -> BoardPack:
     board_paths = [[
         BoardPoint( 0, 0 ),
@@ -75,28 +101,91 @@ def _get_canvas() -> BoardPack:
     return canvas_paths
 
 
-def make_preview_for_pack( pack, out_filename : str ) -> None:
+def _iter_path_arrays( paths ):
+    # an ArrayPack, a list-of-points pack, or any iterable of arrays of shape ( n, 2 ), like a generator
+    if isinstance( paths, ArrayPack ):
+        yield from paths.iter_path_coordinates()
+        return
+    for path in paths:
+        if isinstance( path, np.ndarray ):
+            yield path
+        else:
+            yield ArrayPack.from_paths( [ path ] ).coordinates
+
+
+def write_svg_preview(
+        paths,
+        out_filename : str,
+        open_in_browser : bool = True,
+        precision : int = Constants.PREVIEW_SVG_PRECISION
+) -> None:
+    # paths can be any pack, or any iterable of arrays of shape ( n, 2 ), see _iter_path_arrays
+    minimum = np.full( 2, np.inf )
+    maximum = np.full( 2, -np.inf )
+    point_format = f'%.{precision}f,%.{precision}f'
+    stroke_width = f'{0.5:.{precision}f}'
+
+    with open( out_filename, 'w' ) as f:
+        header_before_view_box, header_after_view_box = _SVG_HEADER.format( view_box = '{view_box}', stroke_width = stroke_width ).split( '{view_box}' )
+        f.write( header_before_view_box )
+        view_box_position = f.tell()
+        f.write( _VIEW_BOX_PLACEHOLDER + header_after_view_box )
+        for path_coordinates in _iter_path_arrays( paths ):
+            if len( path_coordinates ) == 0:
+                continue
+            minimum = np.minimum( minimum, path_coordinates.min( axis = 0 ) )
+            maximum = np.maximum( maximum, path_coordinates.max( axis = 0 ) )
+            points = ' '.join( [ point_format ] * len( path_coordinates ) ) % tuple( path_coordinates.ravel().tolist() )
+            f.write( f'<polyline points="{points}"/>\n' )
+        f.write( _SVG_FOOTER )
+
+        # fill in the viewBox, which has to fit in the reserved space
+        view_box = '0 0 0 0'
+        if np.all( np.isfinite( minimum ) ):
+            size = maximum - minimum
+            view_box = f'{minimum[ 0 ]:.{precision}f} {minimum[ 1 ]:.{precision}f} {size[ 0 ]:.{precision}f} {size[ 1 ]:.{precision}f}'
+        assert len( view_box ) <= len( _VIEW_BOX_PLACEHOLDER )
+        f.seek( view_box_position )
+        f.write( view_box.ljust( len( _VIEW_BOX_PLACEHOLDER ) ) )
+
+    if open_in_browser:
+        webbrowser.open( Path( out_filename ).absolute().as_uri() )
+
+
+def make_preview_for_pack( pack, out_filename : str, open_in_browser : bool = True ) -> None:
     # create preview svg
-    preview = [ ]
-    for path in pack :
-        preview_p = Path()
-        preview.append( preview_p )
-        p0 = path[ 0 ]
-        for p1 in path[ 1 : ] :
-            preview_p.append( Line( complex( p0.x, p0.y ), complex( p1.x, p1.y ) ) )
-            p0 = p1
-
-    disvg( paths = preview, filename = f"{getcwd()}/{out_filename}", margin_size = 0 )
+    # the pack can be any list-of-points pack or ArrayPack, or a generator of path arrays
+    write_svg_preview( pack, out_filename, open_in_browser )
     logging.info( f"Wrote preview file of converted SVG to {out_filename}." )
 
 
-def make_preview_for_motor_instructions( motor_instructions_file : str, out_filename : str ) -> None:
+def _iter_plot_paths_for_motor_instructions_file( motor_instructions_file : str ):
+    # Yields the paths the Device should draw in board space, converting a chunk of paths at a time
+    # Binary files are memory mapped, so only the paths of the current chunk are read
+    if not is_binary_motor_instructions_file( motor_instructions_file ):
+        yield from make_plot_pack_for_motor_instructions_pack( read_motor_instructions_file( motor_instructions_file ) ).iter_path_coordinates()
+        return
+
+    with BinaryMotorInstructionsFile( motor_instructions_file ) as instructions_file:
+        path_offsets = instructions_file.path_offsets.astype( np.int64 )
+        first_path = 0
+        while first_path < instructions_file.n_paths:
+            last_path = int( np.searchsorted( path_offsets, path_offsets[ first_path ] + _PREVIEW_CHUNK_SIZE_POINTS, side = 'right' ) ) - 1
+            last_path = min( max( last_path, first_path + 1 ), instructions_file.n_paths )
+            chunk_offsets = path_offsets[ first_path : last_path + 1 ]
+            # dividing copies the target units, so no view on the memory map is kept around
+            target_degrees = instructions_file.target_units[ chunk_offsets[ 0 ] : chunk_offsets[ -1 ] ] / instructions_file.units_per_degree
+            chunk = MotorInstructionsArrayPack( target_degrees, chunk_offsets - chunk_offsets[ 0 ] )
+            yield from make_plot_pack_for_motor_instructions_pack( chunk ).iter_path_coordinates()
+            first_path = last_path
+
+
+def make_preview_for_motor_instructions( motor_instructions_file : str, out_filename : str, open_in_browser : bool = True ) -> None:
     board = _get_board()
     anchors = _get_anchors()
     canvas = _get_canvas()
-    plot = make_plot_pack_for_motor_instructions_file( motor_instructions_file )
+    plot = _iter_plot_paths_for_motor_instructions_file( motor_instructions_file )
 
     # Combine all previous components to define the full scene
-    full_plot_pack = board + anchors + canvas + plot
-
-    make_preview_for_pack( full_plot_pack, out_filename )
\ No newline at end of file
+    scene = BoardArrayPack.concatenate( [ board, anchors, canvas ] )
+    make_preview_for_pack( itertools.chain( scene.iter_path_coordinates(), plot ), out_filename, open_in_browser )
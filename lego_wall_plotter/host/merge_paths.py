@@ -0,0 +1,112 @@
+import logging
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import CanvasArrayPack, CanvasPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.spatial_index import NearestPointIndex
+
+
+"""
+Joins paths that touch into a single path, so the pen does not have to go up and down between them.
+SVGs exported from drawing tools often consist of many short paths,
+where every path starts right where the previous one ended.
+Every path costs a pen move down and a pen move up on the Device, which take PEN_DOWN_DURATION_S and PEN_UP_DURATION_S.
+
+This runs after ordering, and keeps the order wherever it can:
+a path is joined to the one before it when its start is within the tolerance of where the previous path ended.
+Only when the next path in the order does not touch, we look for any other path that does,
+using a spatial index on the start and end points of the paths that are not drawn yet.
+Such a path is drawn right away, backwards if its end is the one that touches.
+"""
+
+
+def get_path_merge_order(
+        path_starts : np.ndarray,
+        path_ends : np.ndarray,
+        tolerance_mm : float
+) -> tuple[ np.ndarray, np.ndarray, np.ndarray ]:
+    # Returns the order to draw the paths in, whether every path in that order is drawn backwards,
+    # and whether every path in that order is joined to the path before it
+    # Only the endpoints are needed, so the paths themselves do not have to be in memory
+    n_paths = len( path_starts )
+    order = np.zeros( n_paths, dtype = np.int64 )
+    reversed_paths = np.zeros( n_paths, dtype = bool )
+    joins_previous = np.zeros( n_paths, dtype = bool )
+    if n_paths == 0:
+        return order, reversed_paths, joins_previous
+
+    # start point of path i is point i in the index, and its end point is point n_paths + i
+    endpoints = np.concatenate( ( path_starts, path_ends ) )
+    endpoints_index = NearestPointIndex( endpoints )
+    drawn = np.zeros( n_paths, dtype = bool )
+    next_in_order = 0
+    exit_point = None
+
+    for position in range( n_paths ):
+        while drawn[ next_in_order ]:
+            next_in_order += 1
+
+        index, is_reversed, is_joined = next_in_order, False, False
+        if exit_point is not None:
+            if np.hypot( *( path_starts[ next_in_order ] - exit_point ) ) <= tolerance_mm:
+                is_joined = True
+            else:
+                nearest = endpoints_index.nearest( *exit_point )
+                if np.hypot( *( endpoints[ nearest ] - exit_point ) ) <= tolerance_mm:
+                    index, is_reversed, is_joined = nearest % n_paths, nearest >= n_paths, True
+
+        order[ position ] = index
+        reversed_paths[ position ] = is_reversed
+        joins_previous[ position ] = is_joined
+        drawn[ index ] = True
+        endpoints_index.remove( index )
+        endpoints_index.remove( n_paths + index )
+        exit_point = path_starts[ index ] if is_reversed else path_ends[ index ]
+
+    return order, reversed_paths, joins_previous
+
+
+def get_joined_point_mask( coordinates : np.ndarray, path_offsets : np.ndarray, joins_previous : np.ndarray ) -> np.ndarray:
+    # For every point, whether it can be dropped after joining the paths:
+    # the first point of a joined path, when it is exactly the last point of the path before it
+    # When the paths only nearly touch, both points are kept, and the pen simply draws the tiny gap
+    drop = np.zeros( len( coordinates ), dtype = bool )
+    first_points = path_offsets[ : -1 ][ joins_previous ]
+    duplicate = np.all( coordinates[ first_points ] == coordinates[ first_points - 1 ], axis = 1 )
+    drop[ first_points[ duplicate ] ] = True
+    return drop
+
+
+def log_merge_savings( n_paths : int, n_merged_paths : int ) -> None:
+    # every path that is joined to another one saves a pen move up and a pen move down
+    n_pen_lifts_saved = n_paths - n_merged_paths
+    seconds_saved = n_pen_lifts_saved * ( Constants.PEN_DOWN_DURATION_S + Constants.PEN_UP_DURATION_S )
+    logging.info(
+        f"Merging touching paths - DONE! Merged {n_paths} paths into {n_merged_paths}, "
+        f"which saves {n_pen_lifts_saved} pen lifts and {seconds_saved:.0f} seconds of pen moves."
+    )
+
+
+def merge_touching_paths(
+        canvas_pack : CanvasPack | CanvasArrayPack,
+        tolerance_mm : float | None = Constants.PATH_MERGE_TOLERANCE_MM
+) -> CanvasArrayPack:
+    canvas_pack = CanvasArrayPack.from_paths( canvas_pack )
+    if tolerance_mm is None or len( canvas_pack ) == 0:
+        return canvas_pack
+
+    logging.info( "Merging touching paths." )
+    order, reversed_paths, joins_previous = get_path_merge_order(
+        canvas_pack.path_starts(), canvas_pack.path_ends(), tolerance_mm
+    )
+    reordered_pack = canvas_pack.reordered( order, reversed_paths )
+
+    # the merged paths start at the paths that are not joined to the one before them
+    keep = ~get_joined_point_mask( reordered_pack.coordinates, reordered_pack.path_offsets, joins_previous )
+    kept_before = np.concatenate( ( [ 0 ], np.cumsum( keep ) ) )
+    path_offsets = kept_before[ reordered_pack.path_offsets[ np.concatenate( ( ~joins_previous, [ True ] ) ) ] ]
+    merged_pack = CanvasArrayPack( reordered_pack.coordinates[ keep ], path_offsets )
+
+    log_merge_savings( len( canvas_pack ), len( merged_pack ) )
+    return merged_pack
@@ -1,15 +1,16 @@
+import logging
 import math
 
+import numpy as np
+
 from lego_wall_plotter.host.base_types import (
-    MotorInstructionsPack,
-    MotorInstruction,
+    MotorInstructionsArrayPack,
     MotorDegrees,
-    BoardPack,
-    BoardPoint,
-    RopeLengths
+    BoardArrayPack,
 )
 from lego_wall_plotter.host.constants import Constants
 from lego_wall_plotter.host.make_motor_instructions import get_initial_degrees
+from lego_wall_plotter.host.motor_instructions_file import read_motor_instructions_file
 
 
 """
@@ -21,60 +22,41 @@ it is a model of what we think the robot should work like, if we could ignore pw
 """
 
 
-class MotorInstructionReader:
-    def __init__(self, filename):
-        self._file = open( filename, 'r' )
-        self.n_paths = int( self._file.readline().strip() )
+def _get_intersections( x0, y0, r0, x1, y1, r1 ) -> tuple[ np.ndarray, np.ndarray, np.ndarray ]:
+    # circle 1: (x0, y0), radius r0
+    # circle 2: (x1, y1), radius r1
+    # The centers are fixed, while r0 and r1 are arrays, so we solve all intersections at once.
+    # Returns both intersections for every pair of radii,
+    # and a mask of the pairs for which the circles do not intersect.
+    # For those we use a point on the line segment between the centers,
+    # which is where the circles would touch if their radii were just a bit different.
 
-    def paths(self):
-        for _ in range( self.n_paths ):
-            yield PathReader( self._file )
-        return
+    d = math.sqrt( (x1 - x0) ** 2 + (y1 - y0) ** 2 ) - 0.00001
 
+    # coincident centers, there is no way to determine a position
+    if d <= 0 :
+        raise ValueError( "Cannot determine intersections for circles with the same center." )
 
-class PathReader:
-    def __init__(self, file):
-        self._file = file
+    # non-intersecting, or one circle within other
+    unreachable = ( d > r0 + r1 ) | ( d < np.abs( r0 - r1 ) )
 
-    def instructions(self):
-        while True:
-            line = self._file.readline().strip()
-            if not line:
-                return
-            instruction = MotorInstruction( *map( float, line.split(',') ) )
-            yield instruction
+    a = (r0 ** 2 - r1 ** 2 + d ** 2) / (2 * d)
+    h = np.sqrt( np.maximum( r0 ** 2 - a ** 2, 0 ) )
+    a[ unreachable ] = np.clip( a[ unreachable ], 0, d )
+    h[ unreachable ] = 0
+    x2 = x0 + a * (x1 - x0) / d
+    y2 = y0 + a * (y1 - y0) / d
+    x3 = x2 + h * (y1 - y0) / d
+    y3 = y2 - h * (x1 - x0) / d
 
+    x4 = x2 - h * (y1 - y0) / d
+    y4 = y2 + h * (x1 - x0) / d
 
-def _get_intersections( x0, y0, r0, x1, y1, r1 ) :
-    # circle 1: (x0, y0), radius r0
-    # circle 2: (x1, y1), radius r1
+    return np.column_stack( ( x3, y3 ) ), np.column_stack( ( x4, y4 ) ), unreachable
 
-    d = math.sqrt( (x1 - x0) ** 2 + (y1 - y0) ** 2 ) - 0.00001
 
-    # non-intersecting
-    if d > r0 + r1 :
-        return None
-    # One circle within other
-    if d < abs( r0 - r1 ) :
-        return None
-    # coincident circles
-    if d == 0 and r0 == r1 :
-        return None
-    else :
-        a = (r0 ** 2 - r1 ** 2 + d ** 2) / (2 * d)
-        h = math.sqrt( r0 ** 2 - a ** 2 )
-        x2 = x0 + a * (x1 - x0) / d
-        y2 = y0 + a * (y1 - y0) / d
-        x3 = x2 + h * (y1 - y0) / d
-        y3 = y2 - h * (x1 - x0) / d
-
-        x4 = x2 - h * (y1 - y0) / d
-        y4 = y2 + h * (x1 - x0) / d
-
-        return (x3, y3, x4, y4)
-
-
-def _get_point_in_board_space_for_rope_lengths( rope_lengths : RopeLengths ) -> BoardPoint:
+def _get_board_coordinates_for_rope_lengths( rope_lengths : np.ndarray ) -> np.ndarray:
+    # rope_lengths is an array of shape ( n, 2 ) with the left and right rope length of every point
     # Note that we are working in anchor space, not board space!!!
     left_anchor = (0, 0)
     right_anchor = (
@@ -82,47 +64,32 @@ def _get_point_in_board_space_for_rope_lengths( rope_lengths : RopeLengths ) ->
         Constants.RIGHT_ANCHOR_OFFSET_TO_BOARD_MM[ 1 ] - Constants.LEFT_ANCHOR_OFFSET_TO_BOARD_MM[ 1 ],
     )
 
-    intersections = _get_intersections(
-        *left_anchor, rope_lengths[0],
-        *right_anchor, rope_lengths[1]
+    intersections_1, intersections_2, unreachable = _get_intersections(
+        *left_anchor, rope_lengths[ :, 0 ],
+        *right_anchor, rope_lengths[ :, 1 ]
     )
+    if unreachable.any():
+        logging.warning( f"{np.count_nonzero( unreachable )} motor instructions describe rope lengths that cannot be reached." )
 
-    i1x, i1y, i2x, i2y = intersections
-    if i1x > 0 and i1y > 0:
-        x, y = i1x, i1y
-    else:
-        x, y = i2x, i2y
+    # the pen hangs below the anchors
+    use_first = ( intersections_1[ :, 0 ] > 0 ) & ( intersections_1[ :, 1 ] > 0 )
+    points = np.where( use_first[ :, None ], intersections_1, intersections_2 )
 
     # Now that we have worked in anchor space, and will now convert to board space
-    return BoardPoint(
-        x + Constants.LEFT_ANCHOR_OFFSET_TO_BOARD_MM[ 0 ],
-        y + Constants.LEFT_ANCHOR_OFFSET_TO_BOARD_MM[ 1 ]
-    )
-
+    return points + Constants.LEFT_ANCHOR_OFFSET_TO_BOARD_MM
 
-def _get_target_rope_lengths_for_motor_instruction( motor_instruction : MotorInstruction, initial_degrees : MotorDegrees ) -> RopeLengths:
-    return RopeLengths((
-        ( motor_instruction.target_degrees_left + initial_degrees[ 0 ] ) * Constants.MM_PER_DEGREE,
-        ( motor_instruction.target_degrees_right + initial_degrees[ 1 ] ) * Constants.MM_PER_DEGREE
-    ))
 
+def _get_target_rope_lengths_for_motor_instructions( target_degrees : np.ndarray, initial_degrees : MotorDegrees ) -> np.ndarray:
+    return ( target_degrees + initial_degrees ) * Constants.MM_PER_DEGREE
 
-def make_plot_pack_for_motor_instructions_file( motor_instructions_file_path : str ) -> BoardPack:
-
-    instruction_reader = MotorInstructionReader( motor_instructions_file_path )
 
+def make_plot_pack_for_motor_instructions_pack( motor_instructions_pack : MotorInstructionsArrayPack ) -> BoardArrayPack:
     initial_degrees = get_initial_degrees()
-    board_pack = [ ]
-    for motor_instruction_path in instruction_reader.paths():
-        board_path = [ ]
-        for motor_instruction in motor_instruction_path.instructions():
-
-            # compute plot point
-            target_rope_lengths = _get_target_rope_lengths_for_motor_instruction( motor_instruction, initial_degrees )
-            target_position = _get_point_in_board_space_for_rope_lengths( target_rope_lengths )
+    target_rope_lengths = _get_target_rope_lengths_for_motor_instructions( motor_instructions_pack.coordinates, initial_degrees )
+    target_positions = _get_board_coordinates_for_rope_lengths( target_rope_lengths )
+    return BoardArrayPack( target_positions, motor_instructions_pack.path_offsets )
 
-            # update result
-            board_path.append( target_position )
 
-        board_pack.append( board_path )
-    return board_pack
+def make_plot_pack_for_motor_instructions_file( motor_instructions_file_path : str ) -> BoardArrayPack:
+    motor_instructions_pack = read_motor_instructions_file( motor_instructions_file_path )
+    return make_plot_pack_for_motor_instructions_pack( motor_instructions_pack )
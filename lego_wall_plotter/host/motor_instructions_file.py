@@ -1,9 +1,89 @@
 import logging
+import mmap
+import shutil
+import struct
+import tempfile
 
-from lego_wall_plotter.host.base_types import MotorInstructionsPack
+import numpy as np
 
-def write_motor_instructions_file( instructions_pack : MotorInstructionsPack, path : str ) -> None:
+from lego_wall_plotter.host.base_types import MotorInstructionsArrayPack, MotorInstructionsPack
+
+
+"""
+Motor instructions can be written in two formats:
+
+The text format has the number of paths on the first line,
+then one line per instruction with the left and right target degrees separated by a comma,
+and an empty line after every path.
+Instructions can have the end speed as a third value on their line, see below.
+
+The binary format is smaller and much cheaper to parse on the Device.
+All values are little-endian, and all targets are integers in units of 1 / <units per degree> degrees.
+It starts with a header: magic b'LWPI', uint16 version, uint16 units per degree, uint32 number of paths, uint32 number of instructions,
+followed by the path offsets: ( number of paths + 1 ) uint32, path i consists of instructions offsets[ i ] until offsets[ i + 1 ].
+What follows depends on the version:
+
+Version 1, fixed width:
+- instructions: per instruction an int32 left and an int32 right target
+
+Version 2, delta encoded:
+- extra header: uint32 keyframe interval, uint32 number of keyframes
+- path keyframe offsets: ( number of paths + 1 ) uint32, the index of the first keyframe of every path
+- keyframe byte offsets: ( number of keyframes ) uint32, the position of every keyframe in the instruction data
+- instruction data: per instruction the left and then the right target, each as a zigzag varint.
+  Every <keyframe interval>-th instruction of a path, starting with the first, is a keyframe and stores absolute targets,
+  all others store the difference with the previous instruction.
+  Decoding can therefore start at any keyframe, without reading the rest of the path.
+
+Versions 3 and 4 are the same as versions 1 and 2,
+but every instruction has a third value after the left and right target: the end speed,
+which is stored, and for version 4 delta encoded, in exactly the same way as the targets.
+The end speed tells the Device how fast it may still go when it reaches the target, in units of MAX_DEG_PER_S / END_SPEED_MAX.
+An end speed of 0 means the Device has to brake at the target, which is what it does for every instruction in versions 1 and 2.
+"""
+
+
+BINARY_MAGIC = b'LWPI'
+BINARY_VERSION_FIXED_WIDTH = 1
+BINARY_VERSION_DELTA_ENCODED = 2
+BINARY_VERSION_FIXED_WIDTH_WITH_END_SPEEDS = 3
+BINARY_VERSION_DELTA_ENCODED_WITH_END_SPEEDS = 4
+_BINARY_VERSIONS = (
+    BINARY_VERSION_FIXED_WIDTH,
+    BINARY_VERSION_DELTA_ENCODED,
+    BINARY_VERSION_FIXED_WIDTH_WITH_END_SPEEDS,
+    BINARY_VERSION_DELTA_ENCODED_WITH_END_SPEEDS,
+)
+_DELTA_ENCODED_VERSIONS = ( BINARY_VERSION_DELTA_ENCODED, BINARY_VERSION_DELTA_ENCODED_WITH_END_SPEEDS )
+_END_SPEED_VERSIONS = ( BINARY_VERSION_FIXED_WIDTH_WITH_END_SPEEDS, BINARY_VERSION_DELTA_ENCODED_WITH_END_SPEEDS )
+BINARY_HEADER_FORMAT = '<4sHHII'
+BINARY_HEADER_SIZE = struct.calcsize( BINARY_HEADER_FORMAT )
+BINARY_DELTA_HEADER_FORMAT = '<II'
+BINARY_DELTA_HEADER_SIZE = struct.calcsize( BINARY_DELTA_HEADER_FORMAT )
+
+# The motors only report whole degrees, so finer units would not make the Device any more precise
+DEFAULT_UNITS_PER_DEGREE = 1
+
+# A keyframe costs a few more bytes than a delta, and an entry in the keyframe table
+DEFAULT_KEYFRAME_INTERVAL = 64
+
+# The end speed that stands for MAX_DEG_PER_S
+END_SPEED_MAX = 255
+
+
+def get_binary_version( delta_encoded : bool, with_end_speeds : bool ) -> int:
+    if delta_encoded:
+        return BINARY_VERSION_DELTA_ENCODED_WITH_END_SPEEDS if with_end_speeds else BINARY_VERSION_DELTA_ENCODED
+    return BINARY_VERSION_FIXED_WIDTH_WITH_END_SPEEDS if with_end_speeds else BINARY_VERSION_FIXED_WIDTH
+
+
+def write_motor_instructions_file(
+        instructions_pack : MotorInstructionsPack | MotorInstructionsArrayPack,
+        path : str,
+        end_speeds : np.ndarray | None = None
+) -> None:
     logging.info( "=" * 64 )
+    instructions_pack = MotorInstructionsArrayPack.from_paths( instructions_pack )
 
     with open( path, 'w' ) as instructions_file :
 
@@ -11,9 +91,352 @@ def write_motor_instructions_file( instructions_pack : MotorInstructionsPack, pa
         n_paths = len(instructions_pack)
         instructions_file.write( f'{n_paths}\n' )
 
-        for path in instructions_pack:
-            for instruction in path:
-                instructions_file.write( f'{instruction.target_degrees_left},{instruction.target_degrees_right}\n' )
-            instructions_file.write( '\n' ) # empty line to signal the end of the file
+        for i_path, path_coordinates in enumerate( instructions_pack.iter_path_coordinates() ):
+            path_end_speeds = None
+            if end_speeds is not None:
+                path_end_speeds = end_speeds[ instructions_pack.path_offsets[ i_path ] : instructions_pack.path_offsets[ i_path + 1 ] ]
+            write_motor_instructions_path( instructions_file, path_coordinates, path_end_speeds )
+
+    logging.info( f"Wrote motor instructions to file '{path}'" )
+
+
+def write_motor_instructions_path( instructions_file, path : np.ndarray, end_speeds : np.ndarray | None = None ) -> None:
+    # writes a single path of target degrees to an opened text file
+    if end_speeds is None:
+        for target_degrees_left, target_degrees_right in path.tolist():
+            instructions_file.write( f'{target_degrees_left},{target_degrees_right}\n' )
+    else:
+        for ( target_degrees_left, target_degrees_right ), end_speed in zip( path.tolist(), end_speeds.tolist() ):
+            instructions_file.write( f'{target_degrees_left},{target_degrees_right},{end_speed}\n' )
+    instructions_file.write( '\n' ) # empty line to signal the end of the file
+
+
+def read_motor_instructions_file( path : str ) -> MotorInstructionsArrayPack:
+    # Reads the whole file at once into arrays, instead of parsing it line by line like the Device does
+    # Both the binary and the text format are supported
+
+    if is_binary_motor_instructions_file( path ):
+        with BinaryMotorInstructionsFile( path ) as binary_file:
+            return binary_file.to_pack()
+
+    with open( path, 'r' ) as instructions_file :
+        n_paths = int( instructions_file.readline().strip() )
+        lines = instructions_file.read().split( '\n' )
+
+    # every path ends with an empty line, anything after the last path is ignored
+    end_of_path_line_indices = np.flatnonzero( [ len( line.strip() ) == 0 for line in lines ] )[ : n_paths ]
+    assert len( end_of_path_line_indices ) == n_paths
+
+    # the number of instructions before the end of path j, is the number of lines before it minus j empty lines
+    path_offsets = np.zeros( n_paths + 1, dtype = np.int64 )
+    path_offsets[ 1 : ] = end_of_path_line_indices - np.arange( n_paths )
+
+    n_lines = end_of_path_line_indices[ -1 ] if n_paths > 0 else 0
+    instruction_lines = [ line for line in lines[ : n_lines ] if len( line.strip() ) > 0 ]
+    if len( instruction_lines ) == 0:
+        return MotorInstructionsArrayPack( np.empty( ( 0, 2 ) ), path_offsets )
+
+    # the end speeds are only of use to the Device
+    n_values = instruction_lines[ 0 ].count( ',' ) + 1
+    target_degrees = np.array( ','.join( instruction_lines ).split( ',' ), dtype = np.float64 ).reshape( -1, n_values )[ :, : 2 ]
+
+    logging.info( f"Read {len( target_degrees )} motor instructions from file '{path}'" )
+    return MotorInstructionsArrayPack( target_degrees, path_offsets )
+
+
+def _zigzag_encode( values : np.ndarray ) -> np.ndarray:
+    # maps signed integers to unsigned integers, so that small negative numbers stay small: 0, -1, 1, -2, 2 -> 0, 1, 2, 3, 4
+    values = values.astype( np.int64 )
+    return ( ( values << 1 ) ^ ( values >> 63 ) ).astype( np.uint64 )
+
+
+def _zigzag_decode( values : np.ndarray ) -> np.ndarray:
+    values = values.astype( np.uint64 )
+    return ( values >> np.uint64( 1 ) ).astype( np.int64 ) ^ -( values & np.uint64( 1 ) ).astype( np.int64 )
+
+
+def _varint_encode( values : np.ndarray ) -> tuple[ np.ndarray, np.ndarray ]:
+    # Encodes unsigned integers with 7 bits per byte, where the high bit signals that more bytes follow.
+    # Returns the encoded bytes, and the position of every value in those bytes.
+    n_bytes = np.ones( len( values ), dtype = np.int64 )
+    remaining = values >> np.uint64( 7 )
+    while remaining.any():
+        n_bytes += remaining > 0
+        remaining >>= np.uint64( 7 )
+
+    positions = np.zeros( len( values ), dtype = np.int64 )
+    np.cumsum( n_bytes[ : -1 ], out = positions[ 1 : ] )
+    encoded = np.zeros( int( n_bytes.sum() ), dtype = np.uint8 )
+    for i_byte in range( int( n_bytes.max( initial = 0 ) ) ):
+        has_byte = n_bytes > i_byte
+        byte = ( values[ has_byte ] >> np.uint64( 7 * i_byte ) ) & np.uint64( 0x7F )
+        has_more = n_bytes[ has_byte ] > i_byte + 1
+        encoded[ positions[ has_byte ] + i_byte ] = byte.astype( np.uint8 ) | ( has_more.astype( np.uint8 ) << 7 )
+    return encoded, positions
+
+
+def _varint_decode( encoded : np.ndarray ) -> np.ndarray:
+    encoded = np.asarray( encoded, dtype = np.uint8 )
+    is_last_byte = ( encoded & 0x80 ) == 0
+    value_ends = np.flatnonzero( is_last_byte )
+    value_starts = np.concatenate( ( [ 0 ], value_ends[ : -1 ] + 1 ) )
+
+    # the position of every byte within its value determines how far it is shifted
+    value_indices = np.concatenate( ( [ 0 ], np.cumsum( is_last_byte[ : -1 ] ) ) )
+    positions_in_value = np.arange( len( encoded ) ) - value_starts[ value_indices ]
+    shifted = ( encoded & 0x7F ).astype( np.uint64 ) << ( 7 * positions_in_value ).astype( np.uint64 )
+    return np.add.reduceat( shifted, value_starts ) if len( encoded ) > 0 else np.zeros( 0, dtype = np.uint64 )
+
+
+def _get_keyframe_mask( path_offsets : np.ndarray, keyframe_interval : int ) -> np.ndarray:
+    # every <keyframe interval>-th instruction of every path, starting with the first, is a keyframe
+    n_instructions = int( path_offsets[ -1 ] )
+    path_lengths = np.diff( path_offsets )
+    path_indices = np.repeat( np.arange( len( path_lengths ) ), path_lengths )
+    indices_in_path = np.arange( n_instructions ) - path_offsets[ path_indices ]
+    return indices_in_path % keyframe_interval == 0
+
+
+def _get_target_units( target_degrees : np.ndarray, units_per_degree : int ) -> np.ndarray:
+    target_units = np.rint( target_degrees * units_per_degree )
+    int32_info = np.iinfo( np.int32 )
+    assert np.all( ( int32_info.min <= target_units ) & ( target_units <= int32_info.max ) )
+    return target_units.astype( np.int64 )
+
+
+def _get_instruction_values( target_degrees : np.ndarray, units_per_degree : int, version : int, end_speeds : np.ndarray | None ) -> np.ndarray:
+    # the values that are stored for every instruction: the targets, and for some versions the end speed
+    if version not in _BINARY_VERSIONS:
+        raise ValueError( f"Unknown binary motor instructions version {version}." )
+    assert ( end_speeds is not None ) == ( version in _END_SPEED_VERSIONS ), f"Version {version} {'needs' if version in _END_SPEED_VERSIONS else 'has no'} end speeds."
+
+    target_units = _get_target_units( np.reshape( target_degrees, ( -1, 2 ) ), units_per_degree )
+    if end_speeds is None:
+        return target_units
+    end_speeds = np.asarray( end_speeds, dtype = np.int64 )
+    assert np.all( ( 0 <= end_speeds ) & ( end_speeds <= END_SPEED_MAX ) )
+    return np.column_stack( ( target_units, end_speeds ) )
+
+
+def _encode_fixed_width( values : np.ndarray ) -> bytes:
+    return values.astype( '<i4' ).tobytes()
+
+
+def _encode_delta( values : np.ndarray, path_offsets : np.ndarray, keyframe_interval : int ) -> bytes:
+    is_keyframe = _get_keyframe_mask( path_offsets, keyframe_interval )
+    deltas = np.diff( values, axis = 0, prepend = 0 )
+    values = np.where( is_keyframe[ :, None ], values, deltas )
+    encoded, positions = _varint_encode( _zigzag_encode( values.reshape( -1 ) ) )
+
+    # every instruction consists of two or three values, the keyframe byte offsets point at the left value
+    keyframe_byte_offsets = positions[ 0 : : values.shape[ 1 ] ][ is_keyframe ]
+    path_keyframe_offsets = np.concatenate( ( [ 0 ], np.cumsum( is_keyframe ) ) )[ path_offsets ]
+
+    return b''.join( [
+        struct.pack( BINARY_DELTA_HEADER_FORMAT, keyframe_interval, len( keyframe_byte_offsets ) ),
+        path_keyframe_offsets.astype( '<u4' ).tobytes(),
+        keyframe_byte_offsets.astype( '<u4' ).tobytes(),
+        encoded.tobytes(),
+    ] )
+
+
+def _decode_delta( buffer, position : int, path_offsets : np.ndarray, n_values : int ) -> np.ndarray:
+    keyframe_interval, n_keyframes = struct.unpack_from( BINARY_DELTA_HEADER_FORMAT, buffer, position )
+    n_paths = len( path_offsets ) - 1
+    data_position = position + BINARY_DELTA_HEADER_SIZE + 4 * ( n_paths + 1 ) + 4 * n_keyframes
+    encoded = np.frombuffer( buffer, dtype = np.uint8, offset = data_position )
+    values = _zigzag_decode( _varint_decode( encoded ) ).reshape( -1, n_values )
+
+    # a cumulative sum of the deltas, which restarts at every keyframe
+    is_keyframe = _get_keyframe_mask( path_offsets, keyframe_interval )
+    cumulative = np.cumsum( values, axis = 0 )
+    keyframe_indices = np.flatnonzero( is_keyframe )
+    restarts = cumulative[ keyframe_indices ] - values[ keyframe_indices ]
+    return cumulative - restarts[ np.cumsum( is_keyframe ) - 1 ]
+
+
+def encode_motor_instructions_binary(
+        instructions_pack : MotorInstructionsPack | MotorInstructionsArrayPack,
+        units_per_degree : int = DEFAULT_UNITS_PER_DEGREE,
+        version : int = BINARY_VERSION_FIXED_WIDTH,
+        keyframe_interval : int = DEFAULT_KEYFRAME_INTERVAL,
+        end_speeds : np.ndarray | None = None
+) -> bytes:
+    instructions_pack = MotorInstructionsArrayPack.from_paths( instructions_pack )
+    values = _get_instruction_values( instructions_pack.coordinates, units_per_degree, version, end_speeds )
+
+    if version in _DELTA_ENCODED_VERSIONS:
+        instructions = _encode_delta( values, instructions_pack.path_offsets, keyframe_interval )
+    else:
+        instructions = _encode_fixed_width( values )
+
+    return b''.join( [
+        struct.pack(
+            BINARY_HEADER_FORMAT,
+            BINARY_MAGIC,
+            version,
+            units_per_degree,
+            len( instructions_pack ),
+            instructions_pack.n_points
+        ),
+        instructions_pack.path_offsets.astype( '<u4' ).tobytes(),
+        instructions,
+    ] )
+
+
+def write_motor_instructions_binary_file(
+        instructions_pack : MotorInstructionsPack | MotorInstructionsArrayPack,
+        path : str,
+        units_per_degree : int = DEFAULT_UNITS_PER_DEGREE,
+        version : int = BINARY_VERSION_FIXED_WIDTH,
+        keyframe_interval : int = DEFAULT_KEYFRAME_INTERVAL,
+        end_speeds : np.ndarray | None = None
+) -> None:
+    with open( path, 'wb' ) as instructions_file :
+        instructions_file.write( encode_motor_instructions_binary( instructions_pack, units_per_degree, version, keyframe_interval, end_speeds ) )
+
+    logging.info( f"Wrote binary motor instructions (version {version}) to file '{path}'" )
+
+
+class BinaryMotorInstructionsWriter:
+    # Writes a binary motor instructions file one path at a time,
+    # so the whole MotorInstructionsPack never has to be in memory.
+    # The tables in front of the instructions are only known at the end,
+    # so the instructions go to a temporary file first, and are copied behind the tables on close.
+    # Only the tables themselves are kept in memory.
+
+    def __init__(
+            self,
+            path : str,
+            units_per_degree : int = DEFAULT_UNITS_PER_DEGREE,
+            version : int = BINARY_VERSION_FIXED_WIDTH,
+            keyframe_interval : int = DEFAULT_KEYFRAME_INTERVAL
+    ):
+        if version not in _BINARY_VERSIONS:
+            raise ValueError( f"Unknown binary motor instructions version {version}." )
+        self.path = path
+        self.units_per_degree = units_per_degree
+        self.version = version
+        self.keyframe_interval = keyframe_interval
+
+        self._instructions_file = tempfile.TemporaryFile()
+        self._n_instruction_bytes = 0
+        self._path_offsets = [ 0 ]
+        self._path_keyframe_offsets = [ 0 ]
+        self._keyframe_byte_offsets = []
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._instructions_file.close()
+
+    def write_path( self, target_degrees : np.ndarray, end_speeds : np.ndarray | None = None ) -> None:
+        values = _get_instruction_values( target_degrees, self.units_per_degree, self.version, end_speeds )
+        path_offsets = np.array( [ 0, len( values ) ] )
+
+        if self.version not in _DELTA_ENCODED_VERSIONS:
+            instructions = _encode_fixed_width( values )
+        else:
+            # the same as _encode_delta, for a single path
+            is_keyframe = _get_keyframe_mask( path_offsets, self.keyframe_interval )
+            deltas = np.diff( values, axis = 0, prepend = 0 )
+            values = np.where( is_keyframe[ :, None ], values, deltas )
+            encoded, positions = _varint_encode( _zigzag_encode( values.reshape( -1 ) ) )
+            self._keyframe_byte_offsets.append( positions[ 0 : : values.shape[ 1 ] ][ is_keyframe ] + self._n_instruction_bytes )
+            self._path_keyframe_offsets.append( self._path_keyframe_offsets[ -1 ] + int( is_keyframe.sum() ) )
+            instructions = encoded.tobytes()
+
+        self._instructions_file.write( instructions )
+        self._n_instruction_bytes += len( instructions )
+        self._path_offsets.append( self._path_offsets[ -1 ] + len( values ) )
+
+    def close( self ) -> None:
+        n_paths = len( self._path_offsets ) - 1
+        with open( self.path, 'wb' ) as instructions_file :
+            instructions_file.write( struct.pack(
+                BINARY_HEADER_FORMAT,
+                BINARY_MAGIC,
+                self.version,
+                self.units_per_degree,
+                n_paths,
+                self._path_offsets[ -1 ]
+            ) )
+            instructions_file.write( np.array( self._path_offsets ).astype( '<u4' ).tobytes() )
+            if self.version in _DELTA_ENCODED_VERSIONS:
+                keyframe_byte_offsets = np.concatenate( self._keyframe_byte_offsets ) if self._keyframe_byte_offsets else np.zeros( 0 )
+                instructions_file.write( struct.pack( BINARY_DELTA_HEADER_FORMAT, self.keyframe_interval, len( keyframe_byte_offsets ) ) )
+                instructions_file.write( np.array( self._path_keyframe_offsets ).astype( '<u4' ).tobytes() )
+                instructions_file.write( keyframe_byte_offsets.astype( '<u4' ).tobytes() )
+            self._instructions_file.seek( 0 )
+            shutil.copyfileobj( self._instructions_file, instructions_file )
+        self._instructions_file.close()
+
+        logging.info( f"Wrote binary motor instructions (version {self.version}) to file '{self.path}'" )
+
+
+def is_binary_motor_instructions_file( path : str ) -> bool:
+    with open( path, 'rb' ) as instructions_file :
+        return instructions_file.read( len( BINARY_MAGIC ) ) == BINARY_MAGIC
+
+
+class BinaryMotorInstructionsFile:
+    # Memory maps a binary motor instructions file.
+    # path_offsets is a NumPy view directly on the mapped file, and so are target_units and end_speeds for fixed width files,
+    # so nothing is copied. Delta encoded files are decoded into target_units and end_speeds at once.
+    # end_speeds is None for versions without end speeds.
+    # Copy anything you want to keep using after the file is closed.
+    # Views that are still held when the file is closed keep the memory map alive, until they are garbage collected.
+
+    def __init__( self, path : str ):
+        self._file = open( path, 'rb' )
+        self._mmap = mmap.mmap( self._file.fileno(), 0, access = mmap.ACCESS_READ )
+        buffer = memoryview( self._mmap )
+
+        magic, self.version, self.units_per_degree, self.n_paths, self.n_instructions = struct.unpack_from( BINARY_HEADER_FORMAT, buffer )
+        if magic != BINARY_MAGIC:
+            self.close()
+            raise ValueError( f"'{path}' is not a binary motor instructions file." )
+        if self.version not in _BINARY_VERSIONS:
+            self.close()
+            raise ValueError( f"'{path}' has unsupported version {self.version}." )
+
+        offsets_position = BINARY_HEADER_SIZE
+        instructions_position = offsets_position + 4 * ( self.n_paths + 1 )
+        self.path_offsets = np.frombuffer( buffer, dtype = '<u4', count = self.n_paths + 1, offset = offsets_position )
+        n_values = 3 if self.version in _END_SPEED_VERSIONS else 2
+        if self.version in _DELTA_ENCODED_VERSIONS:
+            values = _decode_delta( buffer, instructions_position, self.path_offsets.astype( np.int64 ), n_values )
+        else:
+            values = np.frombuffer(
+                buffer, dtype = '<i4', count = n_values * self.n_instructions, offset = instructions_position
+            ).reshape( -1, n_values )
+        self.target_units = values[ :, : 2 ]
+        self.end_speeds = values[ :, 2 ] if n_values == 3 else None
+        buffer.release()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ) -> None:
+        self.close()
+
+    def close( self ) -> None:
+        # Drops the views held by this object and closes the file.
+        # The memory map is only unmapped here if no caller still holds a view taken from this object.
+        # Otherwise close() does not raise, but the mapping stays open until the last such view is garbage collected,
+        # so copy what you need and drop your views before closing if the mapping has to be released right away.
+        self.path_offsets = None
+        self.target_units = None
+        self.end_speeds = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._file.close()
 
-    logging.info( f"Wrote motor instructions to file '{path}'" )
\ No newline at end of file
+    def to_pack( self ) -> MotorInstructionsArrayPack:
+        return MotorInstructionsArrayPack( self.target_units / self.units_per_degree, self.path_offsets )
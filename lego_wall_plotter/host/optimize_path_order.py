@@ -0,0 +1,222 @@
+import logging
+import time
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import CanvasArrayPack, CanvasPack, CanvasPoint
+
+
+"""
+Improves the order in which paths are drawn, to minimize the distance traveled with the pen up.
+The greedy ordering is a good start, but it only ever draws paths from start to end,
+and it can never undo an early bad choice.
+Here we can draw paths backwards, and apply 2-opt and Or-opt moves for as long as the time budget allows.
+
+The tour starts at the initial pen position and ends at the end of the last path.
+Internally the tour is represented by the order of the paths and whether each path is reversed,
+while the entry and exit points of every position in the tour are kept as complex numbers for fast distances.
+"""
+
+
+# improvements smaller than this (in mm) are not worth another iteration
+_MINIMUM_IMPROVEMENT_MM = 1e-6
+
+# the maximum number of successive paths to move at once during Or-opt
+_OR_OPT_MAX_SEGMENT_LENGTH = 3
+
+
+class _Tour:
+    # only the start and end point of every path matter, which are arrays of shape ( n_paths, 2 )
+    def __init__( self, path_starts : np.ndarray, path_ends : np.ndarray, start_point : CanvasPoint ):
+        self.start = complex( start_point.x, start_point.y )
+        self.path_starts = path_starts[ :, 0 ] + 1j * path_starts[ :, 1 ]
+        self.path_ends = path_ends[ :, 0 ] + 1j * path_ends[ :, 1 ]
+        self.order = np.arange( len( path_starts ) )
+        self.reversed = np.zeros( len( path_starts ), dtype = bool )
+        self.update_points()
+
+    def __len__( self ) -> int:
+        return len( self.order )
+
+    def update_points( self ) -> None:
+        starts = self.path_starts[ self.order ]
+        ends = self.path_ends[ self.order ]
+        self.entries = np.where( self.reversed, ends, starts )
+        self.exits = np.where( self.reversed, starts, ends )
+
+    def previous_exits( self ) -> np.ndarray:
+        # the point we come from before entering every position in the tour
+        return np.concatenate( ( [ self.start ], self.exits[ : -1 ] ) )
+
+    def pen_up_travel( self ) -> float:
+        if len( self ) == 0:
+            return 0.0
+        return float( np.abs( self.entries - self.previous_exits() ).sum() )
+
+
+def _orient_paths( tour : _Tour ) -> None:
+    # For a fixed order, find the optimal direction to draw every path in, using dynamic programming.
+    # The state is whether the path at a position is reversed,
+    # and we keep track of the cheapest travel to reach every state.
+    n = len( tour )
+    if n == 0:
+        return
+    order_starts = tour.path_starts[ tour.order ]
+    order_ends = tour.path_ends[ tour.order ]
+    entries = np.stack( ( order_starts, order_ends ), axis = 1 )
+    exits = np.stack( ( order_ends, order_starts ), axis = 1 )
+
+    costs = np.abs( entries[ 0 ] - tour.start )
+    choices = np.zeros( ( n, 2 ), dtype = int )
+    for k in range( 1, n ):
+        # transition cost from every previous state to every current state
+        transitions = costs[ :, None ] + np.abs( entries[ k ][ None, : ] - exits[ k - 1 ][ :, None ] )
+        choices[ k ] = np.argmin( transitions, axis = 0 )
+        costs = transitions[ choices[ k ], ( 0, 1 ) ]
+
+    state = int( np.argmin( costs ) )
+    reversed_states = np.zeros( n, dtype = bool )
+    for k in range( n - 1, -1, -1 ):
+        reversed_states[ k ] = state == 1
+        state = choices[ k ][ state ]
+
+    tour.reversed = reversed_states
+    tour.update_points()
+
+
+def _try_2_opt( tour : _Tour, i : int ) -> bool:
+    # Reverse the segment of positions i..j for the best j,
+    # which draws those paths in opposite order and opposite direction.
+    n = len( tour )
+    previous_exit = tour.start if i == 0 else tour.exits[ i - 1 ]
+    entry_i = tour.entries[ i ]
+    exits_j = tour.exits[ i : ]
+    next_entries = tour.entries[ i + 1 : ]
+
+    # the connection to the next path does not exist for the last position
+    old_next = np.append( np.abs( next_entries - exits_j[ : -1 ] ), 0.0 )
+    new_next = np.append( np.abs( next_entries - entry_i ), 0.0 )
+    deltas = ( np.abs( exits_j - previous_exit ) + new_next ) - ( np.abs( entry_i - previous_exit ) + old_next )
+
+    best = int( np.argmin( deltas ) )
+    if deltas[ best ] >= -_MINIMUM_IMPROVEMENT_MM:
+        return False
+
+    j = i + best
+    tour.order[ i : j + 1 ] = tour.order[ i : j + 1 ][ : : -1 ].copy()
+    tour.reversed[ i : j + 1 ] = ~tour.reversed[ i : j + 1 ][ : : -1 ]
+    tour.update_points()
+    return True
+
+
+def _try_or_opt( tour : _Tour, i : int, segment_length : int ) -> bool:
+    # Move the segment of positions i..i+segment_length-1 to the best other place in the tour,
+    # possibly reversing it.
+    n = len( tour )
+    last = i + segment_length - 1
+    if segment_length >= n or last >= n:
+        return False
+
+    previous_exits = tour.previous_exits()
+    segment_entry = tour.entries[ i ]
+    segment_exit = tour.exits[ last ]
+
+    # travel saved by taking the segment out of the tour
+    if last == n - 1:
+        removal_gain = abs( segment_entry - previous_exits[ i ] )
+    else:
+        removal_gain = (
+            abs( segment_entry - previous_exits[ i ] )
+            + abs( tour.entries[ last + 1 ] - segment_exit )
+            - abs( tour.entries[ last + 1 ] - previous_exits[ i ] )
+        )
+
+    # Travel added by inserting the segment in gap k, which lies before position k.
+    # Gap n is at the end of the tour, where there is no next path to connect to.
+    gap_froms = np.append( previous_exits, tour.exits[ -1 ] )
+    gap_tos = np.append( tour.entries, np.nan )
+    has_next = np.arange( n + 1 ) < n
+    old_gap = np.where( has_next, np.abs( gap_tos - gap_froms ), 0.0 )
+    forward = np.abs( segment_entry - gap_froms ) + np.where( has_next, np.abs( gap_tos - segment_exit ), 0.0 ) - old_gap
+    backward = np.abs( segment_exit - gap_froms ) + np.where( has_next, np.abs( gap_tos - segment_entry ), 0.0 ) - old_gap
+
+    # gaps touching the segment itself are not valid places to move it to
+    forward[ i : last + 2 ] = np.inf
+    backward[ i : last + 2 ] = np.inf
+
+    best_forward = int( np.argmin( forward ) )
+    best_backward = int( np.argmin( backward ) )
+    reverse_segment = backward[ best_backward ] < forward[ best_forward ]
+    gap = best_backward if reverse_segment else best_forward
+    insertion_cost = backward[ gap ] if reverse_segment else forward[ gap ]
+    if insertion_cost - removal_gain >= -_MINIMUM_IMPROVEMENT_MM:
+        return False
+
+    segment_order = tour.order[ i : last + 1 ]
+    segment_reversed = tour.reversed[ i : last + 1 ]
+    if reverse_segment:
+        segment_order = segment_order[ : : -1 ]
+        segment_reversed = ~segment_reversed[ : : -1 ]
+
+    remaining = np.r_[ 0 : i, last + 1 : n ]
+    # the gap index is in terms of the full tour, convert it to the tour without the segment
+    insert_at = gap if gap < i else gap - segment_length
+    tour.order = np.concatenate( ( tour.order[ remaining[ : insert_at ] ], segment_order, tour.order[ remaining[ insert_at : ] ] ) )
+    tour.reversed = np.concatenate( ( tour.reversed[ remaining[ : insert_at ] ], segment_reversed, tour.reversed[ remaining[ insert_at : ] ] ) )
+    tour.update_points()
+    return True
+
+
+def get_pen_up_travel( canvas_pack : CanvasPack | CanvasArrayPack, start_point : CanvasPoint ) -> float:
+    # total distance in mm traveled with the pen up, starting from start_point
+    canvas_pack = CanvasArrayPack.from_paths( canvas_pack )
+    return _Tour( canvas_pack.path_starts(), canvas_pack.path_ends(), start_point ).pen_up_travel()
+
+
+def optimize_path_order(
+        canvas_pack : CanvasPack | CanvasArrayPack,
+        start_point : CanvasPoint,
+        time_budget_s : float
+) -> CanvasArrayPack:
+    canvas_pack = CanvasArrayPack.from_paths( canvas_pack )
+    order, reversed_paths = optimize_path_order_for_endpoints( canvas_pack.path_starts(), canvas_pack.path_ends(), start_point, time_budget_s )
+    return canvas_pack.reordered( order, reversed_paths )
+
+
+def optimize_path_order_for_endpoints(
+        path_starts : np.ndarray,
+        path_ends : np.ndarray,
+        start_point : CanvasPoint,
+        time_budget_s : float
+) -> tuple[ np.ndarray, np.ndarray ]:
+    # Returns the new order of the paths, and whether every path in that order should be drawn backwards
+    # Only the endpoints are needed, so the paths themselves do not have to be in memory
+    logging.info( "Optimizing path order." )
+    start_time = time.perf_counter()
+    tour = _Tour( path_starts, path_ends, start_point )
+    pen_up_travel_before = tour.pen_up_travel()
+
+    def out_of_time() -> bool:
+        return time.perf_counter() - start_time > time_budget_s
+
+    _orient_paths( tour )
+
+    improved = True
+    while improved and not out_of_time():
+        improved = False
+        for i in range( len( tour ) ):
+            if out_of_time():
+                break
+            if _try_2_opt( tour, i ):
+                improved = True
+            for segment_length in range( 1, _OR_OPT_MAX_SEGMENT_LENGTH + 1 ):
+                if _try_or_opt( tour, i, segment_length ):
+                    improved = True
+
+    pen_up_travel_after = tour.pen_up_travel()
+    logging.info(
+        f"Optimizing path order - DONE! "
+        f"Pen-up travel went from {pen_up_travel_before:.1f}mm to {pen_up_travel_after:.1f}mm "
+        f"in {time.perf_counter() - start_time:.1f}s."
+    )
+    return tour.order, tour.reversed
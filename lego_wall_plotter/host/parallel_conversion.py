@@ -0,0 +1,171 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import math
+
+import numpy as np
+from svgpathtools import Path, Line, QuadraticBezier, CubicBezier, Arc
+
+from lego_wall_plotter.host.sample_svg_paths import sample_path, sample_path_adaptively
+
+
+"""
+Helpers to spread the conversion of independent paths over multiple processes.
+Pickling svgpathtools objects is slow and bulky,
+so paths are sent to the workers as compact arrays of segment data instead, in chunks of whole paths.
+Results are always collected in the order of the chunks, so the output does not depend on the number of workers.
+"""
+
+
+# every segment is stored as a type code and a row of 8 floats:
+# start, two control points, and end, each as x and y
+# Arcs store their radius as the first control point, and their rotation and flags as the second
+_SEGMENT_TYPES = [ Line, QuadraticBezier, CubicBezier, Arc ]
+_ARC_LARGE_ARC_FLAG = 1
+_ARC_SWEEP_FLAG = 2
+
+# every worker gets a couple of chunks, so a single chunk of complicated paths does not hold everyone up
+_CHUNKS_PER_WORKER = 4
+
+
+@dataclass
+class SerializedPaths:
+    # A chunk of paths as plain arrays, which are cheap to send to another process
+    # path i consists of the segments segment_offsets[ i ] : segment_offsets[ i + 1 ]
+    segment_types : np.ndarray
+    segment_data : np.ndarray
+    segment_offsets : np.ndarray
+
+
+def _serialize_segment( segment ) -> tuple[ int, list[ complex ] ]:
+    if isinstance( segment, Line ):
+        return 0, [ segment.start, 0, 0, segment.end ]
+    if isinstance( segment, QuadraticBezier ):
+        return 1, [ segment.start, segment.control, 0, segment.end ]
+    if isinstance( segment, CubicBezier ):
+        return 2, [ segment.start, segment.control1, segment.control2, segment.end ]
+    if isinstance( segment, Arc ):
+        flags = ( _ARC_LARGE_ARC_FLAG if segment.large_arc else 0 ) + ( _ARC_SWEEP_FLAG if segment.sweep else 0 )
+        return 3, [ segment.start, segment.radius, complex( segment.rotation, flags ), segment.end ]
+    raise TypeError( f"Unsupported segment type {type( segment ).__name__}." )
+
+
+def serialize_paths( paths : list[ Path ] ) -> SerializedPaths:
+    segment_types = []
+    segment_points = []
+    segment_offsets = [ 0 ]
+    for path in paths:
+        for segment in path:
+            segment_type, points = _serialize_segment( segment )
+            segment_types.append( segment_type )
+            segment_points.append( points )
+        segment_offsets.append( len( segment_types ) )
+
+    points = np.array( segment_points, dtype = complex ).reshape( -1, 4 )
+    segment_data = np.column_stack( ( points.real, points.imag ) )[ :, [ 0, 4, 1, 5, 2, 6, 3, 7 ] ]
+    return SerializedPaths(
+        np.array( segment_types, dtype = np.int8 ),
+        np.ascontiguousarray( segment_data ),
+        np.array( segment_offsets, dtype = np.int64 )
+    )
+
+
+def _deserialize_segment( segment_type : int, data : list[ float ] ):
+    start, p1, p2, end = [ complex( data[ i ], data[ i + 1 ] ) for i in range( 0, 8, 2 ) ]
+    cls = _SEGMENT_TYPES[ segment_type ]
+    if cls is Line:
+        return Line( start, end )
+    if cls is QuadraticBezier:
+        return QuadraticBezier( start, p1, end )
+    if cls is CubicBezier:
+        return CubicBezier( start, p1, p2, end )
+    flags = int( p2.imag )
+    return Arc( start, p1, p2.real, bool( flags & _ARC_LARGE_ARC_FLAG ), bool( flags & _ARC_SWEEP_FLAG ), end )
+
+
+def deserialize_paths( serialized_paths : SerializedPaths ) -> list[ Path ]:
+    segment_types = serialized_paths.segment_types.tolist()
+    segment_data = serialized_paths.segment_data.tolist()
+    offsets = serialized_paths.segment_offsets.tolist()
+    return [
+        Path( *[ _deserialize_segment( segment_types[ i ], segment_data[ i ] ) for i in range( start, end ) ] )
+        for start, end in zip( offsets[ : -1 ], offsets[ 1 : ] )
+    ]
+
+
+def _split_into_chunks( paths : list[ Path ], n_chunks : int ) -> list[ list[ Path ] ]:
+    # consecutive chunks with roughly the same number of segments,
+    # which is a reasonable estimate of the amount of work
+    n_segments = np.cumsum( [ len( path ) for path in paths ] )
+    if len( paths ) == 0:
+        return []
+    chunk_ends = np.searchsorted( n_segments, np.linspace( 0, n_segments[ -1 ], n_chunks + 1 )[ 1 : ], side = 'left' ) + 1
+    chunk_starts = np.concatenate( ( [ 0 ], chunk_ends[ : -1 ] ) )
+    return [ paths[ start : end ] for start, end in zip( chunk_starts.tolist(), chunk_ends.tolist() ) if end > start ]
+
+
+def _get_bounds_of_chunk( serialized_paths : SerializedPaths ) -> tuple[ float, float, float, float ]:
+    # the same as convert_svg.determine_svg_bounds, for a single chunk
+    bounds = [ math.inf, -math.inf, math.inf, -math.inf ]
+    for path in deserialize_paths( serialized_paths ):
+        if path.length() == 0:
+            continue
+        min_x, max_x, min_y, max_y = path.bbox()
+        bounds = [ min( bounds[ 0 ], min_x ), max( bounds[ 1 ], max_x ), min( bounds[ 2 ], min_y ), max( bounds[ 3 ], max_y ) ]
+    return bounds[ 0 ], bounds[ 1 ], bounds[ 2 ], bounds[ 3 ]
+
+
+def _sample_chunk( serialized_paths : SerializedPaths, sampling_distance : float, flatness_tolerance : float | None ) -> tuple[ np.ndarray, np.ndarray ]:
+    # the same as convert_svg.clean_svg_paths, for a single chunk
+    # the points of all paths are sent back as a single array, together with the number of points per path
+    path_arrays = []
+    for path in deserialize_paths( serialized_paths ):
+        if flatness_tolerance is None:
+            points = sample_path( path, sampling_distance )
+        else:
+            points = sample_path_adaptively( path, flatness_tolerance )
+        if len( points ) == 0:
+            continue
+        path_arrays.append( np.column_stack( ( points.real, points.imag ) ) )
+    if len( path_arrays ) == 0:
+        return np.empty( ( 0, 2 ) ), np.empty( 0, dtype = np.int64 )
+    return np.concatenate( path_arrays ), np.array( [ len( path_array ) for path_array in path_arrays ], dtype = np.int64 )
+
+
+class ParallelPathConverter:
+    # Serializes the paths once, and then runs the steps of the conversion on a pool of processes
+    # Use it as a context manager, so the pool is shut down afterwards
+
+    def __init__( self, paths : list[ Path ], max_workers : int ):
+        self.executor = ProcessPoolExecutor( max_workers = max_workers )
+        self.chunks = [ serialize_paths( chunk ) for chunk in _split_into_chunks( paths, max_workers * _CHUNKS_PER_WORKER ) ]
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.executor.shutdown()
+
+    def get_bounds( self ) -> tuple[ float, float, float, float ]:
+        chunk_bounds = list( self.executor.map( _get_bounds_of_chunk, self.chunks ) )
+        return (
+            min( [ math.inf ] + [ bounds[ 0 ] for bounds in chunk_bounds ] ),
+            max( [ -math.inf ] + [ bounds[ 1 ] for bounds in chunk_bounds ] ),
+            min( [ math.inf ] + [ bounds[ 2 ] for bounds in chunk_bounds ] ),
+            max( [ -math.inf ] + [ bounds[ 3 ] for bounds in chunk_bounds ] ),
+        )
+
+    def sample( self, sampling_distance : float, flatness_tolerance : float | None = None ) -> list[ np.ndarray ]:
+        # executor.map returns the results in the order of the chunks
+        n_chunks = len( self.chunks )
+        results = self.executor.map( _sample_chunk, self.chunks, [ sampling_distance ] * n_chunks, [ flatness_tolerance ] * n_chunks )
+        path_arrays = []
+        for coordinates, path_lengths in results:
+            path_arrays.extend( np.split( coordinates, np.cumsum( path_lengths )[ : -1 ] ) )
+        return path_arrays
+
+
+def split_into_path_chunks( path_offsets : np.ndarray, n_chunks : int ) -> np.ndarray:
+    # the point indices at which to split a pack into <n_chunks> consecutive chunks of whole paths,
+    # with roughly the same number of points each
+    targets = np.linspace( 0, path_offsets[ -1 ], n_chunks + 1 )[ 1 : -1 ]
+    return np.unique( path_offsets[ np.searchsorted( path_offsets, targets ) ] )
@@ -0,0 +1,102 @@
+import logging
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import MotorInstructionsArrayPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.motor_instructions_file import END_SPEED_MAX
+
+
+"""
+Plans how the Device moves through the instructions of a path.
+By default the Device brakes at every instruction, which means most of the time is spent accelerating and stopping.
+Here we determine an end speed for every instruction instead, which the Device can use to keep moving through points,
+and only brake where it really has to: at the end of every path, and at sharp corners.
+Both are decided here on the host, so the Device does not have to look ahead in the instructions.
+
+The end speeds form a trapezoidal velocity profile along every path:
+the speed through a point is limited by how much the path turns there,
+and the speed at every point is low enough to slow down to the speed limit of every point after it,
+and to speed up to it from every point before it, with the planned deceleration.
+All speeds are those of the leading motor, the one that has to turn the most, just like on the Device.
+"""
+
+
+def _get_turn_angles( motor_instructions_pack : MotorInstructionsArrayPack ) -> np.ndarray:
+    # For every instruction, how much the path turns there in radians, 0 is straight on and pi is turning back
+    # The first and last instruction of every path have only one neighbour, so they do not turn
+    # Instructions on top of one of their neighbours do not change the direction at all, so they do not turn either
+    degrees = motor_instructions_pack.coordinates
+    turn_angles = np.zeros( len( degrees ) )
+    if len( degrees ) < 3:
+        return turn_angles
+
+    incoming = degrees[ 1 : -1 ] - degrees[ : -2 ]
+    outgoing = degrees[ 2 : ] - degrees[ 1 : -1 ]
+    lengths = np.hypot( *incoming.T ) * np.hypot( *outgoing.T )
+    cos_angles = np.sum( incoming * outgoing, axis = 1 ) / np.where( lengths > 0, lengths, 1 )
+    turn_angles[ 1 : -1 ] = np.where( lengths > 0, np.arccos( np.clip( cos_angles, -1, 1 ) ), 0 )
+
+    # the neighbours of the first and last instruction of a path belong to other paths
+    path_lengths = motor_instructions_pack.path_lengths
+    turn_angles[ motor_instructions_pack.path_offsets[ : -1 ][ path_lengths > 0 ] ] = 0
+    turn_angles[ motor_instructions_pack.path_offsets[ 1 : ][ path_lengths > 0 ] - 1 ] = 0
+    return turn_angles
+
+
+def _get_squared_junction_speeds( turn_angles : np.ndarray, deceleration : float ) -> np.ndarray:
+    # The squared speed at which we can go through a point where the path turns, like the junction deviation in grbl:
+    # the speed at which we could follow a circular arc that touches both segments,
+    # and passes within the acceptance distance of the point, with the deceleration as centripetal acceleration
+    # Going straight on has no limit at all
+    cos_half_angles = np.cos( turn_angles / 2 )
+    junction_distance = Constants.POINT_REACHED_ERROR_ACCEPTANCE_DEGREES
+    with np.errstate( divide = 'ignore' ):
+        return deceleration * junction_distance * cos_half_angles / ( 1 - cos_half_angles )
+
+
+def get_end_speeds(
+        motor_instructions_pack : MotorInstructionsArrayPack,
+        corner_angle_degrees : float = Constants.CORNER_ANGLE_DEGREES,
+        deceleration : float = Constants.PLANNED_DECELERATION_DEG_PER_S2
+) -> np.ndarray:
+    # The Device brakes at the first instruction of every path, because the pen goes down there,
+    # at the last instruction, because the pen goes up there, and at every corner.
+    # Everywhere else the end speed follows the planned velocity profile.
+    # Everything is computed in squared speeds, which change linearly with the distance at a constant deceleration.
+    logging.info( "Planning motion." )
+    degrees = motor_instructions_pack.coordinates
+    path_lengths = motor_instructions_pack.path_lengths
+    turn_angles = _get_turn_angles( motor_instructions_pack )
+
+    squared_speed_limits = np.minimum( _get_squared_junction_speeds( turn_angles, deceleration ), Constants.MAX_DEG_PER_S ** 2 )
+    squared_speed_limits[ turn_angles > np.radians( corner_angle_degrees ) ] = 0
+    squared_speed_limits[ motor_instructions_pack.path_offsets[ : -1 ][ path_lengths > 0 ] ] = 0
+    squared_speed_limits[ motor_instructions_pack.path_offsets[ 1 : ][ path_lengths > 0 ] - 1 ] = 0
+
+    # the distance of the leading motor from the first instruction, to every instruction
+    # This runs on through the moves between paths, but those do not matter, since we stop at the ends of every path anyway
+    leading_distances = np.zeros( len( degrees ) )
+    if len( degrees ) > 1:
+        np.cumsum( np.max( np.abs( np.diff( degrees, axis = 0 ) ), axis = 1 ), out = leading_distances[ 1 : ] )
+
+    # the squared speed at instruction i, from which we can still slow down to the limit of every instruction j after it:
+    # the minimum of limit[ j ] + 2 * deceleration * ( distance[ j ] - distance[ i ] ), which is a cumulative minimum from the back
+    reachable = squared_speed_limits + 2 * deceleration * leading_distances
+    squared_speeds = np.minimum.accumulate( reachable[ : : -1 ] )[ : : -1 ] - 2 * deceleration * leading_distances
+
+    # and the same for speeding up from every instruction before it, which is a cumulative minimum from the front
+    reachable = squared_speeds - 2 * deceleration * leading_distances
+    squared_speeds = np.minimum.accumulate( reachable ) + 2 * deceleration * leading_distances
+
+    # round down to a speed that the Device can actually set, which is a whole percentage of motor power
+    # ( with a little margin, so the maximum speed does not get rounded down )
+    speeds = np.sqrt( np.maximum( squared_speeds, 0 ) )
+    speeds = np.floor( speeds * Constants.POWER_PER_DEGREE_PER_SECOND + 1e-9 ) / Constants.POWER_PER_DEGREE_PER_SECOND
+    end_speeds = np.floor( speeds / Constants.MAX_DEG_PER_S * END_SPEED_MAX ).astype( np.int64 )
+
+    logging.info(
+        f"Planning motion - DONE! Braking at {np.count_nonzero( end_speeds == 0 )}/{len( end_speeds )} instructions, "
+        f"the average end speed is {speeds.mean() if len( speeds ) > 0 else 0:.0f} degrees per second."
+    )
+    return end_speeds
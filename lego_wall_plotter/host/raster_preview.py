@@ -0,0 +1,137 @@
+import logging
+from pathlib import Path
+import struct
+import webbrowser
+import zlib
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import BoardArrayPack, BoardPack, CanvasArrayPack, CanvasPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.make_preview import _get_anchors, _get_board, _get_canvas
+from lego_wall_plotter.host.mock_plotter import make_plot_pack_for_motor_instructions_file
+
+
+"""
+Previews rasterized straight to a PNG, as a fast alternative to the SVG previews in make_preview.py.
+The SVG previews contain an element for every segment, which makes them slow to create,
+and so heavy for dense drawings that browsers can hardly show them.
+Here all segments are drawn at once with NumPy, by sampling every segment at (at least) every pixel it crosses,
+and the image is written with nothing but zlib, so this does not need an imaging library.
+
+The image shows the whole board, with the anchors and the canvas, in board space with y pointing down.
+Optionally the travel between paths, while the pen is up, is drawn in a separate colour.
+"""
+
+
+_BACKGROUND_COLOUR = ( 255, 255, 255 )
+_SCENE_COLOUR = ( 160, 160, 160 )
+_PLOT_COLOUR = ( 0, 0, 0 )
+_TRAVEL_COLOUR = ( 255, 140, 140 )
+
+# the maximum number of pixels to sample at once, which bounds the memory needed for drawing
+_CHUNK_SIZE_PIXELS = 1 << 22
+
+
+def _write_png( filename : str, image : np.ndarray ) -> None:
+    # image is an array of shape ( height, width, 3 ) of 8-bit RGB colours
+    height, width, _ = image.shape
+
+    def chunk( chunk_type : bytes, data : bytes ) -> bytes:
+        return struct.pack( '>I', len( data ) ) + chunk_type + data + struct.pack( '>I', zlib.crc32( chunk_type + data ) )
+
+    # every row starts with the filter type, 0 means the row is stored as it is
+    rows = np.concatenate( ( np.zeros( ( height, 1 ), dtype = np.uint8 ), image.reshape( height, width * 3 ) ), axis = 1 )
+    with open( filename, 'wb' ) as f:
+        f.write( b'\x89PNG\r\n\x1a\n' )
+        f.write( chunk( b'IHDR', struct.pack( '>IIBBBBB', width, height, 8, 2, 0, 0, 0 ) ) )
+        f.write( chunk( b'IDAT', zlib.compress( rows.tobytes(), 6 ) ) )
+        f.write( chunk( b'IEND', b'' ) )
+
+
+def _draw_segments( image : np.ndarray, starts : np.ndarray, ends : np.ndarray, colour : tuple[ int, int, int ] ) -> None:
+    # starts and ends are arrays of shape ( n, 2 ) in pixels
+    # Every segment is sampled at least once per pixel along its longest axis, which leaves no gaps in the line
+    # Segments far outside the image are sampled no more than a segment across the whole image would be
+    height, width, _ = image.shape
+    n_samples = np.ceil( np.max( np.abs( ends - starts ), axis = 1 ) ).astype( np.int64 ) + 1
+    np.minimum( n_samples, width + height, out = n_samples )
+
+    # draw chunks of whole segments, with a bounded number of samples each
+    sample_offsets = np.concatenate( ( [ 0 ], np.cumsum( n_samples ) ) )
+    chunk_starts = [ 0 ]
+    while chunk_starts[ -1 ] < len( n_samples ):
+        next_start = int( np.searchsorted( sample_offsets, sample_offsets[ chunk_starts[ -1 ] ] + _CHUNK_SIZE_PIXELS, side = 'right' ) ) - 1
+        chunk_starts.append( max( next_start, chunk_starts[ -1 ] + 1 ) )
+
+    for first, last in zip( chunk_starts[ : -1 ], chunk_starts[ 1 : ] ):
+        chunk_n_samples = n_samples[ first : last ]
+        segments = np.repeat( np.arange( first, last ), chunk_n_samples )
+        steps = np.arange( len( segments ) ) - ( sample_offsets[ segments ] - sample_offsets[ first ] )
+        t = steps / np.maximum( n_samples[ segments ] - 1, 1 )
+        points = np.rint( starts[ segments ] + t[ :, None ] * ( ends[ segments ] - starts[ segments ] ) ).astype( np.int64 )
+
+        inside = ( points[ :, 0 ] >= 0 ) & ( points[ :, 0 ] < width ) & ( points[ :, 1 ] >= 0 ) & ( points[ :, 1 ] < height )
+        image[ points[ inside, 1 ], points[ inside, 0 ] ] = colour
+
+
+def _get_path_segments( pack : BoardArrayPack ) -> tuple[ np.ndarray, np.ndarray ]:
+    # the segments between successive points of the same path,
+    # and a segment from the point to itself for paths of a single point, so those show up as a dot
+    coordinates = pack.coordinates
+    within_path = np.ones( max( len( coordinates ) - 1, 0 ), dtype = bool )
+    within_path[ pack.path_offsets[ 1 : -1 ] - 1 ] = False
+    single_points = pack.path_offsets[ : -1 ][ pack.path_lengths == 1 ]
+    starts = np.concatenate( ( coordinates[ : -1 ][ within_path ], coordinates[ single_points ] ) )
+    ends = np.concatenate( ( coordinates[ 1 : ][ within_path ], coordinates[ single_points ] ) )
+    return starts, ends
+
+
+def make_raster_preview_for_pack(
+        pack : BoardPack | BoardArrayPack,
+        out_filename : str,
+        open_in_browser : bool = True,
+        show_travel : bool = True,
+        pixels_per_mm : float = Constants.PREVIEW_PIXELS_PER_MM
+) -> None:
+    # the pack is drawn on top of the board, the anchors and the canvas
+    pack = BoardArrayPack.from_paths( pack )
+    width = int( np.ceil( Constants.BOARD_SIZE_MM[ 0 ] * pixels_per_mm ) ) + 1
+    height = int( np.ceil( Constants.BOARD_SIZE_MM[ 1 ] * pixels_per_mm ) ) + 1
+    image = np.empty( ( height, width, 3 ), dtype = np.uint8 )
+    image[ : ] = _BACKGROUND_COLOUR
+
+    scene = BoardArrayPack.concatenate( [ _get_board(), _get_anchors(), _get_canvas() ] )
+    _draw_segments( image, *( segments * pixels_per_mm for segments in _get_path_segments( scene ) ), _SCENE_COLOUR )
+
+    # the travel goes from the end of every path to the start of the next one
+    if show_travel and len( pack ) > 1:
+        _draw_segments( image, pack.path_ends()[ : -1 ] * pixels_per_mm, pack.path_starts()[ 1 : ] * pixels_per_mm, _TRAVEL_COLOUR )
+    _draw_segments( image, *( segments * pixels_per_mm for segments in _get_path_segments( pack ) ), _PLOT_COLOUR )
+
+    _write_png( out_filename, image )
+    logging.info( f"Wrote raster preview to {out_filename}." )
+    if open_in_browser:
+        webbrowser.open( Path( out_filename ).absolute().as_uri() )
+
+
+def make_raster_preview_for_canvas_pack(
+        canvas_pack : CanvasPack | CanvasArrayPack,
+        out_filename : str,
+        open_in_browser : bool = True,
+        show_travel : bool = True
+) -> None:
+    # the canvas pack is shown where it will end up on the board
+    canvas_pack = CanvasArrayPack.from_paths( canvas_pack )
+    board_pack = BoardArrayPack( np.add( Constants.CANVAS_OFFSET_TO_BOARD_MM, canvas_pack.coordinates ), canvas_pack.path_offsets )
+    make_raster_preview_for_pack( board_pack, out_filename, open_in_browser, show_travel )
+
+
+def make_raster_preview_for_motor_instructions(
+        motor_instructions_file : str,
+        out_filename : str,
+        open_in_browser : bool = True,
+        show_travel : bool = True
+) -> None:
+    plot = make_plot_pack_for_motor_instructions_file( motor_instructions_file )
+    make_raster_preview_for_pack( plot, out_filename, open_in_browser, show_travel )
@@ -0,0 +1,333 @@
+import math
+
+import numpy as np
+from svgpathtools import Path, Line, QuadraticBezier, CubicBezier, Arc
+
+
+"""
+Vectorized sampling of svgpathtools Paths.
+Calling Path.point once per sample from Python is slow for dense SVGs,
+so here we evaluate a whole array of parameters per segment in a single NumPy call.
+Points are represented as complex numbers, just like svgpathtools does.
+"""
+
+
+# relative tolerance on the slope angle to consider two successive moves to be collinear
+COLLINEAR_SLOPE_RELATIVE_TOLERANCE = 1e-3
+
+# adaptive sampling starts with this many intervals per path
+ADAPTIVE_SAMPLING_INITIAL_INTERVALS = 1
+ADAPTIVE_SAMPLING_MAX_DEPTH = 24
+ADAPTIVE_SAMPLING_MAX_ANGLE_DEGREES = 45
+
+
+def get_segment_points( segment, t : np.ndarray ) -> np.ndarray:
+    # Evaluate a single segment for an array of local parameters t in [0, 1]
+    # The formulas are the same as the ones in the respective svgpathtools point() methods
+
+    if isinstance( segment, Line ):
+        return segment.start + ( segment.end - segment.start ) * t
+
+    if isinstance( segment, QuadraticBezier ):
+        tc = 1 - t
+        return tc * tc * segment.start + 2 * tc * t * segment.control + t * t * segment.end
+
+    if isinstance( segment, CubicBezier ):
+        # Horner's rule
+        p0, p1, p2, p3 = segment.start, segment.control1, segment.control2, segment.end
+        return p0 + t * (
+            3 * ( p1 - p0 ) + t * (
+                3 * ( p0 + p2 ) - 6 * p1 + t * (
+                    -p0 + 3 * ( p1 - p2 ) + p3
+                )))
+
+    if isinstance( segment, Arc ):
+        angle = np.radians( segment.theta + t * segment.delta )
+        cos_phi = segment.rot_matrix.real
+        sin_phi = segment.rot_matrix.imag
+        rx = segment.radius.real
+        ry = segment.radius.imag
+        cos_angle = np.cos( angle )
+        sin_angle = np.sin( angle )
+        x = rx * cos_phi * cos_angle - ry * sin_phi * sin_angle + segment.center.real
+        y = rx * sin_phi * cos_angle + ry * cos_phi * sin_angle + segment.center.imag
+        return x + 1j * y
+
+    raise TypeError( f"Unsupported segment type {type( segment ).__name__}." )
+
+
+def _get_segment_ends( path : Path ) -> np.ndarray | None:
+    # The global parameter T at which every segment ends,
+    # or None if the path has no length at all
+    # Computing segment lengths is relatively expensive, so callers evaluating a path repeatedly should reuse these
+
+    segment_lengths = np.array( [ segment.length() for segment in path ], dtype = float )
+    total_length = segment_lengths.sum()
+    if total_length == 0:
+        return None
+    return np.cumsum( segment_lengths / total_length )
+
+
+def get_path_points( path : Path, T : np.ndarray, segment_ends : np.ndarray | None = None ) -> np.ndarray:
+    # Evaluate a Path for an array of global parameters T in [0, 1]
+    # Like Path.point, T is distributed over the segments proportionally to their lengths
+
+    if segment_ends is None:
+        segment_ends = _get_segment_ends( path )
+    if segment_ends is None:
+        return np.full( len( T ), path[ 0 ].start, dtype = complex )
+
+    segment_starts = np.concatenate( ( [ 0.0 ], segment_ends[ : -1 ] ) )
+
+    # the first segment that ends at or after T is the one that contains T
+    indices = np.searchsorted( segment_ends, T, side = 'left' )
+    indices = np.minimum( indices, len( path ) - 1 )
+
+    local_t = np.zeros( len( T ), dtype = float )
+    spans = segment_ends[ indices ] - segment_starts[ indices ]
+    nonzero = spans > 0
+    local_t[ nonzero ] = ( T[ nonzero ] - segment_starts[ indices[ nonzero ] ] ) / spans[ nonzero ]
+    local_t = np.clip( local_t, 0, 1 )
+
+    points = np.empty( len( T ), dtype = complex )
+    for index in np.unique( indices ):
+        mask = indices == index
+        points[ mask ] = get_segment_points( path[ index ], local_t[ mask ] )
+
+    # just like Path.point we use the exact start and end of the path
+    points[ T == 0 ] = path[ 0 ].start
+    points[ T == 1 ] = path[ -1 ].end
+    return points
+
+
+def _is_close( a : np.ndarray, b : np.ndarray ) -> np.ndarray:
+    # vectorized equivalent of math.isclose( a, b, rel_tol = COLLINEAR_SLOPE_RELATIVE_TOLERANCE )
+    return np.abs( a - b ) <= COLLINEAR_SLOPE_RELATIVE_TOLERANCE * np.maximum( np.abs( a ), np.abs( b ) )
+
+
+def remove_collinear_points( points : np.ndarray ) -> np.ndarray:
+    # Successive moves with the same slope form a single straight run,
+    # of which we only need to keep the first and the last point.
+    # A move continues a run if its slope is close to the slope of the move that started the run,
+    # so that slowly bending curves are not collapsed into a single line.
+
+    if len( points ) < 3:
+        return points
+
+    moves = np.diff( points )
+    slopes = np.arctan2( moves.imag, moves.real )
+    indices = np.arange( len( slopes ) )
+
+    # first guess: a run starts wherever the slope differs from the previous move
+    run_starts = np.ones( len( slopes ), dtype = bool )
+    run_starts[ 1: ] = ~_is_close( slopes[ :-1 ], slopes[ 1: ] )
+
+    # then split runs that drifted too far from the slope they started with
+    # only the first violation in every run is a guaranteed new start, so we repeat until nothing changes
+    while True:
+        run_start_indices = np.maximum.accumulate( np.where( run_starts, indices, 0 ) )
+        drifted = ~run_starts & ~_is_close( slopes, slopes[ run_start_indices ] )
+        if not drifted.any():
+            break
+        drifted_indices = np.flatnonzero( drifted )
+        _, first_per_run = np.unique( run_start_indices[ drifted_indices ], return_index = True )
+        run_starts[ drifted_indices[ first_per_run ] ] = True
+
+    # keep the start point of every run, and the very last point
+    keep = np.append( run_starts, True )
+    return points[ keep ]
+
+
+def sample_path( path : Path, sampling_distance : float ) -> np.ndarray:
+    # Sample a Path at (at most) every <sampling_distance>, and drop points on straight lines
+    # Returns an empty array if the path has no length
+
+    steps = math.ceil( path.length() / sampling_distance )
+    if steps == 0:
+        return np.empty( 0, dtype = complex )
+
+    T = np.arange( steps + 1 ) / steps
+    points = get_path_points( path, T )
+    return remove_collinear_points( points )
+
+
+def _get_distances_to_chords( chord_starts : np.ndarray, chord_ends : np.ndarray, points : np.ndarray ) -> np.ndarray:
+    # distance of every point to the line segment between its chord start and end
+    # Note that the distance to the infinite line is not enough,
+    # as thin loops can run far past the ends of their chord
+    chords = chord_ends - chord_starts
+    offsets = points - chord_starts
+    squared_chord_lengths = np.abs( chords ) ** 2
+    t = ( offsets * np.conj( chords ) ).real / np.where( squared_chord_lengths > 0, squared_chord_lengths, 1 )
+    return np.abs( offsets - np.clip( t, 0, 1 ) * chords )
+
+
+def _get_turning_angles( p0 : np.ndarray, p1 : np.ndarray, p2 : np.ndarray ) -> np.ndarray:
+    # the angle in radians between the move p0 -> p1 and the move p1 -> p2
+    return np.abs( np.angle( ( p2 - p1 ) * np.conj( p1 - p0 ) ) )
+
+
+def _get_control_points( path : Path ) -> tuple[ np.ndarray, np.ndarray ]:
+    # The control points of every segment as a cubic Bezier, shape ( n_segments, 4 ),
+    # lines and quadratic Beziers are raised to cubics exactly, so the same bound works for all of them
+    # Arcs are not Beziers at all, so for those only the ends are filled in and the mask is True
+    control_points = np.empty( ( len( path ), 4 ), dtype = complex )
+    is_arc = np.zeros( len( path ), dtype = bool )
+    for index, segment in enumerate( path ):
+        if isinstance( segment, Line ):
+            move = segment.end - segment.start
+            control_points[ index ] = ( segment.start, segment.start + move / 3, segment.start + 2 * move / 3, segment.end )
+        elif isinstance( segment, QuadraticBezier ):
+            control_points[ index ] = (
+                segment.start,
+                segment.start + 2 / 3 * ( segment.control - segment.start ),
+                segment.end + 2 / 3 * ( segment.control - segment.end ),
+                segment.end
+            )
+        elif isinstance( segment, CubicBezier ):
+            control_points[ index ] = ( segment.start, segment.control1, segment.control2, segment.end )
+        elif isinstance( segment, Arc ):
+            control_points[ index ] = ( segment.start, segment.start, segment.end, segment.end )
+            is_arc[ index ] = True
+        else:
+            raise TypeError( f"Unsupported segment type {type( segment ).__name__}." )
+    return control_points, is_arc
+
+
+def _get_sub_control_points( control_points : np.ndarray, a : np.ndarray, b : np.ndarray ) -> np.ndarray:
+    # The control points of the parts of the cubic Beziers between local parameters a and b,
+    # which are the blossoms ( a, a, a ), ( a, a, b ), ( a, b, b ) and ( b, b, b ), computed with de Casteljau
+    def blossom( u1, u2, u3 ):
+        level = control_points
+        for u in ( u1, u2, u3 ):
+            level = ( 1 - u[ :, None ] ) * level[ :, : -1 ] + u[ :, None ] * level[ :, 1 : ]
+        return level[ :, 0 ]
+    return np.stack( [ blossom( a, a, a ), blossom( a, a, b ), blossom( a, b, b ), blossom( b, b, b ) ], axis = 1 )
+
+
+def _get_max_arc_radii_and_sweeps( path : Path, is_arc : np.ndarray ) -> tuple[ np.ndarray, np.ndarray ]:
+    # for every arc the largest radius and the absolute sweep in radians, zero for all other segments
+    radii = np.zeros( len( path ) )
+    sweeps = np.zeros( len( path ) )
+    for index in np.flatnonzero( is_arc ):
+        radii[ index ] = max( abs( path[ index ].radius.real ), abs( path[ index ].radius.imag ) )
+        sweeps[ index ] = abs( math.radians( path[ index ].delta ) )
+    return radii, sweeps
+
+
+def _get_deviation_bounds(
+        T : np.ndarray,
+        p0 : np.ndarray,
+        p1 : np.ndarray,
+        segment_ends : np.ndarray,
+        control_points : np.ndarray,
+        is_arc : np.ndarray,
+        arc_radii : np.ndarray,
+        arc_sweeps : np.ndarray
+) -> np.ndarray:
+    # An upper bound on the distance between the curve and the chord p0 -> p1, for every interval of T
+    # Every interval is cut into the parts of the segments that it spans.
+    # A part of a Bezier lies within the convex hull of its own control points,
+    # and the distance to a line segment is convex, so the largest distance of those control points is a bound.
+    # A part of an arc lies within its sagitta of the chord between its ends, which gives a bound just the same.
+    # Unlike checking the curve at a couple of points, this guarantees that no bulge is missed.
+    n_segments = len( segment_ends )
+    segment_starts = np.concatenate( ( [ 0.0 ], segment_ends[ : -1 ] ) )
+    T0 = T[ : -1 ]
+    T1 = T[ 1 : ]
+
+    # the first segment that ends after T0, up to the first segment that ends at or after T1
+    first_segments = np.minimum( np.searchsorted( segment_ends, T0, side = 'right' ), n_segments - 1 )
+    last_segments = np.maximum( np.minimum( np.searchsorted( segment_ends, T1, side = 'left' ), n_segments - 1 ), first_segments )
+    n_parts = last_segments - first_segments + 1
+    intervals = np.repeat( np.arange( len( T0 ) ), n_parts )
+    segments = first_segments[ intervals ] + np.arange( len( intervals ) ) - np.repeat( np.cumsum( n_parts ) - n_parts, n_parts )
+
+    spans = segment_ends[ segments ] - segment_starts[ segments ]
+    nonzero = spans > 0
+    safe_spans = np.where( nonzero, spans, 1 )
+    a = np.where( nonzero, np.clip( ( T0[ intervals ] - segment_starts[ segments ] ) / safe_spans, 0, 1 ), 0 )
+    b = np.where( nonzero, np.clip( ( T1[ intervals ] - segment_starts[ segments ] ) / safe_spans, 0, 1 ), 0 )
+
+    parts = _get_sub_control_points( control_points[ segments ], a, b )
+    part_bounds = _get_distances_to_chords( p0[ intervals, None ], p1[ intervals, None ], parts ).max( axis = 1 )
+
+    # for arcs only the ends of the parts are exact, the rest is covered by the sagitta
+    # Beyond half a turn the sagitta no longer bounds the arc, but the diameter still does
+    arc_parts = is_arc[ segments ]
+    if arc_parts.any():
+        radii = arc_radii[ segments[ arc_parts ] ]
+        sweeps = arc_sweeps[ segments[ arc_parts ] ] * ( b[ arc_parts ] - a[ arc_parts ] )
+        sagittas = np.where( sweeps <= math.pi, radii * ( 1 - np.cos( sweeps / 2 ) ), 2 * radii )
+        part_bounds[ arc_parts ] += sagittas
+
+    bounds = np.zeros( len( T0 ) )
+    np.maximum.at( bounds, intervals, part_bounds )
+    return bounds
+
+
+def _get_corner_parameters( path : Path, segment_ends : np.ndarray, max_angle : float ) -> np.ndarray:
+    # The global parameters of the joints between segments where the path makes a sharp turn
+    # Adaptive sampling always keeps these, so corners are never cut off
+    # The directions are determined from tiny steps, as tangents are undefined for degenerate curves
+    step = 1e-6
+    directions_in = np.array( [ np.diff( get_segment_points( segment, np.array( [ 1 - step, 1 ] ) ) )[ 0 ] for segment in path[ : -1 ] ] )
+    directions_out = np.array( [ np.diff( get_segment_points( segment, np.array( [ 0, step ] ) ) )[ 0 ] for segment in path[ 1 : ] ] )
+    if len( directions_in ) == 0:
+        return np.empty( 0 )
+    turning_angles = np.abs( np.angle( directions_out * np.conj( directions_in ) ) )
+    return segment_ends[ : -1 ][ turning_angles > max_angle ]
+
+
+def sample_path_adaptively(
+        path : Path,
+        flatness_tolerance : float,
+        max_angle_degrees : float = ADAPTIVE_SAMPLING_MAX_ANGLE_DEGREES
+) -> np.ndarray:
+    # Sample a Path with as few points as possible, instead of at a fixed distance:
+    # an interval is split in half if the curve may deviate more than <flatness_tolerance> from the chord between its ends,
+    # or if the curve turns more than <max_angle_degrees> within it.
+    # Straight-ish parts thus get few points, while tight curves get many.
+    # The intervals span the whole path, so runs of tiny segments do not each cost points of their own.
+    # The deviation is bounded rather than measured, see _get_deviation_bounds,
+    # so the polyline through the points is guaranteed to stay within <flatness_tolerance> of the curve,
+    # unless ADAPTIVE_SAMPLING_MAX_DEPTH is reached first.
+    # That is also why collinear points are not removed here, as doing so can move the polyline away from the curve.
+    # All intervals of the same depth are checked at once.
+    # Returns an empty array if the path has no length, just like sample_path
+
+    segment_ends = _get_segment_ends( path )
+    if segment_ends is None:
+        return np.empty( 0, dtype = complex )
+
+    max_angle = math.radians( max_angle_degrees )
+    control_points, is_arc = _get_control_points( path )
+    arc_radii, arc_sweeps = _get_max_arc_radii_and_sweeps( path, is_arc )
+
+    # start with as few intervals as possible, already split at the corners
+    # Note that closed paths start out with a chord of zero length, which simply results in a split
+    T = np.linspace( 0, 1, ADAPTIVE_SAMPLING_INITIAL_INTERVALS + 1 )
+    T = np.unique( np.concatenate( ( T, _get_corner_parameters( path, segment_ends, max_angle ) ) ) )
+    for _ in range( ADAPTIVE_SAMPLING_MAX_DEPTH ):
+        T0 = T[ : -1 ]
+        T1 = T[ 1 : ]
+        T_mid = 0.5 * ( T0 + T1 )
+        p0 = get_path_points( path, T0, segment_ends )
+        p1 = get_path_points( path, T1, segment_ends )
+        p_mid = get_path_points( path, T_mid, segment_ends )
+
+        deviations = _get_deviation_bounds( T, p0, p1, segment_ends, control_points, is_arc, arc_radii, arc_sweeps )
+
+        turning_angles = _get_turning_angles( p0, p_mid, p1 )
+        # turning within an interval shorter than the tolerance is not visible in the drawing anyway
+        too_curved = ( turning_angles > max_angle ) & ( np.abs( p1 - p0 ) > flatness_tolerance )
+        split = ( deviations > flatness_tolerance ) | too_curved
+        if not split.any():
+            break
+        T = np.sort( np.concatenate( ( T, T_mid[ split ] ) ) )
+
+    points = get_path_points( path, T, segment_ends )
+    # only drop points that coincide with the previous one, which happens around segments of zero length
+    keep = np.ones( len( points ), dtype = bool )
+    keep[ 1 : ] = points[ 1 : ] != points[ : -1 ]
+    return points[ keep ]
@@ -0,0 +1,98 @@
+import logging
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import MotorInstructionsArrayPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.make_motor_instructions import get_initial_degrees
+from lego_wall_plotter.host.mock_plotter import (
+    _get_board_coordinates_for_rope_lengths,
+    _get_target_rope_lengths_for_motor_instructions,
+)
+
+
+"""
+Douglas-Peucker style simplification of MotorInstructionsPacks.
+The Device moves both motors proportionally, so between two instructions it moves in a straight line in degrees,
+which is a curve on the board.
+Instead of simplifying the points on the board, we therefore simplify the instructions in degree space,
+and measure the error on the board with the same forward kinematics as the mock plotter.
+Every instruction we can drop is one less stop-and-brake cycle on the Device.
+"""
+
+
+def _get_board_coordinates_for_degrees( degrees : np.ndarray ) -> np.ndarray:
+    rope_lengths = _get_target_rope_lengths_for_motor_instructions( degrees, get_initial_degrees() )
+    return _get_board_coordinates_for_rope_lengths( rope_lengths )
+
+
+def _get_deviations(
+        degrees : np.ndarray,
+        board_coordinates : np.ndarray,
+        candidates : np.ndarray,
+        previous_kept : np.ndarray,
+        next_kept : np.ndarray
+) -> np.ndarray:
+    # For every candidate instruction, the distance on the board between where it would have taken the pen,
+    # and where the pen goes instead when moving straight (in degrees) from the previous to the next kept instruction.
+    # We compare against the point of that move that is closest in degree space.
+    # This is not necessarily the closest point on the board, so the deviation is never underestimated.
+    chord_starts = degrees[ previous_kept ]
+    chords = degrees[ next_kept ] - chord_starts
+    squared_chord_lengths = np.sum( chords ** 2, axis = 1 )
+    t = np.sum( ( degrees[ candidates ] - chord_starts ) * chords, axis = 1 ) / np.where( squared_chord_lengths > 0, squared_chord_lengths, 1 )
+    t = np.clip( t, 0, 1 )
+    drawn_coordinates = _get_board_coordinates_for_degrees( chord_starts + t[ :, None ] * chords )
+    return np.hypot( *( drawn_coordinates - board_coordinates[ candidates ] ).T )
+
+
+def simplify_motor_instructions(
+        motor_instructions_pack : MotorInstructionsArrayPack,
+        tolerance_mm : float = Constants.QUALITY_THRESHOLD_DISTANCE_VALUE
+) -> MotorInstructionsArrayPack:
+    # Drop every instruction that can be dropped,
+    # while keeping the drawn curve within <tolerance_mm> of the instructions we were given.
+    # Just like Douglas-Peucker we start with only the first and last instruction of every path,
+    # and keep adding the instruction that deviates most from its interval, until all deviations are within tolerance.
+    # Every round handles all intervals of all paths at once.
+
+    logging.info( "Simplifying motor instructions." )
+    degrees = motor_instructions_pack.coordinates
+    path_offsets = motor_instructions_pack.path_offsets
+    n_instructions = len( degrees )
+    if n_instructions == 0:
+        return motor_instructions_pack
+
+    board_coordinates = _get_board_coordinates_for_degrees( degrees )
+    indices = np.arange( n_instructions )
+
+    keep = np.zeros( n_instructions, dtype = bool )
+    non_empty_paths = path_offsets[ 1 : ] > path_offsets[ : -1 ]
+    keep[ path_offsets[ : -1 ][ non_empty_paths ] ] = True
+    keep[ path_offsets[ 1 : ][ non_empty_paths ] - 1 ] = True
+
+    # instructions in intervals that are within tolerance never have to be checked again
+    settled = keep.copy()
+    while not settled.all():
+        # the kept instructions surrounding every instruction,
+        # as every path starts and ends with a kept instruction, these never cross paths
+        previous_kept = np.maximum.accumulate( np.where( keep, indices, 0 ) )
+        next_kept = np.minimum.accumulate( np.where( keep, indices, n_instructions - 1 )[ : : -1 ] )[ : : -1 ]
+
+        candidates = np.flatnonzero( ~settled )
+        intervals = previous_kept[ candidates ]
+        deviations = _get_deviations( degrees, board_coordinates, candidates, intervals, next_kept[ candidates ] )
+
+        # keep the worst deviating candidate of every interval that is not within tolerance yet
+        too_far = deviations > tolerance_mm
+        order = np.lexsort( ( -deviations[ too_far ], intervals[ too_far ] ) )
+        split_intervals, first_per_interval = np.unique( intervals[ too_far ][ order ], return_index = True )
+        keep[ candidates[ too_far ][ order[ first_per_interval ] ] ] = True
+        settled[ candidates[ ~np.isin( intervals, split_intervals ) ] ] = True
+        settled |= keep
+
+    # the offsets of the paths in the simplified pack
+    kept_before = np.concatenate( ( [ 0 ], np.cumsum( keep ) ) )
+    simplified_pack = MotorInstructionsArrayPack( degrees[ keep ], kept_before[ path_offsets ] )
+    logging.info( f"Simplifying motor instructions - DONE. Kept {simplified_pack.n_points}/{n_instructions} instructions." )
+    return simplified_pack
@@ -0,0 +1,68 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+"""
+A spatial index for nearest neighbour queries on a set of points that shrinks over time.
+This is what makes greedy orderings fast:
+instead of comparing against every remaining candidate, we only look at the ones nearby.
+"""
+
+
+class NearestPointIndex:
+    def __init__( self, points : np.ndarray ):
+        # points should be an array of shape ( n, 2 ),
+        # points are referred to by their index in this array
+        self._points = np.asarray( points, dtype = float ).reshape( -1, 2 )
+        self._alive = np.ones( len( self._points ), dtype = bool )
+        self._n_alive = len( self._points )
+        self._build()
+
+    def __len__( self ) -> int:
+        return self._n_alive
+
+    def _build( self ) -> None:
+        # The KD-tree itself does not support removal,
+        # so removed points stay in the tree until it gets rebuilt with only the remaining points.
+        # Rebuilding whenever half of the tree is removed keeps the total cost at O(n log n)
+        self._tree_indices = np.flatnonzero( self._alive )
+        self._tree = cKDTree( self._points[ self._tree_indices ] ) if self._n_alive > 0 else None
+
+    def remove( self, index : int ) -> None:
+        assert self._alive[ index ]
+        self._alive[ index ] = False
+        self._n_alive -= 1
+        if self._n_alive < len( self._tree_indices ) // 2:
+            self._build()
+
+    def nearest( self, x : float, y : float ) -> int:
+        # Returns the index of the remaining point closest to ( x, y ).
+        # If multiple points are equally close, the one with the lowest index is returned,
+        # which is the same result as a stable sort on distance would give.
+        assert self._n_alive > 0
+
+        n_tree = len( self._tree_indices )
+        k = min( 8, n_tree )
+        while True:
+            tree_distances, tree_positions = self._tree.query( ( x, y ), k = k )
+            tree_distances = np.atleast_1d( tree_distances )
+            candidates = self._tree_indices[ np.atleast_1d( tree_positions ) ]
+            candidates = candidates[ self._alive[ candidates ] ]
+
+            if len( candidates ) > 0:
+                # recompute distances exactly the same way as distance() does, for identical tie-breaking
+                deltas = self._points[ candidates ] - ( x, y )
+                distances = np.sqrt( deltas[ :, 0 ] ** 2 + deltas[ :, 1 ] ** 2 )
+                best_distance = distances.min()
+
+                # we are done if no unseen point can be as close as the best one we have seen
+                all_seen = k == n_tree
+                if all_seen or tree_distances[ -1 ] > best_distance * ( 1 + 1e-9 ) + 1e-9:
+                    return int( candidates[ distances == best_distance ].min() )
+
+            k = min( 2 * k, n_tree )
+
+    def pop_nearest( self, x : float, y : float ) -> int:
+        index = self.nearest( x, y )
+        self.remove( index )
+        return index
@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import (
+    ArrayPack,
+    BoardArrayPack,
+    CanvasArrayPack,
+    MotorInstructionsArrayPack,
+    PlotArrayPack,
+)
+from lego_wall_plotter.host.constants import Constants
+
+
+"""
+An on-disk cache for the intermediate results of the conversion, like the sampled and the ordered CanvasPack.
+Every result is stored under a key that is a hash of everything the stage depends on:
+the key of the stage before it, and the values of the Constants it uses.
+Changing a constant thus only invalidates the stages that actually use it, and the stages after those.
+The least recently used results are removed when the cache grows beyond its maximum size.
+"""
+
+
+_PACK_TYPES = { pack_type.__name__ : pack_type for pack_type in [
+    ArrayPack,
+    PlotArrayPack,
+    CanvasArrayPack,
+    BoardArrayPack,
+    MotorInstructionsArrayPack,
+] }
+
+_FILE_EXTENSION = '.npz'
+
+
+def get_file_hash( path : str ) -> str:
+    file_hash = hashlib.sha256()
+    with open( path, 'rb' ) as f:
+        for block in iter( lambda : f.read( 1 << 20 ), b'' ):
+            file_hash.update( block )
+    return file_hash.hexdigest()
+
+
+def make_stage_key( stage_name : str, parent_key : str, constant_names : tuple[ str, ... ], *extra_dependencies ) -> str:
+    # The values of the constants are looked up right now, so the key changes as soon as one of them does
+    # Extra dependencies are values that are not Constants, like a value derived from multiple Constants
+    dependencies = [ stage_name, parent_key ]
+    dependencies += [ f"{name}={getattr( Constants, name )!r}" for name in constant_names ]
+    dependencies += [ repr( dependency ) for dependency in extra_dependencies ]
+    return hashlib.sha256( "\n".join( dependencies ).encode() ).hexdigest()
+
+
+class StageCache:
+
+    def __init__( self, directory : str, max_size_mb : float = Constants.STAGE_CACHE_MAX_SIZE_MB ):
+        self.directory = Path( directory )
+        self.directory.mkdir( parents = True, exist_ok = True )
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+
+    def _get_path( self, key : str ) -> Path:
+        return self.directory / f"{key}{_FILE_EXTENSION}"
+
+    def load( self, key : str ) -> ArrayPack | None:
+        path = self._get_path( key )
+        try:
+            with np.load( path ) as data:
+                pack_type = _PACK_TYPES[ str( data[ 'pack_type' ] ) ]
+                pack = pack_type( data[ 'coordinates' ], data[ 'path_offsets' ] )
+        except FileNotFoundError:
+            return None
+
+        # mark as recently used, so it is evicted last
+        try:
+            os.utime( path )
+        except FileNotFoundError:
+            pass
+        return pack
+
+    def store( self, key : str, pack : ArrayPack ) -> None:
+        # write to a temporary file first, so other processes never see a partially written file
+        file_descriptor, temporary_path = tempfile.mkstemp( dir = self.directory, suffix = '.tmp' )
+        with os.fdopen( file_descriptor, 'wb' ) as f:
+            np.savez( f, pack_type = type( pack ).__name__, coordinates = pack.coordinates, path_offsets = pack.path_offsets )
+        os.replace( temporary_path, self._get_path( key ) )
+        self._evict()
+
+    def _evict( self ) -> None:
+        # remove the least recently used files until the cache fits again
+        entries = []
+        for path in self.directory.glob( f"*{_FILE_EXTENSION}" ):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append( ( stat.st_mtime, stat.st_size, path ) )
+
+        total_size = sum( size for _, size, _ in entries )
+        for _, size, path in sorted( entries, key = lambda entry : entry[ 0 ] ):
+            if total_size <= self.max_size_bytes:
+                break
+            path.unlink( missing_ok = True )
+            total_size -= size
+            logging.info( f"Evicted {path.name} from the stage cache." )
+
+    def get_or_compute( self, key : str, stage_name : str, compute ) -> ArrayPack:
+        start = time.perf_counter()
+        pack = self.load( key )
+        if pack is not None:
+            logging.info( f"Loaded {stage_name} from the stage cache in {time.perf_counter() - start:.3f}s." )
+            return pack
+
+        pack = compute()
+        self.store( key, pack )
+        logging.info( f"Computed {stage_name} in {time.perf_counter() - start:.3f}s, and stored it in the stage cache." )
+        return pack
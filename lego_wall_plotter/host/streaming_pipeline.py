@@ -0,0 +1,189 @@
+import itertools
+import logging
+import tempfile
+
+import numpy as np
+
+from lego_wall_plotter.host.base_types import CanvasArrayPack
+from lego_wall_plotter.host.constants import Constants
+from lego_wall_plotter.host.convert_svg import (
+    clean_svg_paths,
+    determine_scale_factor_fit,
+    determine_svg_bounds,
+    get_greedy_path_order,
+    get_initial_pen_position_in_canvas_space,
+    iter_continuous_paths_from_file,
+    make_canvas_pack_from_svg_paths,
+)
+from lego_wall_plotter.host.make_motor_instructions import make_motor_instructions_for_canvas_pack
+from lego_wall_plotter.host.merge_paths import get_path_merge_order, log_merge_savings
+from lego_wall_plotter.host.motor_instructions_file import (
+    BinaryMotorInstructionsWriter,
+    get_binary_version,
+    write_motor_instructions_path,
+)
+from lego_wall_plotter.host.optimize_path_order import optimize_path_order_for_endpoints
+from lego_wall_plotter.host.plan_motion import get_end_speeds
+from lego_wall_plotter.host.simplify_motor_instructions import simplify_motor_instructions
+
+
+"""
+A streaming version of the conversion from SVG to motor instruction files, for drawings too big to fit in memory.
+Paths flow through sampling, normalization, kinematics and the writers in chunks,
+instead of every stage producing a complete pack before the next stage starts.
+
+Ordering needs to know about all paths before the first one can be written though.
+Only the start and end point of every path are kept in memory for that,
+while the sampled points are spilled to a temporary file, from which they are read back in the chosen order.
+Memory use thus grows with the number of paths, but not with the number of points.
+"""
+
+
+# the number of svg paths to parse and sample at once
+_SAMPLING_CHUNK_SIZE_PATHS = 256
+
+# the number of points to convert to motor instructions at once
+_KINEMATICS_CHUNK_SIZE_POINTS = 1 << 16
+
+
+def _iter_chunks( iterable, chunk_size : int ):
+    iterator = iter( iterable )
+    while chunk := list( itertools.islice( iterator, chunk_size ) ):
+        yield chunk
+
+
+def _iter_canvas_packs(
+        in_path_svg : str,
+        sampling_distance : float,
+        flatness_tolerance_mm : float | None
+):
+    # Yields the sampled and normalized paths, a CanvasArrayPack per chunk of svg paths
+    # The file is read once to determine the bounds, and then again to sample the paths
+    bounds = determine_svg_bounds( iter_continuous_paths_from_file( in_path_svg ) )
+    scale_factor_fit = determine_scale_factor_fit( bounds )
+    scaled_sampling_distance = sampling_distance / scale_factor_fit
+    scaled_flatness_tolerance = None if flatness_tolerance_mm is None else flatness_tolerance_mm / scale_factor_fit
+
+    for paths in _iter_chunks( iter_continuous_paths_from_file( in_path_svg ), _SAMPLING_CHUNK_SIZE_PATHS ):
+        paths_point_based = clean_svg_paths( paths, scaled_sampling_distance, scaled_flatness_tolerance )
+        yield make_canvas_pack_from_svg_paths( paths_point_based, bounds, scale_factor_fit )
+
+
+def _iter_ordered_path_chunks(
+        coordinates : np.ndarray,
+        path_offsets : np.ndarray,
+        order : np.ndarray,
+        reversed_paths : np.ndarray,
+        joins_previous : np.ndarray
+):
+    # Yields CanvasArrayPacks of consecutive paths in the given order, with roughly a fixed number of points each
+    # Paths that are joined to the one before them are appended to it, see merge_paths.py
+    # The coordinates can be memory mapped, only the paths of the current chunk are read
+    path_arrays = []
+    n_points = 0
+    for index, is_reversed, is_joined in zip( order.tolist(), reversed_paths.tolist(), joins_previous.tolist() ):
+        path_array = coordinates[ path_offsets[ index ] : path_offsets[ index + 1 ] ]
+        path_array = np.array( path_array[ : : -1 ] if is_reversed else path_array )
+        if is_joined:
+            previous_path_array = path_arrays[ -1 ]
+            if np.array_equal( path_array[ 0 ], previous_path_array[ -1 ] ):
+                path_array = path_array[ 1 : ]
+            path_arrays[ -1 ] = np.concatenate( ( previous_path_array, path_array ) )
+            n_points += len( path_array )
+            continue
+
+        # only start a new chunk between paths that are not joined
+        if n_points >= _KINEMATICS_CHUNK_SIZE_POINTS:
+            yield CanvasArrayPack.from_path_arrays( path_arrays )
+            path_arrays = []
+            n_points = 0
+        path_arrays.append( path_array )
+        n_points += len( path_array )
+    if path_arrays:
+        yield CanvasArrayPack.from_path_arrays( path_arrays )
+
+
+def convert_svg_file_to_motor_instructions_files(
+        in_path_svg : str,
+        out_path_motor_instructions : str,
+        out_path_motor_instructions_binary : str,
+        sampling_distance : float = Constants.SAMPLING_DISTANCE,
+        flatness_tolerance_mm : float | None = Constants.SAMPLING_FLATNESS_TOLERANCE_MM,
+        optimization_time_budget_s : float = Constants.PATH_ORDER_OPTIMIZATION_TIME_BUDGET_S,
+        delta_encode_instructions : bool = False,
+        merge_tolerance_mm : float | None = Constants.PATH_MERGE_TOLERANCE_MM
+) -> int:
+    # The same steps as main.make_motor_instructions, without the previews
+    # Returns the number of motor instructions that were written
+
+    with tempfile.TemporaryFile() as spill_file:
+
+        # sample all paths, and keep only their endpoints in memory
+        path_lengths = []
+        path_starts = []
+        path_ends = []
+        for canvas_pack in _iter_canvas_packs( in_path_svg, sampling_distance, flatness_tolerance_mm ):
+            spill_file.write( canvas_pack.coordinates.tobytes() )
+            path_lengths.append( canvas_pack.path_lengths )
+            path_starts.append( canvas_pack.path_starts() )
+            path_ends.append( canvas_pack.path_ends() )
+        spill_file.flush()
+
+        path_lengths = np.concatenate( path_lengths ) if path_lengths else np.zeros( 0, dtype = np.int64 )
+        path_offsets = np.concatenate( ( [ 0 ], np.cumsum( path_lengths ) ) )
+        n_paths = len( path_lengths )
+        logging.info( f"Sampled {n_paths} paths with {path_offsets[ -1 ]} points." )
+
+        # determine the order from the endpoints only
+        if n_paths > 0:
+            path_starts = np.concatenate( path_starts )
+            path_ends = np.concatenate( path_ends )
+            greedy_order = get_greedy_path_order( path_starts, path_ends )
+            optimized_order, reversed_paths = optimize_path_order_for_endpoints(
+                path_starts[ greedy_order ],
+                path_ends[ greedy_order ],
+                get_initial_pen_position_in_canvas_space(),
+                optimization_time_budget_s
+            )
+            order = greedy_order[ optimized_order ]
+            joins_previous = np.zeros( n_paths, dtype = bool )
+
+            # join the paths that touch, in the order and direction they are drawn in
+            if merge_tolerance_mm is not None:
+                logging.info( "Merging touching paths." )
+                ordered_starts = np.where( reversed_paths[ :, None ], path_ends[ order ], path_starts[ order ] )
+                ordered_ends = np.where( reversed_paths[ :, None ], path_starts[ order ], path_ends[ order ] )
+                merge_order, merge_reversed, joins_previous = get_path_merge_order( ordered_starts, ordered_ends, merge_tolerance_mm )
+                order = order[ merge_order ]
+                reversed_paths = reversed_paths[ merge_order ] ^ merge_reversed
+                log_merge_savings( n_paths, int( np.count_nonzero( ~joins_previous ) ) )
+            del path_starts, path_ends
+            coordinates = np.memmap( spill_file, dtype = np.float64, mode = 'r', shape = ( int( path_offsets[ -1 ] ), 2 ) )
+        else:
+            order = np.zeros( 0, dtype = np.int64 )
+            reversed_paths = joins_previous = np.zeros( 0, dtype = bool )
+            coordinates = np.zeros( ( 0, 2 ) )
+
+        # read the paths back in order, and convert and write them one chunk at a time
+        n_instructions = 0
+        version = get_binary_version( delta_encode_instructions, Constants.CONTINUOUS_MOTION )
+        with open( out_path_motor_instructions, 'w' ) as instructions_file, \
+                BinaryMotorInstructionsWriter( out_path_motor_instructions_binary, version = version ) as binary_writer:
+            n_merged_paths = int( np.count_nonzero( ~joins_previous ) )
+            instructions_file.write( f'{n_merged_paths}\n' )
+            for canvas_pack in _iter_ordered_path_chunks( coordinates, path_offsets, order, reversed_paths, joins_previous ):
+                motor_instructions_pack = simplify_motor_instructions( make_motor_instructions_for_canvas_pack( canvas_pack ) )
+
+                # end speeds only depend on the path itself, so they can be planned a chunk at a time
+                end_speeds = get_end_speeds( motor_instructions_pack ) if Constants.CONTINUOUS_MOTION else None
+                for i_path, path in enumerate( motor_instructions_pack.iter_path_coordinates() ):
+                    path_end_speeds = None
+                    if end_speeds is not None:
+                        path_end_speeds = end_speeds[ motor_instructions_pack.path_offsets[ i_path ] : motor_instructions_pack.path_offsets[ i_path + 1 ] ]
+                    write_motor_instructions_path( instructions_file, path, path_end_speeds )
+                    binary_writer.write_path( path, path_end_speeds )
+                n_instructions += motor_instructions_pack.n_points
+        del coordinates
+
+    logging.info( f"Wrote {n_instructions} motor instructions for {n_merged_paths} paths." )
+    return n_instructions
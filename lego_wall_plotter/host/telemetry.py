@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+import logging
+import struct
+import sys
+
+import numpy as np
+
+from lego_wall_plotter.host.constants import Constants
+
+
+"""
+Reads the telemetry the Device can record while plotting, see TelemetryRecorder in the device code.
+The file starts with a header: magic b'LWPT', uint16 version, uint16 record size, uint32 capacity, uint32 number of records,
+followed by a ring buffer of <capacity> records, little-endian:
+uint32 iterations of the control loop, uint32 duration in microseconds, float32 final error in degrees.
+Record i is stored at position i % capacity, and only the last <capacity> records are kept.
+The final error is measured at the start of the next move, so it includes overshoot, and is -1 when it is not known yet.
+
+Example, after copying the file from the hub:
+    python -m lego_wall_plotter.host.telemetry telemetry.bin
+"""
+
+
+TELEMETRY_MAGIC = b'LWPT'
+TELEMETRY_VERSION = 1
+TELEMETRY_HEADER_FORMAT = '<4sHHII'
+TELEMETRY_HEADER_SIZE = struct.calcsize( TELEMETRY_HEADER_FORMAT )
+TELEMETRY_RECORD_DTYPE = np.dtype( [ ( 'n_iterations', '<u4' ), ( 'duration_us', '<u4' ), ( 'final_error_degrees', '<f4' ) ] )
+
+
+@dataclass
+class Telemetry:
+    # one entry per move, from oldest to newest
+    n_iterations : np.ndarray
+    duration_s : np.ndarray
+    final_error_degrees : np.ndarray
+    n_moves : int # including the moves that did not fit in the ring buffer anymore
+
+
+def read_telemetry_file( path : str ) -> Telemetry:
+    with open( path, 'rb' ) as f:
+        data = f.read()
+
+    magic, version, record_size, capacity, n_records = struct.unpack_from( TELEMETRY_HEADER_FORMAT, data )
+    assert magic == TELEMETRY_MAGIC, f"'{path}' is not a telemetry file."
+    assert version == TELEMETRY_VERSION, f"'{path}' has unsupported version {version}."
+    assert record_size == TELEMETRY_RECORD_DTYPE.itemsize
+
+    records = np.frombuffer( data, dtype = TELEMETRY_RECORD_DTYPE, count = capacity, offset = TELEMETRY_HEADER_SIZE )
+
+    # once the ring buffer is full, the oldest record is the one that would be overwritten next
+    if n_records > capacity:
+        records = np.roll( records, -( n_records % capacity ) )
+    else:
+        records = records[ : n_records ]
+
+    return Telemetry(
+        n_iterations = records[ 'n_iterations' ].astype( np.int64 ),
+        duration_s = records[ 'duration_us' ] / 1e6,
+        final_error_degrees = records[ 'final_error_degrees' ].astype( np.float64 ),
+        n_moves = n_records,
+    )
+
+
+def log_telemetry_summary( telemetry : Telemetry ) -> None:
+    n_records = len( telemetry.n_iterations )
+    if n_records == 0:
+        logging.info( "The telemetry has no moves." )
+        return
+
+    iteration_rate = telemetry.n_iterations.sum() / max( telemetry.duration_s.sum(), 1e-9 )
+    final_errors_mm = telemetry.final_error_degrees[ telemetry.final_error_degrees >= 0 ] * abs( Constants.MM_PER_DEGREE )
+    logging.info( f"Telemetry of the last {n_records} of {telemetry.n_moves} moves:" )
+    logging.info( f"  control loop: {iteration_rate:.0f} iterations per second" )
+    logging.info(
+        f"  iterations per move: median {np.median( telemetry.n_iterations ):.0f}, "
+        f"95th percentile {np.percentile( telemetry.n_iterations, 95 ):.0f}, max {telemetry.n_iterations.max()}"
+    )
+    logging.info(
+        f"  duration per move: median {np.median( telemetry.duration_s ) * 1000:.1f}ms, total {telemetry.duration_s.sum():.1f}s"
+    )
+    if len( final_errors_mm ) > 0:
+        logging.info(
+            f"  final error: median {np.median( final_errors_mm ):.2f}mm, "
+            f"95th percentile {np.percentile( final_errors_mm, 95 ):.2f}mm, max {final_errors_mm.max():.2f}mm"
+        )
+
+
+if __name__ == "__main__" :
+    logging.basicConfig( level = logging.INFO )
+    log_telemetry_summary( read_telemetry_file( sys.argv[ 1 ] ) )